@@ -0,0 +1,837 @@
+"""A local stand-in for the parts of the GitHub API the stalebot uses.
+
+It serves one repository over REST and GraphQL, with pagination, ``since``
+filters, ETags and conditional requests, rate limit headers, and writes that
+change what later requests see. GraphQL is not parsed in general: only the
+queries and mutations the stalebot sends are recognized, by operation name.
+
+Latency and rate limits can be injected, and every request is counted, so that
+runs against it tell how many requests and bytes a change costs.
+
+"""
+import hashlib
+import itertools
+import json
+import random
+import re
+import shlex
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlencode, urlparse
+
+BOT = {'login': 'github-actions[bot]', 'type': 'Bot'}
+HUMANS = [{'login': f'user{i}', 'type': 'User'} for i in range(50)]
+MAINTAINER = {'login': 'maintainer', 'type': 'User'}
+OTHER_LABELS = ['Bug', 'Docs', 'Effort-low', 'Feature Request', 'io.fits', 'units']
+DAY = timedelta(days=1)
+
+
+def _iso(t):
+    return t.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _text(rng, n_words):
+    words = ('the', 'a', 'fix', 'test', 'array', 'units', 'table', 'should', 'please',
+             'rebase', 'coordinates', 'thanks', 'review', 'docs', 'changelog', 'ping')
+    return ' '.join(rng.choice(words) for _ in range(n_words))
+
+
+class Item:
+    """One issue or pull request and everything that happened to it."""
+    def __init__(self, number, is_pr, created_at, author):
+        self.number = number
+        self.is_pr = is_pr
+        self.repo_index = 0  # Which repository of the server, for node IDs
+        self.state = 'open'
+        self.created_at = created_at
+        self.updated_at = created_at
+        self.author = author
+        self.title = f'Item {number}'
+        self.body = ''
+        self.labels = []
+        self.commits = []  # (sha, committed_at), oldest first
+        self.comments = []  # dicts, oldest first
+        self.events = []  # timeline events other than comments and commits, oldest first
+
+    def touch(self, t):
+        self.updated_at = max(self.updated_at, t)
+
+    def add_commit(self, t):
+        sha = hashlib.sha1(f'{self.number}-{len(self.commits)}-{t}'.encode()).hexdigest()
+        self.commits.append((sha, t))
+        self.touch(t)
+
+    def add_comment(self, user, body, t):
+        self.comments.append({'id': self.number * 100000 + len(self.comments), 'user': user,
+                              'body': body, 'created_at': t, 'updated_at': t})
+        self.touch(t)
+        return self.comments[-1]
+
+    def edit_comment(self, comment, t):
+        comment['updated_at'] = t
+        self.touch(t)
+
+    def add_event(self, event, t, actor, label=None):
+        self.events.append({'event': event, 'created_at': t, 'actor': actor, 'label': label})
+        self.events.sort(key=lambda e: e['created_at'])
+        self.touch(t)
+
+    def add_label(self, name, t, actor):
+        if name not in self.labels:
+            self.labels.append(name)
+        self.add_event('labeled', t, actor, label=name)
+
+    def remove_label(self, name, t, actor):
+        self.labels.remove(name)
+        self.add_event('unlabeled', t, actor, label=name)
+
+    @property
+    def head_sha(self):
+        return self.commits[-1][0] if self.commits else None
+
+
+class FakeRepo:
+    """The repository served, with a fixed idea of what time it is.
+
+    Parameters
+    ----------
+    full_name : str
+        ``owner/name``.
+
+    now : datetime
+        Time all synthetic history is relative to.
+
+    """
+    def __init__(self, full_name='astropy/astropy', now=None):
+        self.full_name = full_name
+        self.now = now or datetime.now(timezone.utc)
+        self.items = {}
+        self.labels = {'Close?', 'keep-open', 'closed-by-bot', *OTHER_LABELS}
+
+    def add(self, is_pr, created_at, author=None):
+        number = len(self.items) + 1
+        item = Item(number, is_pr, created_at, author or HUMANS[0])
+        self.items[number] = item
+        return item
+
+    def open_items(self, is_pr=None):
+        return [item for item in self.items.values() if item.state == 'open' and
+                (is_pr is None or item.is_pr == is_pr)]
+
+    @classmethod
+    def synthetic(cls, n_items, seed=0, now=None, pr_fraction=0.3, stale_label='Close?',
+                  keep_open_label='keep-open', full_name='astropy/astropy'):
+        """A repository with ``n_items`` open issues and PRs, loosely shaped like astropy.
+
+        Commit and comment counts are heavy tailed, from one to a few hundred.
+        About half the PRs have not seen a commit in five months; most of those
+        carry the stale label and a bot warning. A fifth of the issues are
+        labeled as stale, half of those already warned. Some items are kept
+        open by label, and some PRs were force pushed, a few well after their
+        head commit was made.
+
+        """
+        # Imported here so that the server itself does not need the bot on the path.
+        from stale_issues import ISSUE_CLOSE_WARNING
+        from stale_pull_requests import PULL_REQUESTS_CLOSE_WARNING
+
+        rng = random.Random(seed)
+        repo = cls(full_name=full_name, now=now)
+        now = repo.now
+        for _ in range(n_items):
+            is_pr = rng.random() < pr_fraction
+            created_at = now - rng.uniform(1, 8 * 365) * DAY
+            item = repo.add(is_pr, created_at, author=rng.choice(HUMANS))
+            item.body = _text(rng, rng.randint(20, 200))
+            age = (now - created_at) / DAY
+            for label in rng.sample(OTHER_LABELS, rng.randint(0, 3)):
+                item.add_label(label, created_at + rng.uniform(0, age) * DAY * 0.1, MAINTAINER)
+
+            n_comments = min(300, int(rng.paretovariate(1.1)) - 1 + rng.randint(0, 3))
+            for _ in range(n_comments):
+                t = created_at + rng.uniform(0, age) * DAY
+                item.add_comment(rng.choice(HUMANS), _text(rng, rng.randint(5, 80)), t)
+            item.comments.sort(key=lambda c: c['created_at'])
+
+            if is_pr:
+                # Half are recent enough, half have been idle for over five months.
+                if rng.random() < 0.5:
+                    last_commit_age = rng.uniform(0, min(age, 150))
+                else:
+                    last_commit_age = rng.uniform(min(age, 150), age)
+                n_commits = min(250, int(rng.paretovariate(1.0)))
+                last_commit = now - last_commit_age * DAY
+                for i in range(n_commits):
+                    item.add_commit(created_at + (last_commit - created_at) * (i + 1) / n_commits)
+                if rng.random() < 0.2:
+                    item.add_event('head_ref_force_pushed', last_commit + timedelta(minutes=5),
+                                   item.author)
+                if rng.random() < 0.02:
+                    item.add_event('head_ref_force_pushed',
+                                   last_commit + rng.uniform(2, 30) * DAY, item.author)
+                if last_commit_age > 150 and rng.random() < 0.8:
+                    labeled = now - rng.uniform(0, min(60, last_commit_age - 150)) * DAY
+                    item.add_label(stale_label, labeled, BOT)
+                    warning = PULL_REQUESTS_CLOSE_WARNING.format(
+                        keepopen=keep_open_label, pasttime='5 months', futuretime='a month')
+                    item.add_comment(BOT, warning, labeled + timedelta(seconds=30))
+            elif rng.random() < 0.2:
+                labeled = now - rng.uniform(0, 30) * DAY
+                item.add_label(stale_label, labeled, MAINTAINER)
+                if rng.random() < 0.5:
+                    warning = ISSUE_CLOSE_WARNING.format(
+                        closelabel=stale_label, pasttime='a day ago', futuretime='a week')
+                    item.add_comment(BOT, warning, labeled + rng.uniform(0, 1) * DAY)
+
+            if rng.random() < 0.05:
+                item.add_label(keep_open_label, now - rng.uniform(0, age) * DAY, MAINTAINER)
+        return repo
+
+
+class Stats:
+    """What the server was asked to do."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.rest_reads = 0
+        self.rest_writes = 0
+        self.graphql_queries = 0
+        self.graphql_mutations = 0
+        self.not_modified = 0
+        self.rate_limited = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def as_dict(self):
+        return {k: v for k, v in vars(self).items() if k != 'lock'}
+
+
+class FakeGitHub:
+    """HTTP server for one or more `FakeRepo`, in a background thread.
+
+    Parameters
+    ----------
+    repos : `FakeRepo` or list of `FakeRepo`
+        What to serve. Owners are served as organizations.
+
+    latency : float
+        Seconds to wait before answering each request.
+
+    rate_limit : int
+        Requests allowed per ``reset_seconds``, for REST and GraphQL each.
+        A 304 response does not count, like on GitHub.
+
+    reset_seconds : float
+        Length of a rate limit window.
+
+    secondary_every : int
+        Reject every this many writes with a secondary rate limit (403 with
+        ``Retry-After``). Disabled if zero.
+
+    locked_labels : iterable of str
+        Labels that cannot be added with GraphQL: the mutation fails, but
+        the others in the same request still run, as on GitHub.
+
+    """
+    def __init__(self, repos, latency=0, rate_limit=5000, reset_seconds=3600, secondary_every=0,
+                 locked_labels=()):
+        self.repos = [repos] if isinstance(repos, FakeRepo) else list(repos)
+        self.repo = self.repos[0]
+        for index, repo in enumerate(self.repos):
+            for item in repo.items.values():
+                item.repo_index = index
+        self.lock = threading.Lock()
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.reset_seconds = reset_seconds
+        self.secondary_every = secondary_every
+        self.locked_labels = set(locked_labels)
+        self.stats = Stats()
+        self._budgets = {}
+        self._writes = itertools.count(1)
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _make_handler(self))
+        self._server.daemon_threads = True
+        self.base_url = f'http://127.0.0.1:{self._server.server_port}'
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def charge(self, resource):
+        """Count a request against its budget. Returns the budget after it."""
+        with self.stats.lock:
+            now = time.time()
+            budget = self._budgets.get(resource)
+            if budget is None or budget['reset'] <= now:
+                budget = self._budgets[resource] = {
+                    'remaining': self.rate_limit, 'reset': int(now + self.reset_seconds)}
+            if budget['remaining'] > 0:
+                budget['remaining'] -= 1
+                budget['charged'] = True
+            else:
+                budget['charged'] = False
+            return dict(budget)
+
+    def refund(self, resource):
+        with self.stats.lock:
+            self._budgets[resource]['remaining'] += 1
+
+    def budgets(self):
+        with self.stats.lock:
+            return {resource: dict(budget) for resource, budget in self._budgets.items()}
+
+    def repo_named(self, full_name):
+        for repo in self.repos:
+            if repo.full_name.lower() == full_name.lower():
+                return repo
+        return None
+
+    def item_of(self, node_id):
+        _, index, number = node_id.split('_')
+        return self.repos[int(index)].items[int(number)]
+
+    def secondary_limited(self):
+        return self.secondary_every > 0 and next(self._writes) % self.secondary_every == 0
+
+
+# JSON for REST responses. Only roughly the fields GitHub sends, but enough for PyGithub.
+
+def _user(user):
+    return {'login': user['login'], 'type': user['type'], 'id': abs(hash(user['login'])) % 10**8}
+
+
+def _label(base, name):
+    return {'name': name, 'color': 'ededed', 'node_id': f'LA_{name}',
+            'url': f'{base}/labels/{quote(name)}'}
+
+
+def _issue_json(base, item):
+    d = {'number': item.number, 'node_id': f'I_{item.repo_index}_{item.number}',
+         'title': item.title,
+         'body': item.body, 'state': item.state, 'user': _user(item.author),
+         'labels': [_label(base, name) for name in item.labels],
+         'created_at': _iso(item.created_at), 'updated_at': _iso(item.updated_at),
+         'url': f'{base}/issues/{item.number}',
+         'comments': len(item.comments)}
+    if item.is_pr:
+        d['pull_request'] = {'url': f'{base}/pulls/{item.number}'}
+    return d
+
+
+def _pr_json(base, item, repo_json):
+    d = _issue_json(base, item)
+    d.pop('pull_request')
+    d['node_id'] = f'PR_{item.repo_index}_{item.number}'
+    d['url'] = f'{base}/pulls/{item.number}'
+    d['issue_url'] = f'{base}/issues/{item.number}'
+    d['head'] = {'sha': item.head_sha, 'ref': f'branch-{item.number}', 'repo': repo_json}
+    d['base'] = {'sha': 'main', 'ref': 'main', 'repo': repo_json}
+    return d
+
+
+def _comment_json(base, comment):
+    return {'id': comment['id'], 'node_id': f'IC_{comment["id"]}',
+            'url': f'{base}/issues/comments/{comment["id"]}', 'user': _user(comment['user']),
+            'body': comment['body'], 'created_at': _iso(comment['created_at']),
+            'updated_at': _iso(comment['updated_at'])}
+
+
+def _commit_json(base, sha, t):
+    person = {'name': 'Someone', 'email': 'someone@example.com', 'date': _iso(t)}
+    return {'sha': sha, 'url': f'{base}/commits/{sha}',
+            'commit': {'message': 'Commit message', 'author': person, 'committer': person,
+                       'url': f'{base}/git/commits/{sha}'}}
+
+
+def _timeline(base, item):
+    """All timeline events of an item, oldest first, like the REST timeline."""
+    entries = [(e['created_at'], {'event': e['event'], 'created_at': _iso(e['created_at']),
+                                  'actor': _user(e['actor']),
+                                  **({'label': {'name': e['label'], 'color': 'ededed'}}
+                                     if e['label'] else {})})
+               for e in item.events]
+    entries += [(c['created_at'], dict(_comment_json(base, c), event='commented',
+                                       actor=_user(c['user'])))
+                for c in item.comments]
+    # Commits have no creation time of their own in the timeline.
+    entries += [(t, dict(_commit_json(base, sha, t)['commit'], sha=sha, event='committed'))
+                for sha, t in item.commits]
+    entries.sort(key=lambda e: e[0])
+    return [e for _, e in entries]
+
+
+# GraphQL, for the queries the stalebot sends.
+
+def _gql_actor(user):
+    if user['type'] == 'Bot':
+        return {'__typename': 'Bot', 'login': user['login'].replace('[bot]', '')}
+    return {'__typename': 'User', 'login': user['login']}
+
+
+def _gql_last(entries, before=None):
+    """A connection of the last 100 entries before the cursor, which is an index."""
+    end = len(entries) if before is None else int(before)
+    start = max(0, end - 100)
+    return {'pageInfo': {'hasPreviousPage': start > 0, 'startCursor': str(start)},
+            'nodes': entries[start:end]}
+
+
+def _gql_comments(item, before=None):
+    return _gql_last([
+        {'author': _gql_actor(c['user']), 'body': c['body'],
+         'createdAt': _iso(c['created_at']), 'updatedAt': _iso(c['updated_at'])}
+        for c in item.comments], before)
+
+
+def _gql_labeled(item, before=None):
+    return _gql_last([
+        {'createdAt': _iso(e['created_at']), 'actor': _gql_actor(e['actor']),
+         'label': {'name': e['label']}}
+        for e in item.events if e['event'] == 'labeled'], before)
+
+
+def _gql_node(item, n_commits):
+    node = {
+        '__typename': 'PullRequest' if item.is_pr else 'Issue',
+        'id': f'{"PR" if item.is_pr else "I"}_{item.repo_index}_{item.number}',
+        'number': item.number, 'state': item.state.upper(), 'updatedAt': _iso(item.updated_at),
+        'labels': {'nodes': [{'name': name} for name in item.labels]},
+        'comments': _gql_comments(item),
+        'timelineItems': _gql_labeled(item),
+    }
+    if item.is_pr:
+        node['commits'] = {'nodes': [{'commit': {'committedDate': _iso(t)}}
+                                     for _, t in item.commits[-n_commits:]]}
+        node['forcePushes'] = {'nodes': [{'createdAt': _iso(e['created_at'])} for e in item.events
+                                         if e['event'] == 'head_ref_force_pushed'][-1:]}
+    return node
+
+
+def _gql_listed(item):
+    return {'number': item.number, 'updatedAt': _iso(item.updated_at),
+            'labels': {'nodes': [{'name': name} for name in item.labels]}}
+
+
+def _graphql(server, data):
+    """Answer a GraphQL request. Returns the response and whether it was a mutation."""
+    query = data['query']
+    variables = data.get('variables') or {}
+    if query.lstrip().startswith('mutation'):
+        return _graphql_mutation(server, query, variables), True
+    repo = server.repo_named(f'{variables.get("owner")}/{variables.get("name")}')
+    if repo is None:
+        return {'data': {'repository': None},
+                'errors': [{'message': 'Could not resolve to a Repository'}]}, False
+
+    match = re.search(r'query\s+(\w+)', query)
+    name = match.group(1) if match else ''
+    match = re.search(r'commits\(last: (\d+)\)', query)
+    n_commits = int(match.group(1)) if match else 100
+
+    if name in ('StalePullRequests', 'StaleIssues', 'StaleOpenPullRequestNumbers',
+                'StaleOpenIssueNumbers'):
+        is_pr = 'PullRequest' in name
+        items = sorted(repo.open_items(is_pr=is_pr), key=lambda i: i.created_at)
+        if variables.get('labels'):
+            items = [i for i in items if set(variables['labels']) <= set(i.labels)]
+        start = int(variables.get('after') or 0)
+        first = variables['first']
+        connection = 'pullRequests' if is_pr else 'issues'
+        return {'data': {'repository': {connection: {
+            'pageInfo': {'hasNextPage': start + first < len(items),
+                         'endCursor': str(start + first)},
+            'nodes': [_gql_listed(i) if name.endswith('Numbers') else _gql_node(i, n_commits)
+                      for i in items[start:start + first]]}}}}, False
+
+    if name.endswith('ByNumber') or name == 'StalebotCurrentState':
+        want_pr = 'PullRequest' in name
+        out = {}
+        for alias, number in re.findall(r'(n\d+): issueOrPullRequest\(number: (\d+)\)', query):
+            item = repo.items.get(int(number))
+            if item is None:
+                out[alias] = None
+            elif name == 'StalebotCurrentState' or item.is_pr == want_pr:
+                out[alias] = _gql_node(item, n_commits)
+            else:
+                out[alias] = {}  # Inline fragment for the other type matches nothing.
+        return {'data': {'repository': out}}, False
+
+    if name == 'StalePullRequestCommits':
+        item = repo.items[variables['number']]
+        return {'data': {'repository': {'pullRequest': _gql_node(item, n_commits)}}}, False
+
+    if name in ('StaleOlderComments', 'StaleOlderLabeledEvents'):
+        item = repo.items[variables['number']]
+        if name == 'StaleOlderComments':
+            found = {'comments': _gql_comments(item, variables['before'])}
+        else:
+            found = {'timelineItems': _gql_labeled(item, variables['before'])}
+        return {'data': {'repository': {'issueOrPullRequest': found}}}, False
+
+    if name == 'StalebotLabels':
+        out = {k: ({'id': f'LA_{v}'} if v in repo.labels else None)
+               for k, v in variables.items() if re.fullmatch(r'l\d+', k)}
+        return {'data': {'repository': out}}, False
+
+    return {'errors': [{'message': f'Fake server does not know query {name!r}'}]}, False
+
+
+def _graphql_mutation(server, query, variables):
+    out = {}
+    errors = []
+    now = datetime.now(timezone.utc)
+    for alias, mutation, var in re.findall(r'(\w+): (\w+)\(input: \$(\w+)\)', query):
+        data = variables[var]
+        node_id = (data.get('labelableId') or data.get('subjectId') or data.get('issueId') or
+                   data.get('pullRequestId'))
+        item = server.item_of(node_id)
+        if mutation == 'addLabelsToLabelable':
+            if any(label_id[3:] in server.locked_labels for label_id in data['labelIds']):
+                errors.append({'path': [alias], 'message': 'Label cannot be added'})
+                continue
+            for label_id in data['labelIds']:
+                item.add_label(label_id[3:], now, BOT)
+        elif mutation == 'removeLabelsFromLabelable':
+            for label_id in data['labelIds']:
+                item.remove_label(label_id[3:], now, BOT)
+        elif mutation == 'addComment':
+            item.add_comment(BOT, data['body'], now)
+        elif mutation in ('closeIssue', 'closePullRequest'):
+            if (mutation == 'closePullRequest') != item.is_pr:
+                errors.append({'path': [alias], 'message': 'Could not resolve to a node'})
+                continue
+            item.state = 'closed'
+            item.add_event('closed', now, BOT)
+        out[alias] = {'clientMutationId': None}
+    response = {'data': out}
+    if errors:
+        response['errors'] = errors
+    return response
+
+
+def _repo_json(server, repo):
+    return {'full_name': repo.full_name, 'name': repo.full_name.split('/')[1], 'archived': False,
+            'owner': {'login': repo.full_name.split('/')[0], 'type': 'Organization'},
+            'url': f'{server.base_url}/repos/{repo.full_name}'}
+
+
+def _make_handler(server):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        # Plumbing
+
+        def _body(self):
+            n = int(self.headers.get('Content-Length', 0))
+            raw = self.rfile.read(n) if n else b''
+            server.stats.bytes_in += len(raw)
+            return json.loads(raw) if raw else None
+
+        def _respond(self, code, obj=None, headers=(), budget=None, resource='core'):
+            body = b'' if obj is None else json.dumps(obj).encode('utf-8')
+            headers = list(headers)
+            if budget is not None:
+                headers += [('X-RateLimit-Limit', str(server.rate_limit)),
+                            ('X-RateLimit-Remaining', str(budget['remaining'])),
+                            ('X-RateLimit-Reset', str(budget['reset'])),
+                            ('X-RateLimit-Resource', resource)]
+            if obj is not None:
+                headers += [('Content-Type', 'application/json; charset=utf-8')]
+            headers += [('Content-Length', str(len(body)))]
+            self.send_response(code)
+            for key, value in headers:
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+            server.stats.bytes_out += len(body) + sum(len(k) + len(v) + 4 for k, v in headers)
+
+        def _start(self, resource):
+            """Count the request and apply latency and rate limits. Returns the budget or `None`."""
+            with server.stats.lock:
+                server.stats.requests += 1
+                server.stats.bytes_in += len(self.requestline) + sum(
+                    len(k) + len(v) + 4 for k, v in self.headers.items())
+            if server.latency:
+                time.sleep(server.latency)
+            budget = server.charge(resource)
+            if not budget['charged']:
+                with server.stats.lock:
+                    server.stats.rate_limited += 1
+                self._respond(403, {'message': 'API rate limit exceeded'}, budget=budget,
+                              resource=resource)
+                return None
+            return budget
+
+        def _secondary(self):
+            if not server.secondary_limited():
+                return False
+            with server.stats.lock:
+                server.stats.rate_limited += 1
+            self._respond(403, {'message': 'You have exceeded a secondary rate limit.'},
+                          headers=[('Retry-After', '1')])
+            return True
+
+        def _json_get(self, obj, budget, link=None, resource='core'):
+            body = json.dumps(obj).encode('utf-8')
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()
+            if self.headers.get('If-None-Match') == etag:
+                server.refund(resource)  # Conditional requests are free.
+                with server.stats.lock:
+                    server.stats.not_modified += 1
+                budget = dict(budget, remaining=budget['remaining'] + 1)
+                return self._respond(304, headers=[('ETag', etag)], budget=budget,
+                                     resource=resource)
+            headers = [('ETag', etag)]
+            if link:
+                headers.append(('Link', link))
+            self._respond(200, obj, headers=headers, budget=budget, resource=resource)
+
+        def _page(self, entries, query, budget, search=False):
+            per_page = min(100, int(query.get('per_page', ['30'])[0]))
+            page = int(query.get('page', ['1'])[0])
+            # Like GitHub, only the first 1000 search results can be paged through.
+            pageable = entries[:1000] if search else entries
+            last = max(1, -(-len(pageable) // per_page))
+            path = urlparse(self.path).path
+
+            def url(n):
+                params = {k: v[0] for k, v in query.items()}
+                params['page'] = n
+                return f'<{server.base_url}{path}?{urlencode(params)}>'
+
+            links = []
+            if page < last:
+                links += [f'{url(page + 1)}; rel="next"', f'{url(last)}; rel="last"']
+            if page > 1:
+                links += [f'{url(page - 1)}; rel="prev"', f'{url(1)}; rel="first"']
+            obj = pageable[(page - 1) * per_page:page * per_page]
+            if search:
+                obj = {'total_count': len(entries), 'incomplete_results': False, 'items': obj}
+            self._json_get(obj, budget, link=', '.join(links) or None,
+                           resource='search' if search else 'core')
+
+        def _search(self, query, budget):
+            """Answer the subset of issue search queries the bot makes."""
+            terms = shlex.split(query['q'][0])
+            qualifiers = [term.split(':', 1) for term in terms if ':' in term]
+            repo = server.repo_named(dict(qualifiers).get('repo', ''))
+            if repo is None:
+                return self._respond(422, {'message': 'Validation Failed'}, budget=budget,
+                                     resource='search')
+            with server.lock:
+                items = list(repo.items.values())
+                for key, value in qualifiers:
+                    if key == 'is' and value in ('pr', 'issue'):
+                        items = [i for i in items if i.is_pr == (value == 'pr')]
+                    elif key == 'is':
+                        items = [i for i in items if i.state == value]
+                    elif key in ('label', '-label'):
+                        items = [i for i in items if (value in i.labels) == (key == 'label')]
+                    elif key == 'updated' and value.startswith('<'):
+                        before = datetime.fromisoformat(value[1:].replace('Z', '+00:00'))
+                        items = [i for i in items if i.updated_at < before]
+                items.sort(key=lambda i: i.created_at,
+                           reverse=query.get('order', ['desc'])[0] == 'desc')
+                base = f'{server.base_url}/repos/{repo.full_name}'
+                entries = [_issue_json(base, i) for i in items]
+            self._page(entries, query, budget, search=True)
+
+        def _repo(self):
+            """The repository a REST request is for, its URL, and the rest of the path."""
+            match = re.match(r'/repos/([^/]+/[^/]+)(.*)$', urlparse(self.path).path)
+            repo = server.repo_named(match.group(1)) if match else None
+            if repo is None:
+                return None, None, None
+            return repo, f'{server.base_url}/repos/{repo.full_name}', match.group(2)
+
+        # REST and GraphQL
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == '/rate_limit':  # Free, like on GitHub
+                resources = {name: {'limit': server.rate_limit, 'used': 0,
+                                    'remaining': server.rate_limit,
+                                    'reset': int(time.time() + server.reset_seconds)}
+                             for name in ('core', 'graphql', 'search')}
+                for name, budget in server.budgets().items():
+                    resources[name].update(remaining=budget['remaining'], reset=budget['reset'])
+                return self._respond(200, {'resources': resources, 'rate': resources['core']})
+            budget = self._start('search' if url.path == '/search/issues' else 'core')
+            if budget is None:
+                return
+            with server.stats.lock:
+                server.stats.rest_reads += 1
+            query = parse_qs(url.query)
+
+            if url.path == '/search/issues':
+                return self._search(query, budget)
+
+            match = re.fullmatch(r'/(orgs|users)/([^/]+)(/repos)?', url.path)
+            if match:
+                owner = match.group(2)
+                if match.group(3) is None:
+                    return self._json_get({'login': owner, 'type': 'Organization',
+                                           'url': f'{server.base_url}/orgs/{owner}'}, budget)
+                return self._page([_repo_json(server, r) for r in server.repos
+                                   if r.full_name.split('/')[0] == owner], query, budget)
+
+            repo, base, path = self._repo()
+            if repo is None:
+                return self._respond(404, {'message': 'Not Found'}, budget=budget)
+            repo_json = _repo_json(server, repo)
+
+            with server.lock:
+                if path == '':
+                    return self._json_get(repo_json, budget)
+                if path in ('/pulls', '/issues'):
+                    items = repo.open_items(is_pr=True if path == '/pulls' else None)
+                    if query.get('labels'):
+                        wanted = set(query['labels'][0].split(','))
+                        items = [i for i in items if wanted <= set(i.labels)]
+                    if query.get('since'):
+                        since = datetime.fromisoformat(query['since'][0].replace('Z', '+00:00'))
+                        items = [i for i in items if i.updated_at >= since]
+                    sort = query.get('sort', ['created'])[0]
+                    descending = query.get('direction', ['desc'])[0] == 'desc'
+                    items.sort(key=lambda i: getattr(i, f'{sort}_at'), reverse=descending)
+                    if path == '/pulls':
+                        entries = [_pr_json(base, i, repo_json) for i in items]
+                    else:
+                        entries = [_issue_json(base, i) for i in items]
+                    return self._page(entries, query, budget)
+
+                match = re.fullmatch(r'/git/commits/(\w+)', path)
+                if match:
+                    for item in repo.items.values():
+                        for sha, t in item.commits:
+                            if sha == match.group(1):
+                                commit = _commit_json(base, sha, t)['commit']
+                                return self._json_get(dict(commit, sha=sha), budget)
+                    return self._respond(404, {'message': 'Not Found'}, budget=budget)
+
+                match = re.fullmatch(r'/(pulls|issues)/(\d+)(/\w+)?', path)
+                item = repo.items.get(int(match.group(2))) if match else None
+                if item is None or (match.group(1) == 'pulls' and not item.is_pr):
+                    return self._respond(404, {'message': 'Not Found'}, budget=budget)
+                sub = match.group(3)
+                if sub is None and match.group(1) == 'pulls':
+                    return self._json_get(_pr_json(base, item, repo_json), budget)
+                if sub is None:
+                    return self._json_get(_issue_json(base, item), budget)
+                if sub == '/commits':
+                    return self._page([_commit_json(base, sha, t) for sha, t in item.commits],
+                                      query, budget)
+                if sub == '/comments':
+                    comments = item.comments
+                    if query.get('since'):
+                        since = datetime.fromisoformat(query['since'][0].replace('Z', '+00:00'))
+                        comments = [c for c in comments if c['updated_at'] >= since]
+                    return self._page([_comment_json(base, c) for c in comments], query, budget)
+                if sub == '/timeline':
+                    return self._page(_timeline(base, item), query, budget)
+            return self._respond(404, {'message': 'Not Found'}, budget=budget)
+
+        def do_POST(self):
+            path = urlparse(self.path).path
+            if path == '/graphql':
+                return self._post_graphql()
+            budget = self._start('core')
+            if budget is None:
+                return
+            data = self._body()
+            if self._secondary():
+                return
+            with server.stats.lock:
+                server.stats.rest_writes += 1
+            now = datetime.now(timezone.utc)
+            repo, base, path = self._repo()
+            with server.lock:
+                if repo is not None and path == '/labels':
+                    repo.labels.add(data['name'])
+                    return self._respond(201, _label(base, data['name']), budget=budget)
+                match = re.fullmatch(r'/issues/(\d+)/(labels|comments)', path or '')
+                item = repo.items.get(int(match.group(1))) if match else None
+                if item is None:
+                    return self._respond(404, {'message': 'Not Found'}, budget=budget)
+                if match.group(2) == 'labels':
+                    names = data['labels'] if isinstance(data, dict) else data
+                    for name in names:
+                        repo.labels.add(name)
+                        item.add_label(name, now, BOT)
+                    return self._respond(200, [_label(base, n) for n in item.labels],
+                                         budget=budget)
+                item.add_comment(BOT, data['body'], now)
+                return self._respond(201, _comment_json(base, item.comments[-1]), budget=budget)
+
+        def do_PATCH(self):
+            budget = self._start('core')
+            if budget is None:
+                return
+            data = self._body()
+            if self._secondary():
+                return
+            with server.stats.lock:
+                server.stats.rest_writes += 1
+            repo, base, path = self._repo()
+            match = re.fullmatch(r'/issues/(\d+)', path or '')
+            with server.lock:
+                item = repo.items.get(int(match.group(1))) if match else None
+                if item is None:
+                    return self._respond(404, {'message': 'Not Found'}, budget=budget)
+                if data.get('state') == 'closed' and item.state != 'closed':
+                    item.state = 'closed'
+                    item.add_event('closed', datetime.now(timezone.utc), BOT)
+                return self._respond(200, _issue_json(base, item), budget=budget)
+
+        def do_DELETE(self):
+            budget = self._start('core')
+            if budget is None:
+                return
+            if self._secondary():
+                return
+            with server.stats.lock:
+                server.stats.rest_writes += 1
+            repo, base, path = self._repo()
+            match = re.fullmatch(r'/issues/(\d+)/labels/(.+)', path or '')
+            with server.lock:
+                item = repo.items.get(int(match.group(1))) if match else None
+                name = unquote(match.group(2)) if match else None
+                if item is None or name not in item.labels:
+                    return self._respond(404, {'message': 'Label does not exist'}, budget=budget)
+                item.remove_label(name, datetime.now(timezone.utc), BOT)
+                return self._respond(200, [], budget=budget)
+
+        def _post_graphql(self):
+            budget = self._start('graphql')
+            if budget is None:
+                return
+            data = self._body()
+            is_mutation = data['query'].lstrip().startswith('mutation')
+            if is_mutation and self._secondary():
+                return
+            with server.lock:
+                response, is_mutation = _graphql(server, data)
+            with server.stats.lock:
+                if is_mutation:
+                    server.stats.graphql_mutations += 1
+                else:
+                    server.stats.graphql_queries += 1
+            self._respond(200, response, budget=budget, resource='graphql')
+
+    return Handler
@@ -0,0 +1,147 @@
+"""Measure the CPU time and memory each issue or PR costs the stalebot, without requests.
+
+Usage::
+
+    python benchmarks/micro_benchmarks.py [--size 10000] [--repeat 3] [--json results.json]
+
+A synthetic repository of ``--size`` open issues and PRs (see
+`fake_github.FakeRepo.synthetic`) is turned into the GraphQL nodes the
+``graphql`` fetch engine receives, up front. Then each stage is timed on all
+of them, best of ``--repeat``:
+
+``facts``
+    Turning nodes into `~stale_fetch.PullRequestFacts` and
+    `~stale_fetch.IssueFacts`: labels, times of commits, comments and
+    stale label events.
+
+``decide``
+    Deciding on every item with `~stale_pull_requests.plan_one_pr` and
+    `~stale_issues.plan_one_issue`, including the text of the warnings,
+    with their log lines thrown away.
+
+The memory all facts take while held at once, as the plan is, is measured
+with tracemalloc. Results are per item, so runs of different sizes compare.
+
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from functools import partial
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from github import Github  # noqa: E402
+
+import stale_fetch  # noqa: E402
+import stale_issues  # noqa: E402
+import stale_pull_requests  # noqa: E402
+from fake_github import FakeRepo, _gql_node  # noqa: E402
+
+STALE_LABEL = 'Close?'
+KEEP_OPEN_LABEL = 'keep-open'
+
+# A fixed time, so that every run decides the same.
+NOW = datetime(2024, 6, 1, tzinfo=timezone.utc)
+
+
+def make_nodes(size, seed=0):
+    """GraphQL nodes of the open PRs, with their head commit as listed, and of the open
+    issues labeled as stale."""
+    repo = FakeRepo.synthetic(size, seed=seed, now=NOW)
+    pulls = [_gql_node(item, 1) for item in repo.open_items(is_pr=True)]
+    issues = [_gql_node(item, 1) for item in repo.open_items(is_pr=False)
+              if STALE_LABEL in item.labels]
+    return pulls, issues
+
+
+def make_facts(pulls, issues, lazy_repo):
+    is_issue_warning = partial(stale_issues.is_close_warning, stale_label=STALE_LABEL)
+    return ([stale_fetch._pull_request_facts(node, lazy_repo, STALE_LABEL,
+                                             stale_pull_requests.is_close_warning)
+             for node in pulls],
+            [stale_fetch._issue_facts(node, lazy_repo, STALE_LABEL, is_issue_warning)
+             for node in issues])
+
+
+def decide(pr_facts, issue_facts):
+    now = NOW.timestamp()
+    actions = []
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        for facts in pr_facts:
+            stale_pull_requests.plan_one_pr(facts, now, 12960000, 2592000, actions,
+                                            stale_label=STALE_LABEL,
+                                            keep_open_label=KEEP_OPEN_LABEL)
+        for facts in issue_facts:
+            stale_issues.plan_one_issue(facts, now, 0, 604800, actions,
+                                        stale_label=STALE_LABEL,
+                                        keep_open_label=KEEP_OPEN_LABEL)
+    return actions
+
+
+def best_of(repeat, func, *args):
+    """Fastest of ``repeat`` calls in seconds, and what the last one returned."""
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def run_micro_benchmarks(size=10000, repeat=3, seed=0):
+    """Run the stages on a repository of ``size`` items. Returns a dict of results."""
+    pulls, issues = make_nodes(size, seed=seed)
+    n_items = len(pulls) + len(issues)
+    lazy_repo = Github().withLazy(True).get_repo('astropy/astropy')
+
+    facts_seconds, (pr_facts, issue_facts) = best_of(
+        repeat, make_facts, pulls, issues, lazy_repo)
+    decide_seconds, actions = best_of(repeat, decide, pr_facts, issue_facts)
+
+    del pr_facts, issue_facts
+    gc.collect()
+    tracemalloc.start()
+    held = make_facts(pulls, issues, lazy_repo)
+    facts_bytes, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del held
+
+    return {'items': n_items, 'pulls': len(pulls), 'issues': len(issues),
+            'actions': len(actions),
+            'facts_us_per_item': round(facts_seconds / n_items * 1e6, 1),
+            'decide_us_per_item': round(decide_seconds / n_items * 1e6, 1),
+            'facts_bytes_per_item': round(facts_bytes / n_items)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', type=int, default=10000,
+                        help='Open issues and PRs in the repository (default: 10000)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per stage (default: 3)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', default='', help='Also write the results to this file')
+    args = parser.parse_args(argv)
+
+    results = run_micro_benchmarks(size=args.size, repeat=args.repeat, seed=args.seed)
+    print(f'{results["items"]} items checked ({results["pulls"]} PRs, '
+          f'{results["issues"]} stale issues), {results["actions"]} actions planned')
+    print(f'| stage | per item |\n|---|---|\n'
+          f'| facts | {results["facts_us_per_item"]} us |\n'
+          f'| decide | {results["decide_us_per_item"]} us |\n'
+          f'| facts memory | {results["facts_bytes_per_item"]} bytes |')
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as fout:
+            json.dump(results, fout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
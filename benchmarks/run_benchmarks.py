@@ -0,0 +1,146 @@
+"""Run the stalebot end to end against a local fake GitHub API and time it.
+
+Usage::
+
+    python benchmarks/run_benchmarks.py [--sizes 100 1000 10000] [--engine rest graphql async]
+                                        [--workers 1 8] [--latency-ms 50] [--rate-limit 5000]
+                                        [--reset-seconds 3600] [--secondary-every 0]
+                                        [--apply] [--incremental] [--json results.json]
+
+Each size gets a fresh synthetic repository with that many open issues and
+PRs, see `fake_github.FakeRepo.synthetic`. Both passes run on it like
+``stalebot.py`` would, with no limit on how many items are checked, and the
+table printed at the end tells for each run the wall time, how many requests
+it took per item checked, and how many bytes went each way. Nothing needs
+network access.
+
+Runs are dry runs unless ``--apply`` is given. With ``--incremental``, every
+run is followed by a second one on the same repository with the state file
+from the first, which is what scheduled runs look like most of the time.
+
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import stale_issues  # noqa: E402
+import stale_pull_requests  # noqa: E402
+from fake_github import FakeGitHub, FakeRepo  # noqa: E402
+from stale_http import github_client  # noqa: E402
+from stale_scheduler import RateLimitScheduler  # noqa: E402
+
+COLUMNS = ('size', 'engine', 'workers', 'run', 'seconds', 'requests', 'per_item',
+           'kb_down', 'kb_up', 'not_modified', 'rate_limited', 'writes')
+
+
+def run_once(server, engine, workers, is_dryrun, state_dir):
+    """Run both passes once on what ``server`` serves. Returns the counters of the run."""
+    os.environ['GITHUB_API_URL'] = server.base_url
+    os.environ.setdefault('GITHUB_TOKEN', 'fake')
+    server.stats.reset()
+    scheduler = RateLimitScheduler(max_concurrency=workers, min_write_interval=0)
+    g = github_client(pool_size=workers, scheduler=scheduler)
+    common = dict(is_dryrun=is_dryrun, fetch_engine=engine, workers=workers, g=g)
+    n_items = len(server.repo.open_items())
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        stale_pull_requests.process_pull_requests(
+            server.repo.full_name, warn_seconds=12960000, close_seconds=2592000, max_prs=-1,
+            state_file=os.path.join(state_dir, 'pulls.json'), **common)
+        stale_issues.process_issues(
+            server.repo.full_name, warn_seconds=86400, close_seconds=604800, max_issues=-1,
+            state_file=os.path.join(state_dir, 'issues.json'), **common)
+    seconds = time.perf_counter() - start
+    g.close()
+
+    stats = server.stats
+    return {'seconds': round(seconds, 2), 'requests': stats.requests,
+            'per_item': round(stats.requests / max(1, n_items), 3),
+            'kb_down': round(stats.bytes_out / 1024, 1), 'kb_up': round(stats.bytes_in / 1024, 1),
+            'not_modified': stats.not_modified, 'rate_limited': stats.rate_limited,
+            'writes': stats.rest_writes + stats.graphql_mutations}
+
+
+def run_benchmarks(sizes=(100, 1000), engines=('graphql', 'rest'), workers=(1,), latency=0,
+                   rate_limit=5000, reset_seconds=3600, secondary_every=0, is_dryrun=True,
+                   incremental=False, seed=0):
+    """Run every combination of the given settings. Returns one row per run."""
+    rows = []
+    for size in sizes:
+        for engine in engines:
+            for n_workers in workers:
+                # Fresh repository each time, so that applied runs start equal.
+                repo = FakeRepo.synthetic(size, seed=seed)
+                server = FakeGitHub(repo, latency=latency, rate_limit=rate_limit,
+                                    reset_seconds=reset_seconds,
+                                    secondary_every=secondary_every).start()
+                try:
+                    with tempfile.TemporaryDirectory() as state_dir:
+                        runs = ('first', 'incremental') if incremental else ('first',)
+                        for run in runs:
+                            row = {'size': size, 'engine': engine, 'workers': n_workers,
+                                   'run': run}
+                            row.update(run_once(server, engine, n_workers, is_dryrun, state_dir))
+                            rows.append(row)
+                            print(_format_row(row), file=sys.stderr)
+                finally:
+                    server.stop()
+    return rows
+
+
+def _format_row(row):
+    return '| ' + ' | '.join(str(row[c]) for c in COLUMNS) + ' |'
+
+
+def markdown_table(rows):
+    lines = ['| ' + ' | '.join(COLUMNS) + ' |', '|' + '---|' * len(COLUMNS)]
+    return '\n'.join(lines + [_format_row(row) for row in rows])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000],
+                        help='Open issues and PRs per repository (default: 100 1000)')
+    parser.add_argument('--engine', nargs='+', default=['graphql', 'rest'],
+                        choices=['graphql', 'rest', 'async'], help='Fetch engines to compare')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1],
+                        help='Values of STALEBOT_WORKERS to compare')
+    parser.add_argument('--latency-ms', type=float, default=0,
+                        help='Added to every response of the fake API')
+    parser.add_argument('--rate-limit', type=int, default=5000,
+                        help='Requests allowed per window for REST and GraphQL each')
+    parser.add_argument('--reset-seconds', type=float, default=3600,
+                        help='Length of a rate limit window')
+    parser.add_argument('--secondary-every', type=int, default=0,
+                        help='Reject every this many writes with a secondary rate limit')
+    parser.add_argument('--apply', action='store_true',
+                        help='Apply the changes instead of a dry run')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Follow each run by a second one with its state file')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', default='', help='Also write the results to this file')
+    args = parser.parse_args(argv)
+
+    rows = run_benchmarks(
+        sizes=args.sizes, engines=args.engine, workers=args.workers,
+        latency=args.latency_ms / 1000, rate_limit=args.rate_limit,
+        reset_seconds=args.reset_seconds,
+        secondary_every=args.secondary_every, is_dryrun=not args.apply,
+        incremental=args.incremental, seed=args.seed)
+    print(markdown_table(rows))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as fout:
+            json.dump(rows, fout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,342 @@
+"""Talk to the GitHub REST API with asyncio, for the ``async`` fetch engine.
+
+PyGithub is synchronous, and completes objects lazily with requests of its
+own, so what a check costs depends on which attributes it happens to read.
+`AsyncGitHub` only sends the requests it is asked for, 100 items per page,
+over keep-alive connections, HTTP/2 if the ``h2`` package is installed. Once
+the first page of a list tells how many there are, the other pages are
+fetched at the same time, or, for lists read newest first, one at a time
+back from the last, only as far as needed.
+
+Requests are still paced by the `~stale_scheduler.RateLimitScheduler`,
+revalidated against the `~stale_http.ResponseCache` and recorded by the
+`~stale_telemetry.Telemetry` of the session PyGithub uses, see
+:func:`stale_http.shared_session`.
+
+httpx is only needed for this engine.
+
+"""
+import asyncio
+import contextlib
+import contextvars
+import json
+import os
+import queue
+import re
+import threading
+import time
+from collections import deque
+from urllib.parse import urlencode
+
+from github import GithubException, UnknownObjectException
+
+try:
+    import httpx
+except ImportError:  # Only needed with STALEBOT_FETCH_ENGINE=async
+    httpx = None
+
+try:
+    import h2  # noqa: F401
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+from stale_http import shared_session
+from stale_scheduler import resource_of
+
+PER_PAGE = 100
+
+# Server errors worth sending a read again for, like the PyGithub session does.
+_RETRY_STATUSES = (500, 502, 503, 504)
+_SERVER_ERROR_RETRIES = 3
+
+_LAST_PAGE = re.compile(r'<[^>]*[?&]page=(\d+)[^>]*>;\s*rel="last"')
+
+
+def _last_page(headers):
+    match = _LAST_PAGE.search(headers.get('Link', ''))
+    return int(match.group(1)) if match else None
+
+
+class AsyncGitHub:
+    """Asynchronous client for the reads of the GitHub REST API the bot makes.
+
+    Use it as an async context manager, from a single event loop.
+
+    Parameters
+    ----------
+    session : `stale_http.StalebotSession` or `None`
+        Session to share the cache, scheduler and telemetry of.
+        By default, the one installed for PyGithub, if any.
+
+    max_connections : int
+        Most connections kept open. With HTTP/2, one is usually enough.
+
+    """
+    def __init__(self, session=None, max_connections=10):
+        if httpx is None:
+            raise ImportError('The async fetch engine needs httpx: pip install "httpx[http2]"')
+        if session is None:
+            session = shared_session()
+        self.cache = getattr(session, 'cache', None)
+        self.scheduler = getattr(session, 'scheduler', None)
+        self.telemetry = getattr(session, 'telemetry', None)
+        self.base_url = os.environ.get('GITHUB_API_URL', 'https://api.github.com').rstrip('/')
+        self._max_connections = max_connections
+        self._client = None
+
+    async def __aenter__(self):
+        headers = {'Accept': 'application/vnd.github+json',
+                   'User-Agent': 'astropy-stalebot'}
+        token = os.environ.get('GITHUB_TOKEN')
+        if token:
+            headers['Authorization'] = f'token {token}'
+        self._client = httpx.AsyncClient(
+            headers=headers, http2=HTTP2, timeout=httpx.Timeout(30),
+            limits=httpx.Limits(max_connections=self._max_connections,
+                                max_keepalive_connections=self._max_connections))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._client.aclose()
+
+    def _url(self, path, params=None):
+        url = path if path.startswith('http') else f'{self.base_url}{path}'
+        return f'{url}?{urlencode(params)}' if params else url
+
+    async def _send(self, url, headers, item):
+        resource = resource_of(url)
+        for attempt in range(max(_SERVER_ERROR_RETRIES, getattr(
+                self.scheduler, 'max_retries', 0)) + 1):
+            if self.scheduler is not None:
+                # The scheduler blocks, so wait for it in a thread of its own.
+                await asyncio.to_thread(self.scheduler.acquire, resource, False)
+            start = time.perf_counter()
+            response = None
+            retry = False
+            try:
+                response = await self._client.get(url, headers=headers)
+            finally:
+                if self.telemetry is not None:
+                    self.telemetry.record('GET', url, b'', response,
+                                          time.perf_counter() - start, resource, item=item)
+                if self.scheduler is not None:
+                    retry = self.scheduler.release(resource, False, response)
+            if retry:
+                print(f'Rate limited on GET {url}, waiting before trying again')
+            elif response.status_code in _RETRY_STATUSES and attempt < _SERVER_ERROR_RETRIES:
+                await asyncio.sleep(2 ** attempt)
+            else:
+                return response
+        return response
+
+    async def get(self, path, params=None, item=None, missing_ok=False):
+        """GET a resource. Returns its headers and decoded body.
+
+        Parameters
+        ----------
+        path : str
+            Path under the API URL, like ``/repos/astropy/astropy/pulls``, or a full URL.
+
+        params : dict or `None`
+            Query parameters.
+
+        item : tuple or `None`
+            ``(section, repository, number)`` to charge the request to in the telemetry.
+
+        missing_ok : bool
+            Return `None` as the body instead of raising if there is no such
+            thing (404), or it cannot be looked up (422).
+
+        """
+        url = self._url(path, params)
+        headers = {}
+        entry = self.cache.get(url) if self.cache is not None else None
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        response = await self._send(url, headers, item)
+
+        if self.cache is not None:
+            if response.status_code == 304 and entry is not None:
+                self.cache.count(hit=True)
+                return httpx.Headers(entry['headers']), json.loads(entry['body'])
+            self.cache.count(hit=False)
+            if response.status_code == 200:
+                self.cache.put(url, None, response)
+        if response.status_code in (404, 422) and missing_ok:
+            return response.headers, None
+        if response.status_code >= 400:
+            try:
+                data = response.json()
+            except ValueError:
+                data = {'message': response.text}
+            cls = UnknownObjectException if response.status_code == 404 else GithubException
+            raise cls(response.status_code, data, dict(response.headers))
+        return response.headers, response.json()
+
+    async def pages(self, path, params=None, item=None, ahead=None):
+        """Yield the pages of a list, in order.
+
+        After the first page, up to ``ahead`` more are fetched at the same
+        time, or all of them if `None`.
+
+        """
+        params = dict(params or {}, per_page=PER_PAGE)
+        headers, first = await self.get(path, params, item=item)
+        yield first
+        last = _last_page(headers)
+        if last is None:
+            return
+        ahead = last - 1 if ahead is None else max(1, ahead)
+        pending = deque()
+        next_page = 2
+        try:
+            while next_page <= last or pending:
+                while next_page <= last and len(pending) < ahead:
+                    pending.append(asyncio.ensure_future(
+                        self.get(path, dict(params, page=next_page), item=item)))
+                    next_page += 1
+                _, data = await pending.popleft()
+                yield data
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def list_all(self, path, params=None, item=None):
+        """All the elements of a list, fetching every page after the first at once."""
+        out = []
+        async for page in self.pages(path, params, item=item):
+            out.extend(page)
+        return out
+
+    def newest_first(self, path, params=None, item=None, convert=None):
+        """The elements of a list, oldest first on GitHub, read newest first.
+
+        Returns a `NewestFirst`, which fetches pages only as far back as asked.
+        ``convert``, if given, is applied to each element.
+
+        """
+        return NewestFirst(self, path, params, item=item, convert=convert)
+
+
+class NewestFirst:
+    """The elements of a list, newest first, fetched a page at a time.
+
+    The first page settles short lists. Longer ones are walked back from
+    the last page, so that stopping early skips the oldest pages, like
+    ``_newest_first`` in stale_fetch.py does with PyGithub.
+
+    """
+    def __init__(self, client, path, params=None, item=None, convert=None):
+        self._client = client
+        self._path = path
+        self._params = dict(params or {}, per_page=PER_PAGE)
+        self._item = item
+        self._convert = convert or (lambda element: element)
+        self._first = None
+        self._next_page = None
+        self.seen = []
+        self.complete = False
+
+    async def _fetch_page(self):
+        if self._first is None:
+            headers, self._first = await self._client.get(self._path, self._params,
+                                                          item=self._item)
+            self._next_page = _last_page(headers) or 1
+        if self._next_page > 1:
+            _, page = await self._client.get(self._path, dict(self._params, page=self._next_page),
+                                             item=self._item)
+            self._next_page -= 1
+        else:
+            page = self._first
+            self.complete = True
+        self.seen.extend(self._convert(element) for element in reversed(page))
+
+    async def until(self, stop=None):
+        """Fetch pages until an element ``stop`` is true for is seen, or all of them.
+
+        Returns the elements seen so far, newest first.
+
+        """
+        while not self.complete and (stop is None or not any(map(stop, self.seen))):
+            await self._fetch_page()
+        return self.seen
+
+
+_DONE = object()
+
+
+def in_background(list_items, fetch_one, ahead=2):
+    """Fetch items on an event loop in a background thread, and yield them in order.
+
+    Parameters
+    ----------
+    list_items : callable
+        Called with an `AsyncGitHub`, returns an async generator of things to fetch.
+
+    fetch_one : callable
+        Coroutine function called with the `AsyncGitHub` and one of those.
+        Whatever it returns is yielded, unless `None`.
+
+    ahead : int
+        Most items fetched at the same time, ahead of those yielded.
+
+    """
+    results = queue.Queue(maxsize=1)
+    stop = threading.Event()
+
+    def put(value):
+        # Give up once nobody is waiting for results anymore.
+        while not stop.is_set():
+            try:
+                results.put(value, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    async def deliver(task):
+        value = await task
+        if value is not None:
+            await asyncio.to_thread(put, (value, None))
+
+    async def produce():
+        pending = deque()
+        try:
+            async with AsyncGitHub() as client:
+                try:
+                    async with contextlib.aclosing(list_items(client)) as things:
+                        async for thing in things:
+                            if stop.is_set():
+                                break
+                            pending.append(asyncio.ensure_future(fetch_one(client, thing)))
+                            while len(pending) >= ahead and not stop.is_set():
+                                await deliver(pending.popleft())
+                    while pending and not stop.is_set():
+                        await deliver(pending.popleft())
+                finally:
+                    for task in pending:
+                        task.cancel()
+                    await asyncio.gather(*pending, return_exceptions=True)
+        except Exception as e:
+            put((None, e))
+        else:
+            put((_DONE, None))
+
+    # Context variables, like the tenant being checked, carry over to the loop.
+    thread = threading.Thread(target=contextvars.copy_context().run,
+                              args=(asyncio.run, produce()), daemon=True)
+    thread.start()
+    try:
+        while True:
+            value, error = results.get()
+            if error is not None:
+                raise error
+            if value is _DONE:
+                return
+            yield value
+    finally:
+        stop.set()
+        thread.join()
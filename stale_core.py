@@ -0,0 +1,114 @@
+"""What the issue and pull request checks share, done once and cheaply.
+
+Every item a run checks goes through the same few steps: times read from
+GitHub, labels looked up, comments filled in from a template. With
+thousands of items these add up, so they are kept here in one place:
+
+* `parse_time` reads the ISO 8601 times GitHub writes with the standard
+  library, and only falls back to dateutil's general parser for others.
+  Callers only parse the times of entries that pass their other checks.
+* `Template` holds a comment template, parsed once at import, so that
+  filling it in for each item only joins the pieces.
+* `common_options` reads the settings both ``stale_issues.py`` and
+  ``stale_pull_requests.py`` take.
+
+"""
+import functools
+import os
+import string
+from datetime import datetime
+
+import dateutil.parser
+from humanize import naturaldelta
+
+
+def parse_time(value):
+    """Datetime of an ISO 8601 time like ``2024-01-02T03:04:05Z``, `None` if empty."""
+    if not value:
+        return None
+    try:
+        # Python < 3.11 does not take the Z suffix GitHub uses.
+        return datetime.fromisoformat(value[:-1] + '+00:00' if value[-1] == 'Z' else value)
+    except ValueError:
+        return dateutil.parser.parse(value)
+
+
+# Copied over from baldrick
+def unwrap(text):
+    """Given text that has been wrapped, unwrap it but preserve paragraph breaks."""
+
+    # Split into lines and get rid of newlines and leading/trailing spaces
+    lines = [line.strip() for line in text.splitlines()]
+
+    # Join back with predictable newline character
+    text = os.linesep.join(lines)
+
+    # Replace cases where there are more than two successive line breaks
+    while 3 * os.linesep in text:
+        text = text.replace(3 * os.linesep, 2 * os.linesep)
+
+    # Split based on multiple newlines
+    paragraphs = text.split(2 * os.linesep)
+
+    # Join each paragraph using spaces instead of newlines
+    paragraphs = [paragraph.replace(os.linesep, ' ') for paragraph in paragraphs]
+
+    # Join paragraphs together
+    return (2 * os.linesep).join(paragraphs)
+
+
+class Template(str):
+    """A comment template for `str.format`, parsed once.
+
+    `substitute` gives the same text as ``format``, without parsing the
+    template again. Only named fields are supported, without conversions.
+
+    """
+    def __new__(cls, text):
+        self = super().__new__(cls, text)
+        self._parts = []
+        for literal, name, spec, conversion in string.Formatter().parse(text):
+            if conversion is not None or name == '' or name is not None and not name.isidentifier():
+                raise ValueError(f'Unsupported field {{{name}}} in template')
+            self._parts.append((literal, name, spec))
+        return self
+
+    def substitute(self, **fields):
+        return ''.join(literal if name is None else literal + format(fields[name], spec)
+                       for literal, name, spec in self._parts)
+
+
+# For delays that stay the same for a whole run, like ``close_seconds``.
+cached_naturaldelta = functools.lru_cache(maxsize=64)(naturaldelta)
+
+
+def common_options(environ=None):
+    """Keyword arguments that both ``process_issues`` and ``process_pull_requests`` take,
+    from ``STALEBOT_*`` variables.
+
+    They are read from ``environ`` if given, else from the environment.
+
+    """
+    if environ is None:
+        environ = os.environ
+    return dict(
+        is_dryrun=int(environ.get('STALEBOT_DRYRUN', '0')) == 1,
+        stale_label=environ.get('STALEBOT_STALE_LABEL', 'Close?'),
+        keep_open_label=environ.get('STALEBOT_KEEP_OPEN_LABEL', 'keep-open'),
+        closed_by_bot_label=environ.get('STALEBOT_CLOSED_BY_BOT_LABEL', 'closed-by-bot'),
+        sleep=float(environ.get('STALEBOT_SLEEP', '0')),
+        fetch_engine=environ.get('STALEBOT_FETCH_ENGINE', 'graphql'),
+        page_size=int(environ.get('STALEBOT_GRAPHQL_PAGE_SIZE', '25')),
+        workers=int(environ.get('STALEBOT_WORKERS', '1')),
+        cache_dir=environ.get('STALEBOT_CACHE_DIR', ''),
+        cache_max_mb=float(environ.get('STALEBOT_CACHE_MAX_MB', '100')),
+        state_file=environ.get('STALEBOT_STATE_FILE', ''),
+        plan_file=environ.get('STALEBOT_PLAN_FILE', ''),
+        snapshot_file=environ.get('STALEBOT_SNAPSHOT_FILE', ''),
+        batch_size=int(environ.get('STALEBOT_MUTATION_BATCH_SIZE', '20')),
+        history_days=float(environ.get('STALEBOT_HISTORY_DAYS', '0')),
+        report_file=environ.get('STALEBOT_REPORT_FILE', ''),
+        full_scan=int(environ.get('STALEBOT_FULL_SCAN', '0')) == 1,
+        shard_index=int(environ.get('STALEBOT_SHARD_INDEX', '0')),
+        shard_count=int(environ.get('STALEBOT_SHARD_COUNT', '1')),
+        order=environ.get('STALEBOT_ORDER', 'urgency'))
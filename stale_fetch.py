@@ -0,0 +1,1217 @@
+"""Fetch what the stale checks need to know about issues and pull requests.
+
+There are two ways to get there:
+
+* REST: wrap a PyGithub object and fetch commits, comments and timeline
+  lazily, one paginated call each, only when the decision logic asks.
+  Comments and timeline are read newest first, and only until the latest
+  warning or stale label event is found.
+* GraphQL: fetch labels, commits, bot comments and stale label events for a
+  whole page of items in a single query.
+* async: fetch the same as REST, but with explicit requests on an event loop,
+  all pages of a list at once and several items at the same time, see
+  ``stale_async.py``.
+
+Either way, the last commit of a PR is taken from its head commit, unless
+the branch was force pushed well after that commit was made. Only then are
+all its commits looked at.
+
+With REST and async, the newest comment on a stale item is read first. If
+it is a close warning with a marker (see ``stale_markers.py``) and nothing
+happened since, the rest comes from the marker, without the timeline.
+
+The decision logic in ``stale_pull_requests.py`` and ``stale_issues.py``
+only sees the records defined here.
+
+"""
+import asyncio
+import hashlib
+from datetime import timedelta, timezone
+from functools import cached_property
+
+from github import GithubException, UnknownObjectException
+
+from stale_async import in_background
+from stale_core import parse_time
+from stale_markers import trusted_marker
+from stale_priority import Listed
+
+# Comments from these accounts are considered to be from the bot.
+BOT_LOGINS = ('github-actions[bot]', 'astropy-bot[bot]', 'pllim')
+
+# A force push this long after the head commit was made, like a reset to older
+# commits, means the head commit may not be the latest one.
+FORCE_PUSH_SLACK = timedelta(days=1)
+
+
+class IssueFacts:
+    """What the stale check knows about one issue.
+
+    Attributes
+    ----------
+    number : int
+        Issue number.
+
+    labels : list of str
+        Names of all the labels currently applied.
+
+    is_pull_request : bool
+        Whether this is really a pull request.
+
+    warnings : list of datetime
+        Creation times of close warnings left by the bot since the stale
+        label was last added. May only hold the most recent one.
+
+    stale_labeled : list of tuple
+        ``(datetime, login)`` for every time the stale label was added.
+        May only hold the most recent one.
+
+    issue : obj
+        PyGithub Issue instance used to apply changes.
+
+    updated_at : datetime or `None`
+        When the issue was last updated.
+
+    """
+    __slots__ = ('number', 'labels', 'is_pull_request', 'warnings', 'stale_labeled', 'issue',
+                 'updated_at')
+
+    def __init__(self, number, labels, is_pull_request=False, warnings=(),
+                 stale_labeled=(), issue=None, updated_at=None):
+        self.number = number
+        self.labels = labels
+        self.is_pull_request = is_pull_request
+        self.warnings = list(warnings)
+        self.stale_labeled = list(stale_labeled)
+        self.issue = issue
+        self.updated_at = updated_at
+
+
+class PullRequestFacts:
+    """What the stale check knows about one pull request.
+
+    Attributes
+    ----------
+    number : int
+        Pull request number.
+
+    labels : list of str
+        Names of all the labels currently applied.
+
+    last_committed : datetime or `None`
+        Committer date of the most recent commit.
+        Taken from the head commit when it can be trusted.
+
+    warnings : list of datetime
+        Creation times of close warnings left by the bot since the stale
+        label was last added or, if not labeled, since the last commit.
+        May only hold the most recent one.
+
+    stale_labeled : list of tuple
+        ``(datetime, login)`` for every time the stale label was added.
+        May only hold the most recent one.
+
+    issue : obj
+        PyGithub Issue instance used to apply changes.
+
+    updated_at : datetime or `None`
+        When the pull request was last updated.
+
+    """
+    __slots__ = ('number', 'labels', 'last_committed', 'warnings', 'stale_labeled', 'issue',
+                 'updated_at')
+
+    def __init__(self, number, labels, last_committed=None, warnings=(),
+                 stale_labeled=(), issue=None, updated_at=None):
+        self.number = number
+        self.labels = labels
+        self.last_committed = last_committed
+        self.warnings = list(warnings)
+        self.stale_labeled = list(stale_labeled)
+        self.issue = issue
+        self.updated_at = updated_at
+
+
+def fetched(facts):
+    """What is already known about an item, by attribute name, without fetching more.
+
+    Works for all the facts records, whether they keep their attributes in
+    slots or, for those fetched on first access, in their ``__dict__``.
+
+    """
+    known = {}
+    for cls in type(facts).__mro__:
+        for name in cls.__dict__.get('__slots__', ()):
+            try:
+                known[name] = cls.__dict__[name].__get__(facts, cls)
+            except AttributeError:  # Not set
+                pass
+    known.update(getattr(facts, '__dict__', {}))
+    return known
+
+
+def _newest_first(paginated, per_page):
+    """Iterate a REST `PaginatedList` newest first.
+
+    The first page alone settles short lists. Longer ones are walked back
+    from the last page, so that stopping early skips the oldest pages.
+
+    """
+    first = paginated.get_page(0)
+    if len(first) < per_page:
+        yield from reversed(first)
+    else:
+        yield from paginated.reversed
+
+
+def _rest_login(user):
+    return user['login'] if user else 'ghost'  # Deleted account
+
+
+def _labeled_at_horizon(horizon):
+    """When a stale label not added since ``horizon`` counts as added, if there is one.
+
+    History before the horizon is not looked at, so the label was added at
+    the latest then, by someone unknown.
+
+    """
+    return [] if horizon is None else [(horizon, 'unknown')]
+
+
+def _stale_labeled_from_timeline(timeline, stale_label, horizon=None):
+    """Only the most recent time the stale label was added, if any.
+
+    ``timeline`` holds REST timeline events as dicts, newest first. Only
+    called for items labeled as stale.
+
+    """
+    for event in timeline:
+        # Some events, like commits, have no creation time of their own.
+        created_at = event.get('created_at')
+        if created_at is None:
+            continue
+        if horizon is not None and parse_time(created_at) < horizon:
+            break
+        if event['event'] == 'labeled' and event['label']['name'] == stale_label:
+            return [(parse_time(created_at), _rest_login(event.get('actor')))]
+    return _labeled_at_horizon(horizon)
+
+
+def _head_is_latest(head_committed, last_force_pushed):
+    """Whether the head commit can stand for the most recent commit."""
+    return last_force_pushed is None or last_force_pushed <= head_committed + FORCE_PUSH_SLACK
+
+
+def _force_pushed_after(timeline, after):
+    """Time of the latest force push later than ``after``, if any."""
+    for event in timeline:
+        created_at = event.get('created_at')
+        if created_at is None:
+            continue
+        created_at = parse_time(created_at)
+        if created_at <= after:
+            break
+        if event['event'] == 'head_ref_force_pushed':
+            return created_at
+    return None
+
+
+class _Replay:
+    """Iterate over the same items more than once, fetching them only once."""
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+        self._seen = []
+
+    def __iter__(self):
+        i = 0
+        while True:
+            if i == len(self._seen):
+                try:
+                    self._seen.append(next(self._iterator))
+                except StopIteration:
+                    return
+            yield self._seen[i]
+            i += 1
+
+
+def _warnings_from_comments(comments, is_close_warning, horizon=None, since=None, edited=None):
+    """Only the most recent close warning, if any, updated no earlier than ``since``.
+
+    ``comments`` holds ``(created_at, login, body)``, newest first. They are
+    read until one made before ``since``. Older ones only count if edited
+    since then, like with the ``since`` filter of the REST API and the
+    ``updatedAt`` of GraphQL: ``edited``, if given, is called for those
+    comments, see `_edited_warnings`.
+
+    """
+    for created_at, login, body in comments:
+        if horizon is not None and created_at < horizon:
+            return []
+        if since is not None and created_at < since:
+            break
+        if login in BOT_LOGINS and is_close_warning(body):
+            return [created_at]
+    else:
+        return []
+    return [] if edited is None else _edited_warnings(edited(), is_close_warning, since,
+                                                      horizon=horizon)
+
+
+def _edited_warnings(comments, is_close_warning, since, horizon=None):
+    """Only the most recent close warning made before ``since``, if any.
+
+    ``comments`` holds ``(created_at, login, body)`` of those updated since
+    then, newest first, as the REST API lists them with ``since``.
+
+    """
+    for created_at, login, body in comments:
+        if created_at >= since:
+            continue  # Already seen by _warnings_from_comments.
+        if horizon is not None and created_at < horizon:
+            break
+        if login in BOT_LOGINS and is_close_warning(body):
+            return [created_at]
+    return []
+
+
+def _marker_of_newest(comments, is_close_warning, updated_at):
+    """What the bot recorded in the newest comment, if still up to date.
+
+    ``comments`` holds ``(created_at, login, body)``, newest first. Only the
+    first one is looked at: it must be a close warning from the bot with a
+    marker, and the item must not have been updated since.
+
+    """
+    newest = next(iter(comments), None)
+    if newest is None or newest[1] not in BOT_LOGINS or not is_close_warning(newest[2]):
+        return None
+    marker = trusted_marker(newest, updated_at)
+    if marker is None or 'labeled_at' not in marker:
+        return None
+    return marker
+
+
+def _marker_stale_labeled(marker):
+    return [(marker['labeled_at'], marker.get('labeled_by', marker['login']))]
+
+
+def _comment_tuples(comments):
+    # Stay away from raw_data, it would fetch every comment/commit again.
+    for comment in comments:
+        yield comment.created_at, comment.user.login, comment.body
+
+
+def _rest_comments(issue, since=None):
+    """``(created_at, login, body)`` of the comments on a PyGithub Issue, newest first.
+
+    With ``since``, only those updated since then.
+
+    """
+    comments = issue.get_comments() if since is None else issue.get_comments(since=since)
+    return _comment_tuples(_newest_first(comments, issue.requester.per_page))
+
+
+def _event_dicts(timeline):
+    for event in timeline:
+        yield event.raw_data
+
+
+class RestIssueFacts(IssueFacts):
+    """`IssueFacts` backed by a PyGithub Issue, fetched on first access.
+
+    Comments are read newest first, back to the time the stale label was last
+    added, or only the newest one if it has a marker saying when that was.
+    Nothing older than ``horizon`` (a datetime), if given, is looked at.
+
+    """
+    def __init__(self, issue, stale_label, is_close_warning, horizon=None):
+        self.issue = issue
+        self.number = issue.number
+        self.labels = [lbl.name for lbl in issue.labels]
+        self.is_pull_request = issue.pull_request is not None
+        self.updated_at = issue.updated_at
+        self._stale_label = stale_label
+        self._is_close_warning = is_close_warning
+        self._horizon = horizon
+
+    @cached_property
+    def _comments(self):
+        # Shared by the marker and warning lookups.
+        return _Replay(_rest_comments(self.issue))
+
+    @cached_property
+    def _marker(self):
+        return _marker_of_newest(self._comments, self._is_close_warning, self.updated_at)
+
+    @cached_property
+    def stale_labeled(self):
+        if self._stale_label not in self.labels:
+            return []
+        if self._marker is not None:
+            return _marker_stale_labeled(self._marker)
+        return _stale_labeled_from_timeline(
+            _event_dicts(_newest_first(self.issue.get_timeline(), self.issue.requester.per_page)),
+            self._stale_label, horizon=self._horizon)
+
+    @cached_property
+    def warnings(self):
+        if self._marker is not None:
+            return [self._marker['created_at']]
+        last_labeled = max((t for t, _ in self.stale_labeled), default=None)
+        return _warnings_from_comments(self._comments, self._is_close_warning,
+                                       horizon=self._horizon, since=last_labeled,
+                                       edited=lambda: _rest_comments(self.issue, last_labeled))
+
+
+class RestPullRequestFacts(PullRequestFacts):
+    """`PullRequestFacts` backed by a PyGithub PullRequest, fetched on first access.
+
+    If the PR is labeled as stale and its newest comment is a close warning
+    with a marker, nothing else is fetched. Nothing older than ``horizon``
+    (a datetime), if given, is looked at.
+
+    """
+    def __init__(self, pr, stale_label, is_close_warning, horizon=None):
+        self._pr = pr
+        self.number = pr.number
+        self.labels = [lbl.name for lbl in pr.labels]
+        self.updated_at = pr.updated_at
+        self._stale_label = stale_label
+        self._is_close_warning = is_close_warning
+        self._horizon = horizon
+
+    @cached_property
+    def issue(self):
+        return self._pr.as_issue()  # Some API only available for Issue
+
+    @cached_property
+    def _timeline(self):
+        # Shared by the force push and stale label lookups.
+        return _Replay(_event_dicts(
+            _newest_first(self.issue.get_timeline(), self.issue.requester.per_page)))
+
+    @cached_property
+    def _comments(self):
+        # Shared by the marker and warning lookups.
+        return _Replay(_rest_comments(self.issue))
+
+    @cached_property
+    def _marker(self):
+        if self._stale_label not in self.labels:
+            return None  # Not warned yet, as far as the bot is concerned.
+        marker = _marker_of_newest(self._comments, self._is_close_warning, self.updated_at)
+        if marker is None or 'last_commit' not in marker:
+            return None
+        return marker
+
+    @cached_property
+    def last_committed(self):
+        if self._marker is not None:
+            return self._marker['last_commit']
+        # Head repo is gone if the fork was deleted, but the base repo keeps the commits.
+        repo = self._pr.head.repo or self._pr.base.repo
+        try:
+            head_committed = repo.get_git_commit(self._pr.head.sha).committer.date
+        except GithubException:
+            head_committed = None
+        if head_committed is not None:
+            last_force_pushed = _force_pushed_after(
+                self._timeline, head_committed + FORCE_PUSH_SLACK)
+            if _head_is_latest(head_committed, last_force_pushed):
+                return head_committed
+        dates = [commit.commit.committer.date for commit in self._pr.get_commits()]
+        return max(dates, key=lambda t: t.timestamp(), default=None)
+
+    @cached_property
+    def warnings(self):
+        if self._marker is not None:
+            return [self._marker['created_at']]
+        since = _warnings_since(self.labels, self._stale_label, self.stale_labeled,
+                                self.last_committed)
+        if self._stale_label in self.labels:
+            # Already read from the newest.
+            return _warnings_from_comments(
+                self._comments, self._is_close_warning, horizon=self._horizon, since=since,
+                edited=lambda: _rest_comments(self.issue, since))
+        # Only those updated since, all of which count.
+        return _warnings_from_comments(_rest_comments(self.issue, since), self._is_close_warning,
+                                       horizon=self._horizon)
+
+    @cached_property
+    def stale_labeled(self):
+        if self._stale_label not in self.labels:
+            return []  # Only asked for when labeled, except to date warnings.
+        if self._marker is not None:
+            return _marker_stale_labeled(self._marker)
+        return _stale_labeled_from_timeline(self._timeline, self._stale_label,
+                                            horizon=self._horizon)
+
+
+def _warnings_since(labels, stale_label, stale_labeled, last_committed):
+    """Warnings on a PR before this time do not count.
+
+    With the stale label on, only warnings since it was added count;
+    otherwise, only warnings since the last commit.
+
+    """
+    if stale_label in labels:
+        return max((t for t, _ in stale_labeled), default=None)
+    return last_committed
+
+
+def fetch_rest_by_number(get_item, numbers, known=None):
+    """Yield the open items with the given numbers, one REST call each.
+
+    Parameters
+    ----------
+    get_item : callable
+        Like ``repo.get_pull`` or ``repo.get_issue``.
+
+    numbers : list of int
+        Item numbers, in the order to yield them.
+
+    known : dict or `None`
+        PyGithub objects of the same kind already listed, by number.
+        These are yielded without another call.
+
+    """
+    known = known or {}
+    for number in numbers:
+        item = known.get(number)
+        if item is not None:
+            yield item
+            continue
+        # The repository is lazy, so the item is only fetched for its state.
+        try:
+            item = get_item(number)
+            state = item.state
+        except UnknownObjectException:  # Deleted or transferred
+            continue
+        if state == 'open':
+            yield item
+
+
+# GraphQL reports apps without the "[bot]" suffix that REST uses.
+_GRAPHQL_ACTOR = '__typename login'
+
+_GRAPHQL_COMMENTS_PAGE = f"""
+comments(last: 100, before: $before) {{
+  pageInfo {{ hasPreviousPage startCursor }}
+  nodes {{ author {{ {_GRAPHQL_ACTOR} }} body createdAt updatedAt }}
+}}
+"""
+
+_GRAPHQL_LABELED_PAGE = f"""
+timelineItems(last: 100, before: $before, itemTypes: [LABELED_EVENT]) {{
+  pageInfo {{ hasPreviousPage startCursor }}
+  nodes {{ ... on LabeledEvent {{ createdAt actor {{ {_GRAPHQL_ACTOR} }} label {{ name }} }} }}
+}}
+"""
+
+# The newest 100 of each come with the item.
+_GRAPHQL_COMMENTS = (_GRAPHQL_COMMENTS_PAGE + _GRAPHQL_LABELED_PAGE).replace(
+    ', before: $before', '')
+
+PULL_REQUEST_FRAGMENT = f"""
+fragment StalePullRequest on PullRequest {{
+  number
+  state
+  updatedAt
+  labels(first: 100) {{ nodes {{ name }} }}
+  commits(last: 1) {{ nodes {{ commit {{ committedDate }} }} }}
+  forcePushes: timelineItems(last: 1, itemTypes: [HEAD_REF_FORCE_PUSHED_EVENT]) {{
+    nodes {{ ... on HeadRefForcePushedEvent {{ createdAt }} }}
+  }}
+  {_GRAPHQL_COMMENTS}
+}}
+"""
+
+ISSUE_FRAGMENT = f"""
+fragment StaleIssue on Issue {{
+  number
+  state
+  updatedAt
+  labels(first: 100) {{ nodes {{ name }} }}
+  {_GRAPHQL_COMMENTS}
+}}
+"""
+
+PULL_REQUESTS_QUERY = """
+query StalePullRequests($owner: String!, $name: String!, $first: Int!, $after: String) {
+  repository(owner: $owner, name: $name) {
+    pullRequests(states: OPEN, first: $first, after: $after,
+                 orderBy: {field: CREATED_AT, direction: ASC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes { ...StalePullRequest }
+    }
+  }
+}
+""" + PULL_REQUEST_FRAGMENT
+
+PULL_REQUEST_COMMITS_QUERY = """
+query StalePullRequestCommits($owner: String!, $name: String!, $number: Int!) {
+  repository(owner: $owner, name: $name) {
+    pullRequest(number: $number) {
+      commits(last: 100) { nodes { commit { committedDate } } }
+    }
+  }
+}
+"""
+
+
+def _older_page_query(operation, connection):
+    return f"""
+query {operation}($owner: String!, $name: String!, $number: Int!, $before: String) {{
+  repository(owner: $owner, name: $name) {{
+    issueOrPullRequest(number: $number) {{
+      ... on Issue {{ {connection} }}
+      ... on PullRequest {{ {connection} }}
+    }}
+  }}
+}}
+"""
+
+
+# Only when the newest 100 do not settle the decision, see _complete_history.
+OLDER_COMMENTS_QUERY = _older_page_query('StaleOlderComments', _GRAPHQL_COMMENTS_PAGE)
+OLDER_LABELED_QUERY = _older_page_query('StaleOlderLabeledEvents', _GRAPHQL_LABELED_PAGE)
+
+ISSUES_QUERY = """
+query StaleIssues($owner: String!, $name: String!, $labels: [String!], $first: Int!,
+                  $after: String) {
+  repository(owner: $owner, name: $name) {
+    issues(states: OPEN, labels: $labels, first: $first, after: $after,
+           orderBy: {field: CREATED_AT, direction: ASC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes { ...StaleIssue }
+    }
+  }
+}
+""" + ISSUE_FRAGMENT
+
+# The search API returns no more than this many results per query.
+SEARCH_MAX_RESULTS = 1000
+
+# Only what tells which items belong to a shard, and how urgent they are,
+# before fetching them.
+OPEN_PULL_REQUEST_NUMBERS_QUERY = """
+query StaleOpenPullRequestNumbers($owner: String!, $name: String!, $first: Int!,
+                                  $after: String) {
+  repository(owner: $owner, name: $name) {
+    pullRequests(states: OPEN, first: $first, after: $after,
+                 orderBy: {field: CREATED_AT, direction: ASC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes { number updatedAt labels(first: 100) { nodes { name } } }
+    }
+  }
+}
+"""
+
+OPEN_ISSUE_NUMBERS_QUERY = """
+query StaleOpenIssueNumbers($owner: String!, $name: String!, $labels: [String!], $first: Int!,
+                            $after: String) {
+  repository(owner: $owner, name: $name) {
+    issues(states: OPEN, labels: $labels, first: $first, after: $after,
+           orderBy: {field: CREATED_AT, direction: ASC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes { number updatedAt labels(first: 100) { nodes { name } } }
+    }
+  }
+}
+"""
+
+
+def in_shard(number, shard_index=0, shard_count=1):
+    """Whether an issue or PR is checked by shard ``shard_index`` out of ``shard_count``.
+
+    Every number belongs to exactly one shard. Numbers are hashed rather than
+    taken modulo ``shard_count``, so that each shard gets a similar share of
+    old and new items however they are numbered.
+
+    """
+    if shard_count <= 1:
+        return True
+    digest = hashlib.blake2b(str(number).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % shard_count == shard_index
+
+
+def _by_number_query(operation, fragment, fragment_name, numbers):
+    """Build a query fetching the given issues or PRs by number, one alias each."""
+    aliases = '\n'.join(
+        f'n{n}: issueOrPullRequest(number: {n}) {{ ...{fragment_name} }}' for n in numbers)
+    return f"""
+query {operation}($owner: String!, $name: String!) {{
+  repository(owner: $owner, name: $name) {{
+    {aliases}
+  }}
+}}
+""" + fragment
+
+
+def _login(actor):
+    if actor is None:  # Deleted account
+        return 'ghost'
+    if actor['__typename'] == 'Bot':
+        return f"{actor['login']}[bot]"
+    return actor['login']
+
+
+def _graphql_stale_labeled(node, stale_label, horizon=None):
+    out = []
+    for event in node['timelineItems']['nodes']:
+        if not event or event['label']['name'] != stale_label:
+            continue
+        created_at = parse_time(event['createdAt'])
+        if horizon is None or created_at >= horizon:
+            out.append((created_at, _login(event['actor'])))
+    return out
+
+
+def _graphql_warnings(node, is_close_warning, since=None, horizon=None):
+    out = []
+    for comment in node['comments']['nodes']:
+        if _login(comment['author']) not in BOT_LOGINS or not is_close_warning(comment['body']):
+            continue
+        if since is not None and parse_time(comment['updatedAt']) < since:
+            continue
+        created_at = parse_time(comment['createdAt'])
+        if horizon is None or created_at >= horizon:
+            out.append(created_at)
+    return out
+
+
+def _graphql_last_committed(commits):
+    dates = [parse_time(c['commit']['committedDate']) for c in commits['nodes']]
+    return max(dates, key=lambda t: t.timestamp(), default=None)
+
+
+def _may_go_back(page, horizon, since=None):
+    """Whether older pages of a connection may still hold something that counts."""
+    if not page['pageInfo']['hasPreviousPage']:
+        return False
+    oldest = next((entry for entry in page['nodes'] if entry), None)
+    if oldest is None:
+        return True
+    created_at = parse_time(oldest['createdAt'])
+    return all(limit is None or created_at >= limit for limit in (horizon, since))
+
+
+def _with_older(g, query, connection, variables, number, page):
+    """The page of a connection with the previous page of the item's in front."""
+    data = graphql(g, query, dict(variables, number=number,
+                                  before=page['pageInfo']['startCursor']))
+    older = data['repository']['issueOrPullRequest'][connection]
+    return {'pageInfo': older['pageInfo'], 'nodes': older['nodes'] + page['nodes']}
+
+
+def _complete_history(g, variables, node, stale_label, is_close_warning, horizon=None,
+                      pulls=False):
+    """Fetch older stale label events and comments of a node, if the newest 100 are not enough.
+
+    Going back 100 at a time, as the REST path does page by page, until the
+    latest stale label event, if labeled, and the latest warning since then,
+    or for an unlabeled PR since its last commit, are found or cannot be
+    there. Returns the node with what was fetched in front.
+
+    """
+    labels = [lbl['name'] for lbl in node['labels']['nodes']]
+    if not pulls and stale_label not in labels:
+        return node  # Not checked any further.
+    events = node['timelineItems']
+    if stale_label in labels:
+        while (not _graphql_stale_labeled({'timelineItems': events}, stale_label, horizon)
+               and _may_go_back(events, horizon)):
+            events = _with_older(g, OLDER_LABELED_QUERY, 'timelineItems', variables,
+                                 node['number'], events)
+    stale_labeled = _graphql_stale_labeled({'timelineItems': events}, stale_label, horizon)
+    if pulls:
+        since = _warnings_since(labels, stale_label, stale_labeled,
+                                _graphql_last_committed(node['commits']))
+    else:
+        since = max((t for t, _ in stale_labeled), default=None)
+    comments = node['comments']
+    while (not _graphql_warnings({'comments': comments}, is_close_warning, since, horizon)
+           and _may_go_back(comments, horizon, since)):
+        comments = _with_older(g, OLDER_COMMENTS_QUERY, 'comments', variables, node['number'],
+                               comments)
+    if events is node['timelineItems'] and comments is node['comments']:
+        return node
+    return dict(node, timelineItems=events, comments=comments)
+
+
+def _pull_request_facts(node, lazy_repo, stale_label, is_close_warning, horizon=None):
+    labels = [lbl['name'] for lbl in node['labels']['nodes']]
+    last_committed = _graphql_last_committed(node['commits'])
+    stale_labeled = _graphql_stale_labeled(node, stale_label, horizon=horizon)
+    if stale_label in labels and not stale_labeled:
+        stale_labeled = _labeled_at_horizon(horizon)
+    since = _warnings_since(labels, stale_label, stale_labeled, last_committed)
+    return PullRequestFacts(
+        node['number'], labels,
+        last_committed=last_committed,
+        warnings=_graphql_warnings(node, is_close_warning, since=since, horizon=horizon),
+        stale_labeled=stale_labeled,
+        issue=lazy_repo.get_issue(node['number']),
+        updated_at=parse_time(node['updatedAt']))
+
+
+def _issue_facts(node, lazy_repo, stale_label, is_close_warning, horizon=None):
+    labels = [lbl['name'] for lbl in node['labels']['nodes']]
+    stale_labeled = _graphql_stale_labeled(node, stale_label, horizon=horizon)
+    if stale_label in labels and not stale_labeled:
+        stale_labeled = _labeled_at_horizon(horizon)
+    last_labeled = max((t for t, _ in stale_labeled), default=None)
+    return IssueFacts(
+        node['number'], labels,
+        warnings=_graphql_warnings(node, is_close_warning, since=last_labeled, horizon=horizon),
+        stale_labeled=stale_labeled,
+        issue=lazy_repo.get_issue(node['number']),
+        updated_at=parse_time(node['updatedAt']))
+
+
+def graphql(g, query, variables):
+    """Run a GraphQL query and return its ``data``.
+
+    Unlike PyGithub, an item that cannot be found only comes back as `None`
+    instead of failing the whole query.
+
+    """
+    _, data = g.requester.requestJsonAndCheck(
+        'POST', g.requester.graphql_url, input={'query': query, 'variables': variables})
+    errors = [e for e in data.get('errors', []) if e.get('type') != 'NOT_FOUND']
+    if errors:
+        raise g.requester.createException(400, {}, data)
+    return data['data']
+
+
+def _paginate(g, query, connection, variables, max_items, page_size):
+    """Yield nodes of a repository connection page by page."""
+    after = None
+    n = 0
+    while max_items < 0 or n < max_items:
+        first = page_size if max_items < 0 else min(page_size, max_items - n)
+        data = graphql(g, query, dict(variables, first=first, after=after))
+        result = data['repository'][connection]
+        for node in result['nodes']:
+            yield node
+            n += 1
+        if not result['pageInfo']['hasNextPage']:
+            break
+        after = result['pageInfo']['endCursor']
+
+
+def _by_number(g, operation, fragment, fragment_name, variables, numbers, page_size):
+    """Yield open items with the given numbers, ``page_size`` of them per query."""
+    numbers = list(numbers)
+    for i in range(0, len(numbers), page_size):
+        chunk = numbers[i:i + page_size]
+        data = graphql(g, _by_number_query(operation, fragment, fragment_name, chunk), variables)
+        for n in chunk:
+            node = data['repository'].get(f'n{n}')
+            # Empty node means the number belongs to the other kind of item.
+            if node and node.get('state') == 'OPEN':
+                yield node
+
+
+def fetch_pull_requests(g, repository, stale_label, is_close_warning, max_prs=-1,
+                        page_size=25, numbers=None, horizon=None):
+    """Fetch open PRs, oldest first, with one GraphQL query per page.
+
+    Parameters
+    ----------
+    g : obj
+        PyGithub Github instance.
+
+    repository : str
+        Repository in the format of ``org/repo`` or ``user/repo``.
+
+    stale_label : str
+        Only events adding this label are kept.
+
+    is_close_warning : callable
+        Tells whether a comment body is a close warning.
+
+    max_prs : int
+        Stop after this many PRs. This is skipped if set to a negative number.
+
+    page_size : int
+        Number of PRs per query.
+
+    numbers : list of int or `None`
+        Only fetch these PRs, in this order, instead of all open PRs.
+        Closed ones are left out.
+
+    horizon : datetime or `None`
+        Ignore comments and stale label events from before then.
+
+    Yields
+    ------
+    facts : `PullRequestFacts`
+        Only the last 100 commits are seen. Commits other than the head are
+        only fetched, with one more query, if the PR was force pushed well
+        after its head commit was made. Comments and stale label events older
+        than the last 100 are only fetched, 100 per query, if those do not
+        hold the latest stale label event or warning.
+
+    """
+    owner, name = repository.split('/')
+    lazy_repo = g.withLazy(True).get_repo(repository)
+    variables = {'owner': owner, 'name': name}
+    if numbers is None:
+        nodes = _paginate(g, PULL_REQUESTS_QUERY, 'pullRequests', variables, max_prs, page_size)
+    else:
+        nodes = _by_number(g, 'StalePullRequestsByNumber', PULL_REQUEST_FRAGMENT,
+                           'StalePullRequest', variables, numbers, page_size)
+    for node in nodes:
+        head_committed = _graphql_last_committed(node['commits'])
+        force_pushed = [parse_time(e['createdAt'])
+                        for e in node['forcePushes']['nodes'] if e]
+        if head_committed is not None and not _head_is_latest(
+                head_committed, max(force_pushed, default=None)):
+            data = graphql(g, PULL_REQUEST_COMMITS_QUERY, dict(variables, number=node['number']))
+            node = dict(node, commits=data['repository']['pullRequest']['commits'])
+        node = _complete_history(g, variables, node, stale_label, is_close_warning,
+                                 horizon=horizon, pulls=True)
+        yield _pull_request_facts(node, lazy_repo, stale_label, is_close_warning,
+                                  horizon=horizon)
+
+
+def fetch_issues(g, repository, stale_label, is_close_warning, max_issues=-1, page_size=25,
+                 numbers=None, horizon=None):
+    """Fetch open issues labeled as stale, oldest first, with one GraphQL query per page.
+
+    Like the REST path, only comments updated since the stale label was last added
+    are considered. See :func:`fetch_pull_requests` for the parameters.
+
+    Yields
+    ------
+    facts : `IssueFacts`
+
+    """
+    owner, name = repository.split('/')
+    lazy_repo = g.withLazy(True).get_repo(repository)
+    variables = {'owner': owner, 'name': name}
+    if numbers is None:
+        nodes = _paginate(g, ISSUES_QUERY, 'issues', dict(variables, labels=[stale_label]),
+                          max_issues, page_size)
+    else:
+        nodes = _by_number(g, 'StaleIssuesByNumber', ISSUE_FRAGMENT, 'StaleIssue',
+                           variables, numbers, page_size)
+    for node in nodes:
+        node = _complete_history(g, variables, node, stale_label, is_close_warning,
+                                 horizon=horizon)
+        yield _issue_facts(node, lazy_repo, stale_label, is_close_warning, horizon=horizon)
+
+
+def list_open(g, repository, pulls=True, labels=None, engine='graphql'):
+    """List open PRs, or open issues, oldest first, as `~stale_priority.Listed`.
+
+    Only numbers, labels and update times are asked for, 100 per query,
+    which is much cheaper than fetching what checking them needs. With
+    ``labels``, only issues with all of them are listed. Engines other than
+    ``'graphql'`` list them with REST, also 100 per page, and keep the
+    PyGithub objects.
+
+    """
+    if engine != 'graphql':
+        repo = g.withLazy(True).get_repo(repository)
+        if pulls:
+            items = repo.get_pulls(state='open', sort='created', direction='asc')
+        else:
+            kwargs = {'labels': labels} if labels else {}
+            items = (issue for issue in
+                     repo.get_issues(state='open', sort='created', direction='asc', **kwargs)
+                     if issue.pull_request is None)
+        return [Listed(item.number, item.updated_at, [lbl.name for lbl in item.labels],
+                       item=item) for item in items]
+    owner, name = repository.split('/')
+    variables = {'owner': owner, 'name': name}
+    if pulls:
+        nodes = _paginate(g, OPEN_PULL_REQUEST_NUMBERS_QUERY, 'pullRequests', variables, -1, 100)
+    else:
+        nodes = _paginate(g, OPEN_ISSUE_NUMBERS_QUERY, 'issues', dict(variables, labels=labels),
+                          -1, 100)
+    return [Listed(node['number'], parse_time(node['updatedAt']),
+                   [lbl['name'] for lbl in node['labels']['nodes']]) for node in nodes]
+
+
+def search_candidates(g, repository, stale_label, keep_open_label, updated_before, pulls=True):
+    """List open PRs, or issues, that may need attention, by number, as `~stale_priority.Listed`.
+
+    Only the search API is asked, for those labeled ``stale_label`` and for
+    those not updated since ``updated_before`` that are not labeled
+    ``keep_open_label``. The last commit is always before the last update, so
+    the others can only be stale if they were commented on since; those are
+    left alone until things quiet down. The search API has a rate limit of
+    its own.
+
+    """
+    base = f'repo:{repository} is:{"pr" if pulls else "issue"} is:open'
+    cutoff = updated_before.strftime('%Y-%m-%dT%H:%M:%SZ')
+    queries = (f'{base} label:"{stale_label}"',
+               f'{base} updated:<{cutoff} -label:"{stale_label}" -label:"{keep_open_label}"')
+    found = {}
+    for query in queries:
+        results = g.search_issues(query, sort='created', order='asc')
+        for result in results:
+            found[result.number] = Listed(result.number, result.updated_at,
+                                          [lbl.name for lbl in result.labels])
+        if results.totalCount > SEARCH_MAX_RESULTS:
+            print(f'Search only returned {SEARCH_MAX_RESULTS} of {results.totalCount} '
+                  f'for {query}, the rest is left for later runs')
+    return [found[n] for n in sorted(found)]
+
+
+# The async engine: explicit REST requests, see stale_async.py.
+
+class _Unavailable:
+    """Facts that could not be fetched. Checking them raises what went wrong."""
+    def __init__(self, number, updated_at, error):
+        self.number = number
+        self.updated_at = updated_at
+        self.error = error
+        self.issue = None
+
+    def __getattr__(self, name):
+        raise self.error
+
+
+class _UnavailableIssueFacts(_Unavailable, IssueFacts):
+    pass
+
+
+class _UnavailablePullRequestFacts(_Unavailable, PullRequestFacts):
+    pass
+
+
+def _since_param(since):
+    if since is None:
+        return None
+    return {'since': since.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')}
+
+
+def _async_comments(client, base, number, since, item):
+    """`~stale_async.NewestFirst` ``(created_at, login, body)`` of the comments on an item."""
+    return client.newest_first(
+        f'{base}/issues/{number}/comments', _since_param(since), item=item,
+        convert=lambda c: (parse_time(c['created_at']), _rest_login(c.get('user')), c['body']))
+
+
+def _older_than(horizon=None, since=None):
+    """Whether an element of a list read newest first is older than what is looked at."""
+    def older(created_at):
+        return (created_at is not None and
+                (horizon is not None and created_at < horizon or
+                 since is not None and created_at < since))
+    return older
+
+
+def _event_time(event):
+    created_at = event.get('created_at')
+    return None if created_at is None else parse_time(created_at)
+
+
+async def _async_warnings(client, base, number, item, comments, is_close_warning, since,
+                          horizon):
+    """`_warnings_from_comments`, reading only as many comments as it needs.
+
+    The comments edited since ``since`` are fetched if needed.
+
+    """
+    older = _older_than(horizon, since)
+    seen = await comments.until(
+        lambda c: older(c[0]) or c[1] in BOT_LOGINS and is_close_warning(c[2]))
+    warnings = _warnings_from_comments(seen, is_close_warning, horizon=horizon, since=since)
+    if warnings or since is None or not any(t < since for t, _, _ in seen):
+        return warnings
+    edited = await _async_comments(client, base, number, since, item).until(
+        lambda c: _older_than(horizon)(c[0]) or
+        c[0] < since and c[1] in BOT_LOGINS and is_close_warning(c[2]))
+    return _edited_warnings(edited, is_close_warning, since, horizon=horizon)
+
+
+async def _async_stale_labeled(timeline, stale_label, horizon):
+    """`_stale_labeled_from_timeline`, reading only as many events as it needs."""
+    older = _older_than(horizon)
+    events = await timeline.until(
+        lambda e: older(_event_time(e)) or
+        e['event'] == 'labeled' and e['label']['name'] == stale_label)
+    return _stale_labeled_from_timeline(events, stale_label, horizon=horizon)
+
+
+async def _async_pull_request_facts(client, repository, pr, lazy_repo, stale_label,
+                                    is_close_warning, keep_open_label=None, horizon=None):
+    number = pr['number']
+    labels = [label['name'] for label in pr['labels']]
+    facts = PullRequestFacts(number, labels, issue=lazy_repo.get_issue(number),
+                             updated_at=parse_time(pr['updated_at']))
+    if keep_open_label in labels:
+        return facts  # Not checked any further.
+    base = f'/repos/{repository}'
+    item = ('pulls', repository, number)
+    comments = None
+    if stale_label in labels:
+        comments = _async_comments(client, base, number, None, item)
+        marker = _marker_of_newest(await comments.until(lambda c: True), is_close_warning,
+                                   facts.updated_at)
+        if marker is not None and 'last_commit' in marker:
+            facts.last_committed = marker['last_commit']
+            facts.stale_labeled = _marker_stale_labeled(marker)
+            facts.warnings = [marker['created_at']]
+            return facts
+    # Needed to trust the head commit, so its newest events are fetched alongside it.
+    timeline = client.newest_first(f'{base}/issues/{number}/timeline', item=item)
+    newest_events = asyncio.ensure_future(timeline.until(lambda e: True))
+    # Head repo is gone if the fork was deleted, but the base repo keeps the commits.
+    head_repo = (pr['head'].get('repo') or pr['base']['repo'])['full_name']
+    try:
+        _, commit = await client.get(f'/repos/{head_repo}/git/commits/{pr["head"]["sha"]}',
+                                     item=item, missing_ok=True)
+        await newest_events
+    finally:
+        newest_events.cancel()
+    head_committed = parse_time(commit['committer']['date']) if commit else None
+    head_is_latest = False
+    if head_committed is not None:
+        after = head_committed + FORCE_PUSH_SLACK
+        events = await timeline.until(
+            lambda e: e['event'] == 'head_ref_force_pushed' or
+            _event_time(e) is not None and _event_time(e) <= after)
+        head_is_latest = _head_is_latest(head_committed, _force_pushed_after(events, after))
+    if head_is_latest:
+        facts.last_committed = head_committed
+    else:
+        commits = await client.list_all(f'{base}/pulls/{number}/commits', item=item)
+        facts.last_committed = max((parse_time(c['commit']['committer']['date'])
+                                    for c in commits), key=lambda t: t.timestamp(), default=None)
+    if stale_label in labels:
+        facts.stale_labeled = await _async_stale_labeled(timeline, stale_label, horizon)
+    since = _warnings_since(labels, stale_label, facts.stale_labeled, facts.last_committed)
+    if comments is None:
+        # Only those updated since, all of which count.
+        comments = _async_comments(client, base, number, since, item)
+        facts.warnings = await _async_warnings(client, base, number, item, comments,
+                                               is_close_warning, None, horizon)
+    else:
+        facts.warnings = await _async_warnings(client, base, number, item, comments,
+                                               is_close_warning, since, horizon)
+    return facts
+
+
+async def _async_issue_facts(client, repository, issue, lazy_repo, stale_label,
+                             is_close_warning, keep_open_label=None, horizon=None):
+    number = issue['number']
+    labels = [label['name'] for label in issue['labels']]
+    facts = IssueFacts(number, labels, is_pull_request='pull_request' in issue,
+                       issue=lazy_repo.get_issue(number),
+                       updated_at=parse_time(issue['updated_at']))
+    if facts.is_pull_request or stale_label not in labels or keep_open_label in labels:
+        return facts  # Not checked any further.
+    base = f'/repos/{repository}'
+    item = ('issues', repository, number)
+    comments = _async_comments(client, base, number, None, item)
+    marker = _marker_of_newest(await comments.until(lambda c: True), is_close_warning,
+                               facts.updated_at)
+    if marker is not None:
+        facts.stale_labeled = _marker_stale_labeled(marker)
+        facts.warnings = [marker['created_at']]
+        return facts
+    timeline = client.newest_first(f'{base}/issues/{number}/timeline', item=item)
+    facts.stale_labeled = await _async_stale_labeled(timeline, stale_label, horizon)
+    since = max((t for t, _ in facts.stale_labeled), default=None)
+    facts.warnings = await _async_warnings(client, base, number, item, comments,
+                                           is_close_warning, since, horizon)
+    return facts
+
+
+def _fetch_async(g, repository, path, facts, unavailable, max_items, numbers, keep, workers,
+                 list_params):
+    """Run the async engine for one kind of items. See `fetch_pull_requests_async`."""
+    lazy_repo = g.withLazy(True).get_repo(repository)
+    base = f'/repos/{repository}'
+
+    async def list_items(client):
+        n = 0
+        if numbers is not None:
+            for number in numbers:
+                yield number
+            return
+        # A few pages ahead, the rest may not be needed.
+        async for page in client.pages(f'{base}/{path}', list_params, ahead=2):
+            for listed in page:
+                if max_items >= 0 and n >= max_items:
+                    return
+                if keep is None or keep(listed['number']):
+                    n += 1
+                    yield listed
+
+    async def fetch_one(client, listed):
+        number = listed if isinstance(listed, int) else listed['number']
+        try:
+            if isinstance(listed, int):
+                _, listed = await client.get(f'{base}/{path}/{number}', missing_ok=True)
+                if listed is None or listed['state'] != 'open':
+                    return None  # Deleted, transferred, closed, or the other kind of item
+            return await facts(client, repository, listed, lazy_repo)
+        except Exception as e:
+            updated_at = None if isinstance(listed, int) else parse_time(listed['updated_at'])
+            return unavailable(number, updated_at, e)
+
+    return in_background(list_items, fetch_one, ahead=2 * max(1, workers))
+
+
+def fetch_pull_requests_async(g, repository, stale_label, is_close_warning, max_prs=-1,
+                              numbers=None, horizon=None, keep_open_label=None, keep=None,
+                              workers=1):
+    """Fetch open PRs, oldest first, with explicit REST requests on an event loop.
+
+    Timelines and comments are read newest first, a page at a time and only
+    as far back as needed, all the pages of commits at once, and up to
+    ``2 * workers`` PRs at the same time, in a background thread. See
+    :func:`fetch_pull_requests` for the other parameters.
+
+    Parameters
+    ----------
+    keep_open_label : str or `None`
+        Only the labels of PRs with this label are fetched.
+
+    keep : callable or `None`
+        Called with each PR number when listing all open PRs; only those it
+        returns `True` for are fetched.
+
+    Yields
+    ------
+    facts : `PullRequestFacts`
+        If anything failed, reading the facts of the PR raises the error.
+
+    """
+    async def facts(client, repo_name, pr, lazy_repo):
+        return await _async_pull_request_facts(
+            client, repo_name, pr, lazy_repo, stale_label, is_close_warning,
+            keep_open_label=keep_open_label, horizon=horizon)
+
+    return _fetch_async(g, repository, 'pulls', facts, _UnavailablePullRequestFacts, max_prs,
+                        numbers, keep, workers,
+                        {'state': 'open', 'sort': 'created', 'direction': 'asc'})
+
+
+def fetch_issues_async(g, repository, stale_label, is_close_warning, max_issues=-1,
+                       numbers=None, horizon=None, keep_open_label=None, keep=None, workers=1):
+    """Fetch open issues labeled as stale, oldest first, with explicit REST requests.
+
+    See :func:`fetch_pull_requests_async` for the parameters.
+
+    Yields
+    ------
+    facts : `IssueFacts`
+
+    """
+    async def facts(client, repo_name, issue, lazy_repo):
+        return await _async_issue_facts(
+            client, repo_name, issue, lazy_repo, stale_label, is_close_warning,
+            keep_open_label=keep_open_label, horizon=horizon)
+
+    return _fetch_async(g, repository, 'issues', facts, _UnavailableIssueFacts, max_issues,
+                        numbers, keep, workers,
+                        {'state': 'open', 'labels': stale_label, 'sort': 'created',
+                         'direction': 'asc'})
@@ -0,0 +1,362 @@
+"""HTTP plumbing shared by all the GitHub calls the bot makes.
+
+PyGithub keeps a single connection object per client and stores the
+pending request on it, so the same client cannot be used from several
+threads. Here, every PyGithub request gets its own light connection object
+instead, all backed by one keep-alive `requests.Session`.
+
+That session can also keep GET responses on disk between runs and revalidate
+them with conditional requests. GitHub does not count a 304 response against
+the rate limit. Every request it sends is paced by a `RateLimitScheduler`,
+and recorded by a `Telemetry`.
+
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+import requests
+from github import Auth, Github
+from github.Requester import HTTPRequestsConnectionClass, HTTPSRequestsConnectionClass, Requester
+from urllib3.util.retry import Retry
+
+from stale_scheduler import RateLimitScheduler, current_scheduler, resource_of
+from stale_telemetry import Telemetry
+
+
+# Only meaningful for the body as it was received.
+_UNCACHED_HEADERS = ('content-encoding', 'content-length', 'transfer-encoding', 'connection')
+
+
+# Share of ``max_bytes`` the cache is brought down to when it goes over.
+LOW_WATER = 0.9
+
+
+class ResponseCache:
+    """GET responses kept on disk, keyed by URL, for conditional requests.
+
+    Each entry is one JSON file, so the directory can be saved and restored
+    with ``actions/cache``. When the directory grows past ``max_bytes``, the
+    least recently used entries are dropped, down to `LOW_WATER` of it, so
+    that the directory is not sorted again on every new entry.
+
+    Parameters
+    ----------
+    path : str
+        Cache directory. Created if needed.
+
+    max_bytes : int
+        Size cap for the cache directory.
+
+    """
+    def __init__(self, path, max_bytes=100 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._sizes = {}
+        for name in os.listdir(path):
+            if name.endswith('.json'):
+                self._sizes[name] = os.path.getsize(os.path.join(path, name))
+        self._total = sum(self._sizes.values())
+        self._evict()
+
+    def _filename(self, url, accept):
+        return hashlib.sha256(f'{accept} {url}'.encode('utf-8')).hexdigest() + '.json'
+
+    def get(self, url, accept=None):
+        """Return the stored entry for this URL, if any, and mark it as recently used."""
+        name = self._filename(url, accept)
+        filename = os.path.join(self.path, name)
+        try:
+            with open(filename, encoding='utf-8') as fin:
+                entry = json.load(fin)
+            os.utime(filename)
+        except (OSError, ValueError):
+            return None
+        return entry
+
+    def put(self, url, accept, response):
+        """Store a 200 response that can be revalidated later."""
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag is None and last_modified is None:
+            return
+        entry = {'url': url, 'etag': etag, 'last_modified': last_modified,
+                 'headers': {k: v for k, v in response.headers.items()
+                             if k.lower() not in _UNCACHED_HEADERS},
+                 'body': response.text}
+        name = self._filename(url, accept)
+        data = json.dumps(entry).encode('utf-8')
+        with self._lock:
+            with open(os.path.join(self.path, name), 'wb') as fout:
+                fout.write(data)
+            self._total += len(data) - self._sizes.get(name, 0)
+            self._sizes[name] = len(data)
+            self._evict()
+
+    def _mtime(self, name):
+        try:
+            return os.path.getmtime(os.path.join(self.path, name))
+        except OSError:  # Removed by someone else, drop it first.
+            return 0
+
+    def _evict(self):
+        if self._total <= self.max_bytes:
+            return
+        low_water = self.max_bytes * LOW_WATER
+        for name in sorted(self._sizes, key=self._mtime):
+            if self._total <= low_water:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            self._total -= self._sizes.pop(name)
+            self.evictions += 1
+
+    def count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def summary(self):
+        size = self._total
+        return (f'HTTP cache: {self.hits} hits, {self.misses} misses, {self.evictions} evicted, '
+                f'{len(self._sizes)} entries ({size / 1024 / 1024:.1f} MB)')
+
+
+class StalebotSession(requests.Session):
+    """`requests.Session` that revalidates GET responses against a `ResponseCache`
+    and waits for its `RateLimitScheduler` before sending anything."""
+    cache = None
+    scheduler = None
+    telemetry = None
+
+    def _request(self, method, url, resource, *args, **kwargs):
+        if self.telemetry is None:
+            return super().request(method, url, *args, **kwargs)
+        start = time.perf_counter()
+        response = None
+        try:
+            response = super().request(method, url, *args, **kwargs)
+        finally:
+            self.telemetry.record(method, url, _body(kwargs), response,
+                                  time.perf_counter() - start, resource)
+        return response
+
+    def _send(self, method, url, *args, **kwargs):
+        resource = resource_of(url)
+        if self.scheduler is None:
+            return self._request(method, url, resource, *args, **kwargs)
+        # GraphQL reads are POSTs too, but only mutations are writes.
+        is_write = method.upper() != 'GET' and not (
+            resource == 'graphql' and b'mutation' not in _body(kwargs))
+        for attempt in range(self.scheduler.max_retries + 1):
+            self.scheduler.acquire(resource, is_write)
+            response = None
+            try:
+                response = self._request(method, url, resource, *args, **kwargs)
+            finally:
+                retry = self.scheduler.release(resource, is_write, response)
+            if not retry or attempt == self.scheduler.max_retries:
+                return response
+            print(f'Rate limited on {method} {url}, waiting before trying again')
+
+    def request(self, method, url, *args, **kwargs):
+        if self.cache is None or method.upper() != 'GET':
+            return self._send(method, url, *args, **kwargs)
+
+        headers = dict(kwargs.pop('headers', None) or {})
+        accept = headers.get('Accept')
+        entry = self.cache.get(url, accept)
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        response = self._send(method, url, *args, headers=headers, **kwargs)
+
+        if response.status_code == 304 and entry is not None:
+            self.cache.count(hit=True)
+            return _replay(entry, response)
+        self.cache.count(hit=False)
+        if response.status_code == 200:
+            self.cache.put(url, accept, response)
+        return response
+
+
+def _body(kwargs):
+    data = kwargs.get('data') or b''
+    return data.encode('utf-8') if isinstance(data, str) else data
+
+
+def _replay(entry, response):
+    """Turn a 304 response back into the 200 response it stands for."""
+    cached = requests.models.Response()
+    cached.status_code = 200
+    cached.headers = requests.structures.CaseInsensitiveDict(entry['headers'])
+    # Rate limit information is only current in the new response.
+    for key, value in response.headers.items():
+        if key.lower().startswith('x-ratelimit'):
+            cached.headers[key] = value
+    cached._content = entry['body'].encode('utf-8')
+    cached.encoding = 'utf-8'
+    cached.url = response.url
+    cached.request = response.request
+    cached.reason = 'OK'
+    return cached
+
+
+def make_session(pool_size=10, cache=None, scheduler=None, telemetry=None):
+    """Create the `requests.Session` all GitHub traffic goes through.
+
+    Parameters
+    ----------
+    pool_size : int
+        Maximum number of connections kept alive.
+
+    cache : `ResponseCache` or `None`
+        Where to keep GET responses for conditional requests.
+
+    scheduler : `RateLimitScheduler` or `None`
+        What paces the requests.
+
+    telemetry : `Telemetry` or `None`
+        What records the requests.
+
+    """
+    session = StalebotSession()
+    session.cache = cache
+    session.scheduler = scheduler
+    session.telemetry = telemetry
+    # Same as PyGithub: do not fall back to .netrc file.
+    session.auth = Requester.noopAuth
+    # Rate limits are up to the scheduler; only retry reads that hit a server error.
+    retry = Retry(total=3, backoff_factor=1, status_forcelist=(500, 502, 503, 504),
+                  raise_on_status=False)
+    adapter = requests.adapters.HTTPAdapter(
+        max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class _SharedHTTPSConnection(HTTPSRequestsConnectionClass):
+    session = None
+
+    def __init__(self, host, port=None, strict=False, timeout=None, retry=None,
+                 pool_size=None, **kwargs):
+        self.port = port if port else 443
+        self.host = host
+        self.protocol = 'https'
+        self.timeout = timeout
+        self.verify = kwargs.get('verify', True)
+
+    def close(self):
+        pass  # The session outlives the request.
+
+
+class _SharedHTTPConnection(HTTPRequestsConnectionClass):
+    session = None
+
+    def __init__(self, host, port=None, strict=False, timeout=None, retry=None,
+                 pool_size=None, **kwargs):
+        self.port = port if port else 80
+        self.host = host
+        self.protocol = 'http'
+        self.timeout = timeout
+        self.verify = kwargs.get('verify', True)
+
+    def close(self):
+        pass  # The session outlives the request.
+
+
+def install(session):
+    """Send all PyGithub requests through the given session."""
+    _SharedHTTPSConnection.session = session
+    _SharedHTTPConnection.session = session
+    Requester.injectConnectionClasses(_SharedHTTPConnection, _SharedHTTPSConnection)
+
+
+def shared_session():
+    """The session PyGithub requests go through, or `None` if not installed yet.
+
+    Other clients can use it to share its cache, scheduler and telemetry.
+
+    """
+    return _SharedHTTPSConnection.session
+
+
+def github_client(pool_size=1, cache=None, scheduler=None, telemetry=None):
+    """Create a Github client that is safe to share between threads.
+
+    Parameters
+    ----------
+    pool_size : int
+        Number of threads that will use the client at the same time.
+
+    cache : `ResponseCache` or `None`
+        Where to keep GET responses for conditional requests.
+
+    scheduler : `RateLimitScheduler` or `None`
+        What paces the requests. By default, up to ``pool_size`` requests
+        in flight with one second between writes.
+
+    telemetry : `Telemetry` or `None`
+        What records the requests. Nothing is recorded by default.
+
+    """
+    if scheduler is None:
+        scheduler = RateLimitScheduler(max_concurrency=pool_size)
+    install(make_session(pool_size=max(pool_size, 10), cache=cache, scheduler=scheduler,
+                         telemetry=telemetry))
+    auth = Auth.Token(os.environ.get('GITHUB_TOKEN'))
+    # The scheduler replaces PyGithub's fixed spacing between requests.
+    # Fewer, bigger pages make the most of each request.
+    return Github(auth=auth, base_url=os.environ.get('GITHUB_API_URL', 'https://api.github.com'),
+                  seconds_between_requests=None, seconds_between_writes=None, per_page=100)
+
+
+def setup_client(workers=1, sleep=0, cache_dir='', cache_max_mb=100):
+    """Create the Github client for a run, with its cache, scheduler and telemetry.
+
+    Parameters
+    ----------
+    workers : int
+        Number of threads that will use the client at the same time.
+
+    sleep : float
+        Minimum number of seconds between writes. Never less than 1.
+
+    cache_dir : str
+        Directory to keep GET responses in between runs. Disabled if empty.
+
+    cache_max_mb : float
+        Size cap for ``cache_dir``.
+
+    Returns
+    -------
+    g, cache, scheduler, telemetry
+        PyGithub Github instance, `ResponseCache` or `None`, `RateLimitScheduler`
+        and `Telemetry`. The scheduler becomes the
+        `~stale_scheduler.current_scheduler` of the calling context, so that
+        passes stop early when the rate limit runs low.
+
+    """
+    cache = None
+    if cache_dir:
+        cache = ResponseCache(cache_dir, max_bytes=int(cache_max_mb * 1024 * 1024))
+    scheduler = RateLimitScheduler(max_concurrency=workers, min_write_interval=max(sleep, 1))
+    telemetry = Telemetry()
+    g = github_client(pool_size=workers, cache=cache, scheduler=scheduler, telemetry=telemetry)
+    current_scheduler.set(scheduler)
+    return g, cache, scheduler, telemetry
@@ -1,70 +1,46 @@
-import json
+import functools
+import itertools
+import math
 import os
 import sys
 import time
+from datetime import datetime, timezone
 
-import dateutil.parser
-from github import Auth, Github
 from humanize import naturaltime, naturaldelta
 
-# This workflow only makes sense in these events.
-event_name = os.environ.get('GITHUB_EVENT_NAME', 'unknown')
-if event_name not in ('schedule', 'workflow_dispatch'):
-    print(f'No-op for {event_name}')
-    sys.exit(0)
+from stale_core import Template, cached_naturaldelta, common_options, unwrap
+from stale_fetch import (
+    IssueFacts, RestIssueFacts, fetch_issues, fetch_issues_async, fetch_rest_by_number, in_shard,
+    list_open)
+from stale_http import setup_client
+from stale_markers import add_marker
+from stale_parallel import map_in_order
+from stale_plan import Action, apply_plan, apply_rest, save_plan
+from stale_priority import ORDERS, Listed, by_urgency, order_plan
+from stale_scheduler import over_budget, within_budget
+from stale_snapshot import SnapshotWriter
+from stale_state import CHECKPOINT_EVERY, DeadlineIndex, policy_for
+from stale_telemetry import Telemetry, write_report
 
-event_jsonfile = os.environ.get('GITHUB_EVENT_PATH', None)
-if event_jsonfile:
-    with open(event_jsonfile, encoding='utf-8') as fin:
-        event = json.load(fin)
-else:
-    # Dummy values for testing only!
-    event = {'repository': {'full_name': 'astropy/astropy'}}
 
-if event_name == 'schedule':
-    reponame = os.environ['GITHUB_REPOSITORY']
-else:
-    reponame = event['repository']['full_name']
+def options_from_env(environ=None):
+    """Keyword arguments for :func:`process_issues` from ``STALEBOT_*`` environment variables.
 
-is_dryrun = int(os.environ.get('STALEBOT_DRYRUN', '0')) == 1
-stale_label = os.environ.get('STALEBOT_STALE_LABEL', 'Close?')
-keep_open_label = os.environ.get('STALEBOT_KEEP_OPEN_LABEL', 'keep-open')
-closed_by_bot_label = os.environ.get('STALEBOT_CLOSED_BY_BOT_LABEL', 'closed-by-bot')
-max_issues = int(os.environ.get('STALEBOT_MAX_ISSUES', '50'))
-sleep = float(os.environ.get('STALEBOT_SLEEP', '0'))
+    They are read from ``environ`` if given, else from the environment.
 
-# Warn immediately.
-warn_seconds = float(os.environ.get('STALEBOT_WARN_ISSUE_SECONDS', '0'))
-
-# Close after a week.
-close_seconds = float(os.environ.get('STALEBOT_CLOSE_ISSUE_SECONDS', '604800'))
-
-
-# Copied over from baldrick
-def unwrap(text):
-    """Given text that has been wrapped, unwrap it but preserve paragraph breaks."""
-
-    # Split into lines and get rid of newlines and leading/trailing spaces
-    lines = [line.strip() for line in text.splitlines()]
-
-    # Join back with predictable newline character
-    text = os.linesep.join(lines)
-
-    # Replace cases where there are more than two successive line breaks
-    while 3 * os.linesep in text:
-        text = text.replace(3 * os.linesep, 2 * os.linesep)
-
-    # Split based on multiple newlines
-    paragraphs = text.split(2 * os.linesep)
-
-    # Join each paragraph using spaces instead of newlines
-    paragraphs = [paragraph.replace(os.linesep, ' ') for paragraph in paragraphs]
-
-    # Join paragraphs together
-    return (2 * os.linesep).join(paragraphs)
-
-
-ISSUE_CLOSE_WARNING = unwrap("""
+    """
+    if environ is None:
+        environ = os.environ
+    return dict(
+        common_options(environ),
+        max_issues=int(environ.get('STALEBOT_MAX_ISSUES', '50')),
+        # Warn immediately.
+        warn_seconds=float(environ.get('STALEBOT_WARN_ISSUE_SECONDS', '0')),
+        # Close after a week.
+        close_seconds=float(environ.get('STALEBOT_CLOSE_ISSUE_SECONDS', '604800')))
+
+
+ISSUE_CLOSE_WARNING = Template(unwrap("""
 Hi humans :wave: - this issue was labeled as **{closelabel}** approximately
 {pasttime}. If you think this issue should not be closed, a maintainer should
 remove the **{closelabel}** label - otherwise, I will close this issue in
@@ -72,15 +48,15 @@ remove the **{closelabel}** label - otherwise, I will close this issue in
 
 *If you believe I commented on this issue incorrectly, please report this
 [here](https://github.com/pllim/action-astropy-stalebot/issues)*
-""")
+"""))
 
 
 # NOTE: This must be in-sync with ISSUE_CLOSE_WARNING
-def is_close_warning(message):
+def is_close_warning(message, stale_label='Close?'):
     return f'Hi humans :wave: - this issue was labeled as **{stale_label}**' in message
 
 
-ISSUE_CLOSE_EPILOGUE = unwrap("""
+ISSUE_CLOSE_EPILOGUE = Template(unwrap("""
 I'm going to close this issue as per my previous message, but if you feel that
 this issue should stay open, then feel free to re-open and remove the
  **{closelabel}** label.
@@ -88,7 +64,7 @@ this issue should stay open, then feel free to re-open and remove the
 *If this is the first time I am commenting on this issue, or if you believe I
 closed this issue incorrectly, please report this
 [here](https://github.com/pllim/action-astropy-stalebot/issues)*
-""")
+"""))
 
 
 # NOTE: This must be in-sync with ISSUE_CLOSE_EPILOGUE
@@ -99,48 +75,83 @@ def is_close_epilogue(message):
 def process_one_issue(issue, now, warn_seconds, close_seconds,
                       stale_label='Close?', keep_open_label='keep-open',
                       closed_by_bot_label='closed-by-bot', is_dryrun=False):
-    """Check the given issue and close it if needed. Pull request is skipped.
+    """Check the given issue and close it if needed, right away. Pull request is skipped.
+
+    See :func:`plan_one_issue` for the parameters and return value.
+
+    """
+    if not isinstance(issue, IssueFacts):
+        issue = RestIssueFacts(issue, stale_label,
+                               functools.partial(is_close_warning, stale_label=stale_label))
+    actions = []
+    deadline = plan_one_issue(issue, now, warn_seconds, close_seconds, actions,
+                              stale_label=stale_label, keep_open_label=keep_open_label,
+                              closed_by_bot_label=closed_by_bot_label)
+    if not is_dryrun:
+        apply_rest(issue.issue, actions)
+    return deadline
+
+
+def plan_one_issue(issue, now, warn_seconds, close_seconds, actions,
+                   stale_label='Close?', keep_open_label='keep-open',
+                   closed_by_bot_label='closed-by-bot'):
+    """Check the given issue and plan what to do with it, without changing anything.
+    Pull request is skipped.
 
     Parameters
     ----------
     issue : obj
-        PyGithub Issue instance of the issue to be checked.
+        PyGithub Issue instance of the issue to be checked,
+        or its `~stale_fetch.IssueFacts` if already fetched.
 
     now : float
         Time now in seconds.
 
+    actions : list
+        Planned `~stale_plan.Action` are appended here, in order.
+
     *args, **kwargs
         See :func:`process_issues`.
 
+    Returns
+    -------
+    deadline : float or `None`
+        Time in seconds when this issue next needs attention, assuming it is not
+        updated in the meantime. `None` means it should be checked on every run
+        and ``math.inf`` means it never needs attention as it is.
+
     """
-    if issue.pull_request is not None:
+    if not isinstance(issue, IssueFacts):
+        issue = RestIssueFacts(issue, stale_label,
+                               functools.partial(is_close_warning, stale_label=stale_label))
+
+    if issue.is_pull_request:
         print(f'Skipping {issue.number} because it is a pull request')
-        return
+        return math.inf
 
-    all_issue_labels = [lbl.name for lbl in issue.labels]
+    all_issue_labels = issue.labels
 
     if stale_label not in all_issue_labels:  # Nothing to do
         print(f'Skipping {issue.number}, {stale_label} not found in {all_issue_labels}')
-        return
+        return math.inf
 
     if keep_open_label in all_issue_labels:
         print(f'Skipping {issue.number} due to "{keep_open_label}" label, '
               f'removing "{stale_label}" label')
-        if not is_dryrun and stale_label in all_issue_labels:
-            issue.remove_from_labels(stale_label)
-        return
+        if stale_label in all_issue_labels:
+            actions.append(Action.for_item(issue, 'remove_label', label=stale_label))
+        return math.inf
 
     # Find when the label was added. Only count the most recent event.
     last_labeled = None
     labeled_time_sec = 0
-    for timeline in issue.get_timeline():
-        if timeline.event != 'labeled' or timeline.raw_data['label']['name'] != stale_label:
-            continue
-        cur_created_at = dateutil.parser.parse(timeline.raw_data['created_at'])
+    labeled_by = None
+    for cur_created_at, actor in issue.stale_labeled:
         cur_labeled_time_sec = cur_created_at.timestamp()
         if cur_labeled_time_sec > labeled_time_sec:
             last_labeled = cur_created_at
             labeled_time_sec = cur_labeled_time_sec
+            labeled_by = actor
 
     print(f'Checking Issue {issue.number} marked stale on {last_labeled} '
           f'with labels {all_issue_labels}')
@@ -152,11 +163,8 @@ def process_one_issue(issue, now, warn_seconds, close_seconds,
     time_since_last_warning = -1
     last_warn_time_sec = 0
 
-    for comment in issue.get_comments(since=last_labeled):
-        if (comment.user.login not in ('github-actions[bot]', 'astropy-bot[bot]', 'pllim') or
-                not is_close_warning(comment.body)):
-            continue
-        cur_labeled_time_sec = dateutil.parser.parse(comment.raw_data['created_at']).timestamp()
+    for cur_warn_time in issue.warnings:
+        cur_labeled_time_sec = cur_warn_time.timestamp()
         if cur_labeled_time_sec > last_warn_time_sec:
             last_warn_time_sec = cur_labeled_time_sec
 
@@ -172,33 +180,43 @@ def process_one_issue(issue, now, warn_seconds, close_seconds,
         # keep_open_label if they do not want this to happen.
         print(f'-> CLOSING issue {issue.number}, {naturaldelta(time_since_last_warning)} '
               'since last warning')
-        if not is_dryrun:
-            issue.add_to_labels(closed_by_bot_label)
-            issue.create_comment(ISSUE_CLOSE_EPILOGUE.format(closelabel=stale_label))
-            issue.edit(state='closed')
+        actions.append(Action.for_item(issue, 'add_label', label=closed_by_bot_label))
+        actions.append(Action.for_item(issue, 'comment', body=add_marker(
+            ISSUE_CLOSE_EPILOGUE.substitute(closelabel=stale_label), 'close',
+            labeled_at=last_labeled, warned_at=last_warn_time_sec, closed_at=now)))
+        actions.append(Action.for_item(issue, 'close'))
 
     elif time_since_stale_label > warn_seconds:
         if time_since_last_warning < 0:
             print(f'-> WARNING issue {issue.number}, {naturaldelta(time_since_stale_label)} since stale')
-            if not is_dryrun:
-                issue.create_comment(ISSUE_CLOSE_WARNING.format(
-                    closelabel=stale_label,
-                    pasttime=naturaltime(time_since_stale_label),
-                    futuretime=naturaldelta(close_seconds)))
+            actions.append(Action.for_item(issue, 'comment', body=add_marker(
+                ISSUE_CLOSE_WARNING.substitute(
+                    closelabel=stale_label, pasttime=naturaltime(time_since_stale_label),
+                    futuretime=cached_naturaldelta(close_seconds)),
+                'warning', labeled_at=last_labeled, labeled_by=labeled_by, warned_at=now,
+                deadline=now + close_seconds)))
         else:
             print(f'-> OK issue {issue.number} (already warned), '
                   f'{naturaldelta(time_since_stale_label)} since stale')
+            return last_warn_time_sec + close_seconds
 
     else:
         print(f'-> OK issue {issue.number}, '
               f'{naturaldelta(time_since_last_warning)} since last warning, '
               f'{naturaldelta(time_since_stale_label)} since stale')
+        if time_since_last_warning < 0:
+            return labeled_time_sec + warn_seconds
+        return last_warn_time_sec + close_seconds
 
 
 def process_issues(repository, warn_seconds, close_seconds,
                    stale_label='Close?', keep_open_label='keep-open',
                    closed_by_bot_label='closed-by-bot', max_issues=50,
-                   sleep=0, is_dryrun=False):
+                   sleep=0, is_dryrun=False, fetch_engine='graphql', page_size=25,
+                   workers=1, cache_dir='', cache_max_mb=100, state_file='',
+                   full_scan=False, plan_file='', snapshot_file='', batch_size=20,
+                   history_days=0, report_file='', shard_index=0, shard_count=1,
+                   order='urgency', numbers=None, index=None, g=None, telemetry=None):
     """Check for stale issues and close them if needed.
 
     Parameters
@@ -228,36 +246,298 @@ def process_issues(repository, warn_seconds, close_seconds,
         Maximum number of issues to process. This is skipped if set to a negative number.
 
     sleep : float
-        Number of seconds to sleep between issues. Ignored for dry-run.
+        Minimum number of seconds between writes (labels, comments, closing).
+        GitHub asks for at least 1 second, which is also the floor here.
+        Reads are only held back by the rate limit itself.
 
     is_dryrun : bool
-        Set to `True` for dry-run only.
+        Set to `True` for dry-run only. Changes are planned but not applied.
+
+    fetch_engine : {'graphql', 'rest', 'async'}
+        With ``'graphql'``, everything needed to check a whole page of issues is
+        fetched in one query. With ``'rest'``, each issue costs several paginated calls.
+        ``'async'`` makes the same calls as ``'rest'`` with httpx, fetching all pages
+        at once and ``2 * workers`` issues ahead of the checks.
+
+    page_size : int
+        Number of issues per GraphQL query.
+
+    workers : int
+        Number of issues to check at the same time, which also caps the number
+        of requests in flight. Log output is still grouped per issue, in order.
+
+    cache_dir : str
+        Directory to keep REST responses in between runs, so unchanged ones
+        are revalidated with conditional requests. Disabled if empty.
+
+    cache_max_mb : float
+        Size cap for ``cache_dir``. Least recently used responses are dropped first.
+
+    state_file : str
+        File to remember between runs when each issue next needs attention.
+        If set, and the previous run got through all open issues with the same
+        settings, only issues updated since then or past their deadline are checked.
+        A run that stops before checking all of them, because of ``max_issues``,
+        the rate limit or being killed, records the last one it checked, and
+        the next run starts after it. Consecutive runs so take turns through
+        all stale issues.
+
+    full_scan : bool
+        Check all open issues even if ``state_file`` would allow skipping some.
+
+    plan_file : str
+        JSON file to write the planned changes to, even for dry-run.
+        It can be applied later with ``python stale_plan.py <plan_file>``.
+
+    snapshot_file : str
+        SQLite file to write what is known about each issue checked, and what
+        was decided on, to as they are checked (see :mod:`stale_snapshot`).
+        Disabled if empty.
+
+    batch_size : int
+        Most changes applied in one GraphQL request.
+
+    history_days : float
+        Ignore comments and stale label events older than this many days,
+        and stop reading comments and timelines there. No limit if zero.
+        Labels added before then count as added at an unknown time.
+
+    report_file : str
+        Where to write a JSON report of the requests made and the time spent.
+        Its tables also go to the step summary of the job. Disabled if empty.
+
+    shard_index, shard_count : int
+        Only check the open issues that :func:`stale_fetch.in_shard` puts in
+        shard ``shard_index``, counting from zero, out of ``shard_count``.
+        Runs with the same count and different indices never check the same
+        issue. They should each have their own ``state_file``.
+
+    order : {'urgency', 'created'}
+        With ``'urgency'``, a capped run checks first the issues that most
+        likely need closing, going by their labels and last update (see
+        :func:`stale_priority.urgency`). With ``'created'``, oldest issues
+        come first. Either way, planned closes are applied before warnings.
+
+    numbers : list of int or `None`
+        Only check these issues, for example the one an event is about,
+        instead of listing the open ones. ``state_file`` and ``snapshot_file``
+        only get these updated, and the next run still looks for updates
+        since the last run that listed them all.
+
+    index : `~stale_state.DeadlineIndex` or `None`
+        Index to use instead of reading one from ``state_file``, like one a
+        long-running worker keeps in memory. It must be for the same
+        settings, see :func:`stale_state.policy_for`.
+
+    g : obj or `None`
+        PyGithub Github instance to use, for example one shared with the other
+        pass (see :func:`stale_http.setup_client`). In that case, ``sleep``,
+        ``cache_dir``, ``cache_max_mb`` and ``report_file`` are up to whoever
+        created it. By default, a new one is created for this pass.
+
+    telemetry : `Telemetry` or `None`
+        What records the requests made by ``g``, to time the phases of this
+        pass and charge requests to items with.
 
     """
-    i = 0
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(f'Shard index {shard_index} out of range for {shard_count} shards')
+    if order not in ORDERS:
+        raise ValueError(f'Unknown order {order!r}, should be one of {ORDERS}')
     now = time.time()
-    auth = Auth.Token(os.environ["GITHUB_TOKEN"])
-    g = Github(auth=auth)
-    repo = g.get_repo(repository)
+    horizon = None
+    if history_days > 0:
+        horizon = datetime.fromtimestamp(now - history_days * 86400, timezone.utc)
+    is_warning = functools.partial(is_close_warning, stale_label=stale_label)
+    own_client = g is None
+    if own_client:
+        g, cache, scheduler, telemetry = setup_client(
+            workers=workers, sleep=sleep, cache_dir=cache_dir, cache_max_mb=cache_max_mb)
+    elif telemetry is None:
+        telemetry = Telemetry()  # Phases are still timed, but requests are not seen.
 
     # Get issues labeled as stale.
-    for issue in repo.get_issues(state='open', labels=[stale_label], sort='created', direction='asc'):
-        if max_issues >= 0 and i >= max_issues:
-            break
+    targeted = numbers is not None
+    listed = {}  # What listing told about the issues, to order them by.
+    if index is None and state_file:
+        index = DeadlineIndex(state_file, 'issues', policy=policy_for(
+            warn_seconds, close_seconds, stale_label, keep_open_label,
+            shard_index=shard_index, shard_count=shard_count, history_days=history_days))
+    snapshot = None
+    if snapshot_file:
+        snapshot = SnapshotWriter(snapshot_file, repository, 'issues', now, stale_label=stale_label,
+                                  keep_open_label=keep_open_label, shard_index=shard_index,
+                                  shard_count=shard_count)
+    if shard_count > 1:
+        print(f'Shard {shard_index + 1} of {shard_count}')
+    incremental = not targeted and index is not None and index.usable and not full_scan
+    if incremental:
+        repo = g.get_repo(repository)
+        with telemetry.phase('issues', 'list'):
+            changed = [Listed(issue.number, issue.updated_at, [lbl.name for lbl in issue.labels],
+                              item=issue)
+                       for issue in repo.get_issues(state='open', labels=[stale_label],
+                                                    since=index.last_run_time)
+                       if issue.pull_request is None]
+        numbers = [n for n in index.todo([(c.number, c.updated_at) for c in changed], now)
+                   if in_shard(n, shard_index, shard_count)]
+        listed = {n: Listed.from_state(n, index.items[str(n)])
+                  for n in numbers if str(n) in index.items}
+        listed.update((c.number, c) for c in changed)
+        print(f'Checking {len(numbers)} issues updated or due since {index.last_run_time}')
+    elif index is not None and not targeted:
+        index.reset()
+    if numbers is None and (shard_count > 1 and fetch_engine == 'graphql' or
+                            max_issues >= 0 and order == 'urgency' or
+                            index is not None and (max_issues >= 0 or index.cursor is not None)):
+        # Cheap to list them all, so that only those of this shard are fetched,
+        # the most urgent come first, and a capped run can pick up where the
+        # previous one stopped.
+        with telemetry.phase('issues', 'list'):
+            listed = {c.number: c for c in list_open(
+                g, repository, pulls=False, labels=[stale_label], engine=fetch_engine)
+                if in_shard(c.number, shard_index, shard_count)}
+        numbers = list(listed)
+    total = None
+    if numbers is not None:
+        if index is not None:
+            # Anything not checked in this run stays due for the next one.
+            for n in numbers:
+                index.mark_due(n)
+        if index is not None and not targeted:
+            numbers = index.rotate(numbers)
+            if index.cursor is not None:
+                print(f'Resuming after issue {index.cursor}')
+        if order == 'urgency':
+            numbers = by_urgency(numbers, listed, now, stale_label, keep_open_label,
+                                 close_seconds)
+        total = len(numbers)
+        if max_issues >= 0:
+            numbers = numbers[:max_issues]
+
+    if fetch_engine == 'graphql':
+        all_issues = fetch_issues(g, repository, stale_label, is_warning,
+                                  max_issues=max_issues, page_size=page_size, numbers=numbers,
+                                  horizon=horizon)
+    elif fetch_engine == 'async':
+        all_issues = fetch_issues_async(
+            g, repository, stale_label, is_warning, max_issues=max_issues, numbers=numbers,
+            horizon=horizon, keep_open_label=keep_open_label, workers=workers,
+            keep=functools.partial(in_shard, shard_index=shard_index, shard_count=shard_count))
+    elif numbers is not None:
+        repo = g.withLazy(True).get_repo(repository)
+        all_issues = fetch_rest_by_number(repo.get_issue, numbers, known={
+            n: c.item for n, c in listed.items() if c.item is not None})
+    else:
+        repo = g.get_repo(repository)
+        all_issues = (issue for issue in repo.get_issues(state='open', labels=[stale_label],
+                                                         sort='created', direction='asc')
+                      if in_shard(issue.number, shard_index, shard_count))
+
+    checked = set()
+
+    def check(issue):
+        if not isinstance(issue, IssueFacts):
+            issue = RestIssueFacts(issue, stale_label, is_warning, horizon=horizon)
+        actions = []
+        deadline = None
+        labels = None
+        # With REST, facts are fetched as the decision needs them.
+        with telemetry.item('issues', repository, issue.number), \
+                telemetry.phase('issues', 'decide', requests_as='fetch'):
+            try:
+                deadline = plan_one_issue(
+                    issue, now, warn_seconds, close_seconds, actions, stale_label=stale_label,
+                    keep_open_label=keep_open_label, closed_by_bot_label=closed_by_bot_label)
+                labels = issue.labels
+            except Exception as e:
+                print(f'-> ERROR: {repr(e)}')
+                actions = []
+        if index is not None:
+            index.record(issue.number, issue.updated_at, deadline, labels=labels)
+        if snapshot is not None:
+            # Labels are only kept once the check went through. The snapshot
+            # is a side output, so failing to write it does not stop the pass.
+            try:
+                snapshot.record(issue, actions, deadline, error=labels is None)
+            except Exception as e:
+                print(f'-> ERROR writing the snapshot: {repr(e)}')
+        checked.add(issue.number)
+        return issue.number, actions
+
+    if max_issues >= 0:
+        all_issues = itertools.islice(all_issues, max_issues)
+    # Plain REST lists the items as they are checked, the other ways fetch
+    # what checking them needs.
+    fetched_as = 'list' if fetch_engine == 'rest' and numbers is None else 'fetch'
+    all_issues = telemetry.timed('issues', fetched_as, within_budget(all_issues))
+    plan = []
+    last = None
+    for i, (last, actions) in enumerate(map_in_order(check, all_issues, workers=workers), 1):
+        plan.extend(actions)
+        # Save progress now and then, so that a run that gets killed can resume.
+        # Issues with changes planned but not applied yet are still due.
+        if index is not None and not targeted and i % CHECKPOINT_EVERY == 0:
+            index.cursor = last
+            index.save(now, numbers is not None,
+                       due={action.number for action in plan})
+    # Cut short when sharing the rate limit with other repositories.
+    stopped = over_budget()
+    plan = order_plan(plan, stale_label)
+
+    if plan_file:
+        save_plan(plan_file, 'issues', repository, plan)
+    if is_dryrun:
+        print(f'Planned {len(plan)} changes, not applied for dry-run')
+    else:
+        with telemetry.phase('issues', 'mutate'):
+            failed = apply_plan(g, repository, plan, engine=fetch_engine, batch_size=batch_size)
+        if index is not None:
+            for n in failed:
+                index.mark_due(n)
+
+    if index is not None and targeted:
+        if not stopped:
+            for n in set(numbers) - checked:
+                index.forget(n)
+        # Other items were not looked at, so keep the time of the last run that did.
+        index.save(index.last_run, index.usable)
+    elif index is not None:
+        if numbers is None:
+            complete = not stopped and (max_issues < 0 or len(checked) < max_issues)
+        else:
+            complete = True
+            # Not returned because no longer open, unless cut short.
+            if not stopped:
+                for n in set(numbers) - checked:
+                    index.forget(n)
+        # The next run starts after the last issue checked, unless all of them were.
+        if not stopped and (total is None or len(numbers) == total):
+            index.cursor = None
+        elif last is not None:
+            index.cursor = last
+        index.save(now, complete)
+    if snapshot is not None:
         try:
-            process_one_issue(issue, now, warn_seconds, close_seconds,
-                              stale_label=stale_label, keep_open_label=keep_open_label,
-                              closed_by_bot_label=closed_by_bot_label, is_dryrun=is_dryrun)
+            if numbers is not None and not stopped:
+                for n in set(numbers) - checked:
+                    snapshot.forget(n)
+            # After going through all open issues, the others are no longer open.
+            snapshot.close(swept=not (stopped or targeted or incremental) and (
+                len(numbers) == total if numbers is not None
+                else max_issues < 0 or len(checked) < max_issues))
         except Exception as e:
-            print(f'-> ERROR: {repr(e)}')
-        i += 1
-        if not is_dryrun and sleep > 0:
-            time.sleep(sleep)
-
+            print(f'ERROR writing the snapshot: {repr(e)}')
+    if own_client:
+        if cache is not None:
+            print(cache.summary())
+        print(scheduler.summary())
+        print(telemetry.summary())
+        write_report(telemetry, repository, report_file,
+                     shard=(shard_index, shard_count) if shard_count > 1 else None)
     print('Finished processing stale issues')
 
 
-process_issues(reponame, warn_seconds, close_seconds,
-               stale_label=stale_label, keep_open_label=keep_open_label,
-               closed_by_bot_label=closed_by_bot_label, max_issues=max_issues,
-               sleep=sleep, is_dryrun=is_dryrun)
+if __name__ == '__main__':
+    from stalebot import run  # The runner imports this module, so not at the top.
+    run(passes=('issues',), argv=sys.argv[1:])
@@ -0,0 +1,134 @@
+"""Hidden markers in the comments the bot leaves, recording what it decided on.
+
+Close warnings and closing comments end with an HTML comment, which GitHub
+does not show, like::
+
+    <!-- stalebot {"v": 1, "kind": "warning", "labeled_at": "2024-01-02T03:04:05+00:00", ...} -->
+
+As long as an item was not updated after its latest warning, that warning
+tells when the stale label was added, when the warning was made and, for a
+PR, when the last commit was, so the timeline need not be read again.
+Comments left before markers existed are still recognized by their text,
+and then the timeline is read as before.
+
+"""
+import json
+import re
+from datetime import datetime, timedelta, timezone
+
+from stale_core import parse_time
+
+MARKER_VERSION = 1
+
+# Fields holding a time, written as ISO 8601 in UTC.
+TIME_FIELDS = ('labeled_at', 'warned_at', 'last_commit', 'deadline', 'closed_at')
+
+# Adding the comment updates the item too, at about the same time.
+MARKER_SLACK = timedelta(seconds=10)
+
+# Stands for a time only known once the comment is posted, see `stamp_marker`.
+APPLIED = 'applied'
+
+_MARKER = re.compile(r'<!-- stalebot (\{.*?\}) -->')
+
+
+def add_marker(body, kind, **fields):
+    """Return the comment body with a marker recording ``fields`` appended.
+
+    Parameters
+    ----------
+    body : str
+        Comment as shown.
+
+    kind : {'warning', 'close'}
+        What the comment is.
+
+    **fields
+        Times among `TIME_FIELDS`, as datetimes or seconds, or `APPLIED`,
+        and other values that can go in JSON. `None` values are left out.
+
+    """
+    data = {'v': MARKER_VERSION, 'kind': kind}
+    for key, value in fields.items():
+        if value is None:
+            continue
+        if key in TIME_FIELDS and value != APPLIED:
+            if not isinstance(value, datetime):
+                value = datetime.fromtimestamp(value, timezone.utc)
+            value = value.astimezone(timezone.utc).isoformat()
+        data[key] = value
+    return f'{body}\n\n<!-- stalebot {_dumps(data)} -->'
+
+
+def _dumps(data):
+    return json.dumps(data, separators=(',', ':'))
+
+
+def stamp_marker(body, when=None):
+    """Return the comment body with the `APPLIED` times of its marker set to ``when``.
+
+    Called right before posting the comment, by default with the current
+    time. A marker left with `APPLIED` times cannot be read.
+
+    """
+    match = _MARKER.search(body) if body else None
+    if match is None:
+        return body
+    data = json.loads(match.group(1))
+    stamped = {key for key in TIME_FIELDS if data.get(key) == APPLIED}
+    if not stamped:
+        return body
+    when = (when or datetime.now(timezone.utc)).astimezone(timezone.utc).isoformat()
+    data.update(dict.fromkeys(stamped, when))
+    return f'{body[:match.start(1)]}{_dumps(data)}{body[match.end(1):]}'
+
+
+def read_marker(body):
+    """The fields of the marker in a comment body, with times as datetimes.
+
+    Returns `None` if there is no marker, or one this version cannot read.
+
+    """
+    match = _MARKER.search(body)
+    if match is None:
+        return None
+    try:
+        data = json.loads(match.group(1))
+        if data.get('v') != MARKER_VERSION:
+            return None
+        for key in TIME_FIELDS:
+            if key in data:
+                data[key] = parse_time(data[key])
+    except (ValueError, TypeError, AttributeError):
+        return None
+    return data
+
+
+def trusted_marker(comment, updated_at):
+    """The marker of an item's newest comment, if it still tells the whole story.
+
+    Parameters
+    ----------
+    comment : tuple or `None`
+        ``(created_at, login, body)`` of the newest comment on the item.
+
+    updated_at : datetime or `None`
+        When the item was last updated. Labels, commits, force pushes and
+        comments all count as updates.
+
+    Returns
+    -------
+    marker : dict or `None`
+        Fields of the marker, plus ``created_at`` and ``login`` of the
+        comment, if the item was not updated after it.
+
+    """
+    if comment is None or updated_at is None:
+        return None
+    created_at, login, body = comment
+    if updated_at > created_at + MARKER_SLACK:
+        return None
+    marker = read_marker(body)
+    if marker is None or marker['kind'] != 'warning':
+        return None
+    return dict(marker, created_at=created_at, login=login)
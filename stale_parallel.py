@@ -0,0 +1,89 @@
+"""Check several issues or PRs at the same time, keeping the output readable."""
+import contextvars
+import io
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class _ThreadLocalStdout:
+    """Stand-in for `sys.stdout` that lets each thread print into its own buffer."""
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        buf = getattr(self.local, 'buf', None)
+        return (buf or self.stream).write(text)
+
+    def flush(self):
+        if getattr(self.local, 'buf', None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def map_in_order(func, items, workers=1):
+    """Call ``func`` on each item, ``workers`` at a time.
+
+    Whatever each call prints is held back and written out in one block,
+    in the order of ``items``, so the log reads the same as a serial run.
+    Calls can use ``map_in_order`` themselves, and they see the context
+    variables of the caller.
+
+    Parameters
+    ----------
+    func : callable
+        Called with one item at a time. Must not raise.
+
+    items : iterable
+        Items to process. Only consumed as fast as the workers keep up.
+
+    workers : int
+        Number of calls in flight. With 1 or less, everything runs serially
+        in the calling thread.
+
+    Yields
+    ------
+    result : obj
+        Return value of ``func`` for each item, in order.
+
+    """
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    # When nested, the output of the inner calls goes to the buffer of the outer one.
+    stdout = sys.stdout
+    proxy = stdout if isinstance(stdout, _ThreadLocalStdout) else _ThreadLocalStdout(stdout)
+
+    def run(item):
+        proxy.local.buf = io.StringIO()
+        try:
+            return func(item), proxy.local.buf.getvalue()
+        finally:
+            proxy.local.buf = None
+
+    pending = deque()
+    sys.stdout = proxy
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for item in items:
+                pending.append(pool.submit(contextvars.copy_context().run, run, item))
+                # Do not read ahead more than the workers can use.
+                while len(pending) > 2 * workers:
+                    yield _drain(pending.popleft(), stdout)
+            while pending:
+                yield _drain(pending.popleft(), stdout)
+    finally:
+        sys.stdout = stdout
+
+
+def _drain(future, stdout):
+    result, output = future.result()
+    stdout.write(output)
+    stdout.flush()
+    return result
@@ -0,0 +1,393 @@
+"""Apply the changes the stale checks decided on, separately from deciding.
+
+The checks in ``stale_pull_requests.py`` and ``stale_issues.py`` only plan
+`Action` records. Applying them is done here, in bulk: with the GraphQL
+engine, the actions for many items go out as one GraphQL document with one
+aliased mutation per action, which GitHub runs in order. Closes go out in
+later documents, only for items whose other changes went through, since a
+failed mutation does not stop the rest of its document. So closing an item
+(label, comment, close) no longer costs three REST calls of its own.
+
+Just before applying, the current state of every item is fetched again.
+Items that were closed or updated since they were planned are left alone,
+and labels that are already there (or already gone) are not touched again.
+Applying the same plan twice is therefore harmless.
+
+A plan can also be written to a JSON file, for example from a dry-run, and
+applied later with::
+
+    python stale_plan.py plan.json
+
+"""
+import json
+import os
+import sys
+from datetime import datetime, timezone
+
+from github import GithubException
+
+from stale_core import parse_time
+from stale_fetch import graphql
+from stale_markers import stamp_marker
+
+ACTION_KINDS = ('add_label', 'remove_label', 'comment', 'close')
+
+# Mutation, input type and input for each kind of action,
+# given the action, the node ID of its item and the node IDs of labels.
+_MUTATIONS = {
+    'add_label': ('addLabelsToLabelable', 'AddLabelsToLabelableInput',
+                  lambda a, node_id, labels: {'labelableId': node_id,
+                                              'labelIds': [labels[a.label]]}),
+    'remove_label': ('removeLabelsFromLabelable', 'RemoveLabelsFromLabelableInput',
+                     lambda a, node_id, labels: {'labelableId': node_id,
+                                                 'labelIds': [labels[a.label]]}),
+    'comment': ('addComment', 'AddCommentInput',
+                lambda a, node_id, labels: {'subjectId': node_id,
+                                            'body': stamp_marker(a.body)}),
+    'close': ('closeIssue', 'CloseIssueInput',
+              lambda a, node_id, labels: {'issueId': node_id}),
+    'close_pr': ('closePullRequest', 'ClosePullRequestInput',
+                 lambda a, node_id, labels: {'pullRequestId': node_id}),
+}
+
+# Same as labels created by adding them through REST.
+_NEW_LABEL_COLOR = 'ededed'
+
+_ITEM_STATE = 'id state updatedAt labels(first: 100) { nodes { name } }'
+
+
+class Action:
+    """One change to make to an issue or pull request.
+
+    Attributes
+    ----------
+    number : int
+        Issue or pull request number.
+
+    kind : {'add_label', 'remove_label', 'comment', 'close'}
+        What to do.
+
+    label : str or `None`
+        Label to add or remove.
+
+    body : str or `None`
+        Comment to leave. Times of its marker only known once it is posted
+        are filled in then, see `stale_markers.stamp_marker`.
+
+    updated_at : datetime or `None`
+        When the item was last updated as seen by the check that planned this.
+        If it was updated since, the action is not applied.
+
+    """
+    __slots__ = ('number', 'kind', 'label', 'body', 'updated_at')
+
+    def __init__(self, number, kind, label=None, body=None, updated_at=None):
+        if kind not in ACTION_KINDS:
+            raise ValueError(f'Unknown action {kind}')
+        self.number = number
+        self.kind = kind
+        self.label = label
+        self.body = body
+        self.updated_at = updated_at
+
+    @classmethod
+    def for_item(cls, item, kind, label=None, body=None):
+        """Plan an action for the item described by the given facts."""
+        return cls(item.number, kind, label=label, body=body, updated_at=item.updated_at)
+
+    def to_dict(self):
+        return {'number': self.number, 'kind': self.kind, 'label': self.label,
+                'body': self.body,
+                'updated_at': self.updated_at.isoformat() if self.updated_at else None}
+
+    @classmethod
+    def from_dict(cls, d):
+        updated_at = d.get('updated_at')
+        return cls(d['number'], d['kind'], label=d.get('label'), body=d.get('body'),
+                   updated_at=parse_time(updated_at))
+
+    def __repr__(self):
+        detail = f' {self.label!r}' if self.label else ''
+        return f'<Action {self.kind}{detail} on {self.number}>'
+
+
+def apply_rest(issue, actions):
+    """Apply actions on a single item through its PyGithub Issue, one call each."""
+    for action in actions:
+        if action.kind == 'add_label':
+            issue.add_to_labels(action.label)
+        elif action.kind == 'remove_label':
+            issue.remove_from_labels(action.label)
+        elif action.kind == 'comment':
+            issue.create_comment(stamp_marker(action.body))
+        elif action.kind == 'close':
+            issue.edit(state='closed')
+
+
+def _group(actions):
+    by_item = {}
+    for action in actions:
+        by_item.setdefault(action.number, []).append(action)
+    return by_item
+
+
+def _current_graphql(g, repository, numbers, page_size):
+    owner, name = repository.split('/')
+    current = {}
+    for i in range(0, len(numbers), page_size):
+        chunk = numbers[i:i + page_size]
+        aliases = '\n'.join(
+            f'n{n}: issueOrPullRequest(number: {n}) {{ __typename '
+            f'... on Issue {{ {_ITEM_STATE} }} ... on PullRequest {{ {_ITEM_STATE} }} }}'
+            for n in chunk)
+        query = f"""
+query StalebotCurrentState($owner: String!, $name: String!) {{
+  repository(owner: $owner, name: $name) {{
+    {aliases}
+  }}
+}}
+"""
+        data = graphql(g, query, {'owner': owner, 'name': name})
+        for n in chunk:
+            node = data['repository'].get(f'n{n}')
+            if node:
+                current[n] = {'node_id': node['id'], 'state': node['state'].lower(),
+                              'updated_at': parse_time(node['updatedAt']),
+                              'labels': [lbl['name'] for lbl in node['labels']['nodes']],
+                              'is_pull_request': node['__typename'] == 'PullRequest'}
+    return current
+
+
+def _current_rest(lazy_repo, numbers):
+    current = {}
+    for n in numbers:
+        try:
+            issue = lazy_repo.get_issue(n)
+            current[n] = {'node_id': issue.node_id, 'state': issue.state,
+                          'updated_at': issue.updated_at,
+                          'labels': [lbl.name for lbl in issue.labels],
+                          'is_pull_request': issue.pull_request is not None}
+        except GithubException as e:
+            print(f'-> ERROR looking up {n}: {repr(e)}')
+    return current
+
+
+def _still_needed(number, actions, current):
+    """Drop actions that are already done or no longer wanted."""
+    if current is None or current['state'] != 'open':
+        print(f'-> SKIP {number}, no longer open')
+        return []
+    planned = actions[0].updated_at
+    if planned is not None and current['updated_at'] > planned:
+        print(f'-> SKIP {number}, updated on {current["updated_at"]} after it was checked')
+        return []
+    labels = set(current['labels'])
+    needed = []
+    for action in actions:
+        if action.kind == 'add_label':
+            if action.label in labels:
+                continue
+            labels.add(action.label)
+        elif action.kind == 'remove_label':
+            if action.label not in labels:
+                continue
+            labels.discard(action.label)
+        needed.append(action)
+    return needed
+
+
+def _label_ids(g, repository, names):
+    owner, name = repository.split('/')
+    names = sorted(names)
+    if not names:
+        return {}
+    params = ''.join(f', $l{i}: String!' for i in range(len(names)))
+    aliases = '\n'.join(f'l{i}: label(name: $l{i}) {{ id }}' for i in range(len(names)))
+    query = f"""
+query StalebotLabels($owner: String!, $name: String!{params}) {{
+  repository(owner: $owner, name: $name) {{
+    {aliases}
+  }}
+}}
+"""
+    variables = {'owner': owner, 'name': name}
+    variables.update({f'l{i}': label for i, label in enumerate(names)})
+    data = graphql(g, query, variables)
+    return {label: data['repository'][f'l{i}']['id']
+            for i, label in enumerate(names) if data['repository'].get(f'l{i}')}
+
+
+def _batches(todo, batch_size):
+    """Split ``(number, actions)`` into batches of up to ``batch_size`` actions, leaving out
+    items without any. The actions of an item are never split."""
+    batches = []
+    for number, actions in todo:
+        if not actions:
+            continue
+        if not batches or sum(len(a) for _, a in batches[-1]) + len(actions) > batch_size:
+            batches.append([])
+        batches[-1].append((number, actions))
+    return batches
+
+
+def _mutate(g, batch, current, label_ids):
+    """Apply the actions of several items in one GraphQL request.
+
+    Returns the numbers of the items for which something went wrong.
+
+    """
+    params = []
+    fields = []
+    variables = {}
+    owners = {}
+    for number, actions in batch:
+        item = current[number]
+        for action in actions:
+            i = len(fields)
+            kind = 'close_pr' if action.kind == 'close' and item['is_pull_request'] else action.kind
+            mutation, input_type, make_input = _MUTATIONS[kind]
+            params.append(f'$x{i}: {input_type}!')
+            fields.append(f'a{i}: {mutation}(input: $x{i}) {{ clientMutationId }}')
+            variables[f'x{i}'] = make_input(action, item['node_id'], label_ids)
+            owners[f'a{i}'] = number
+    query = f"mutation StalebotApply({', '.join(params)}) {{\n  " + '\n  '.join(fields) + '\n}'
+    _, data = g.requester.requestJsonAndCheck(
+        'POST', g.requester.graphql_url, input={'query': query, 'variables': variables})
+    failed = set()
+    for error in data.get('errors', []):
+        path = error.get('path') or []
+        number = owners.get(path[0]) if path else None
+        if number is None:  # Whole request rejected
+            print(f'-> ERROR applying changes: {error.get("message")}')
+            return {n for n, _ in batch}
+        print(f'-> ERROR applying changes to {number}: {error.get("message")}')
+        failed.add(number)
+    return failed
+
+
+def apply_plan(g, repository, actions, engine='graphql', batch_size=20, page_size=50):
+    """Apply planned actions, skipping those that no longer apply.
+
+    Parameters
+    ----------
+    g : obj
+        PyGithub Github instance.
+
+    repository : str
+        Repository in the format of ``org/repo`` or ``user/repo``.
+
+    actions : list of `Action`
+        Actions on the same item are applied in the given order.
+
+    engine : {'graphql', 'rest', 'async'}
+        With ``'graphql'``, up to ``batch_size`` actions go out in one request.
+        Labels that do not exist yet are created first. With ``'rest'`` or
+        ``'async'``, each action is its own REST call.
+
+    batch_size : int
+        Most actions in one GraphQL request. Those of an item are never split.
+
+    page_size : int
+        Number of items to look up per GraphQL query before applying.
+
+    Returns
+    -------
+    failed : set of int
+        Numbers of items that may not have been fully updated.
+
+    """
+    by_item = _group(actions)
+    if not by_item:
+        return set()
+    lazy_repo = g.withLazy(True).get_repo(repository)
+    if engine == 'graphql':
+        current = _current_graphql(g, repository, list(by_item), page_size)
+    else:
+        current = _current_rest(lazy_repo, list(by_item))
+
+    todo = []
+    for number, item_actions in by_item.items():
+        needed = _still_needed(number, item_actions, current.get(number))
+        if needed:
+            todo.append((number, needed))
+
+    label_ids = {}
+    if engine == 'graphql':
+        label_ids = _label_ids(g, repository, {a.label for _, needed in todo for a in needed
+                                               if a.label is not None})
+        # REST would create a missing label on first use, GraphQL cannot.
+        for label in {a.label for _, needed in todo for a in needed
+                      if a.kind == 'add_label' and a.label not in label_ids}:
+            try:
+                label_ids[label] = lazy_repo.create_label(label, _NEW_LABEL_COLOR).node_id
+            except GithubException as e:
+                print(f'-> ERROR creating label {label}: {repr(e)}')
+    batched = []
+    rest = []
+    for number, needed in todo:
+        if engine == 'graphql' and all(a.label is None or a.label in label_ids for a in needed):
+            batched.append((number, needed))
+        else:
+            rest.append((number, needed))
+
+    failed = set()
+    n_batches = 0
+    # The mutations of one request all run even if some fail, unlike REST
+    # calls made one after the other. So items are only closed in later
+    # requests, once their labels and comments went through.
+    for closing in (False, True):
+        for batch in _batches([(number, [a for a in needed if (a.kind == 'close') == closing])
+                               for number, needed in batched if number not in failed],
+                              batch_size):
+            n_batches += 1
+            try:
+                failed |= _mutate(g, batch, current, label_ids)
+            except GithubException as e:
+                print(f'-> ERROR applying changes to {[n for n, _ in batch]}: {repr(e)}')
+                failed |= {n for n, _ in batch}
+    for number, needed in rest:
+        try:
+            apply_rest(lazy_repo.get_issue(number), needed)
+        except GithubException as e:
+            print(f'-> ERROR applying changes to {number}: {repr(e)}')
+            failed.add(number)
+
+    n_actions = sum(len(needed) for _, needed in todo)
+    n_requests = n_batches + sum(len(needed) for _, needed in rest)
+    print(f'Applied {n_actions} of {len(actions)} planned changes to {len(todo)} items '
+          f'in {n_requests} requests, {len(failed)} failed')
+    return failed
+
+
+def save_plan(path, section, repository, actions):
+    """Write planned actions to a JSON file, next to those of other passes."""
+    try:
+        with open(path, encoding='utf-8') as fin:
+            data = json.load(fin)
+    except (OSError, ValueError):
+        data = {}
+    data[section] = {'repository': repository,
+                     'created': datetime.now(timezone.utc).isoformat(),
+                     'actions': [action.to_dict() for action in actions]}
+    tmpfile = f'{path}.tmp'
+    with open(tmpfile, 'w', encoding='utf-8') as fout:
+        json.dump(data, fout, indent=1)
+    os.replace(tmpfile, path)
+
+
+def load_plan(path):
+    """Read a plan file back. Returns ``{section: (repository, actions)}``."""
+    with open(path, encoding='utf-8') as fin:
+        data = json.load(fin)
+    return {section: (plan['repository'], [Action.from_dict(d) for d in plan['actions']])
+            for section, plan in data.items()}
+
+
+if __name__ == '__main__':
+    from stale_http import github_client
+
+    client = github_client()
+    for plan_section, (plan_repository, plan_actions) in load_plan(sys.argv[1]).items():
+        print(f'Applying {len(plan_actions)} planned {plan_section} changes to {plan_repository}')
+        apply_plan(client, plan_repository, plan_actions,
+                   engine=os.environ.get('STALEBOT_FETCH_ENGINE', 'graphql'))
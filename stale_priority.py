@@ -0,0 +1,147 @@
+"""Check first the issues and PRs that most likely need something done.
+
+When a run cannot get through all open items, because of a cap or the rate
+limit, it should be spent on overdue closes first, then on due warnings,
+then on marking as stale, rather than on whichever items are oldest. What
+an item needs next is guessed from what listing it tells: its labels and
+when it was last updated. Comments, commits and labels all count as
+updates, so an item labeled as stale and not updated for ``close_seconds``
+has had nothing happen since its warning.
+
+The guess only decides the order. Every item is still checked in full.
+Items that rank the same keep their order, so that runs that do not get
+through them all still take turns, see `stale_state.DeadlineIndex.rotate`.
+
+"""
+import math
+
+from stale_core import parse_time
+
+# What an item most likely needs next, most urgent first.
+CLOSE, WARN, MARK, MAYBE, NOTHING = range(5)
+
+ORDERS = ('urgency', 'created')
+
+
+class Listed:
+    """What listing an issue or PR tells about it, before anything else is fetched.
+
+    Attributes
+    ----------
+    number : int
+        Issue or PR number.
+
+    updated_at : datetime or `None`
+        When it was last updated, if known.
+
+    labels : list of str or `None`
+        Names of its labels, if known.
+
+    deadline : float or `None`
+        When the previous run expected it to need attention, in seconds.
+
+    item : obj or `None`
+        PyGithub object that came with the list, if it can stand for the
+        item when checking it.
+
+    """
+    __slots__ = ('number', 'updated_at', 'labels', 'deadline', 'item')
+
+    def __init__(self, number, updated_at=None, labels=None, deadline=None, item=None):
+        self.number = number
+        self.updated_at = updated_at
+        self.labels = labels
+        self.deadline = deadline
+        self.item = item
+
+    @classmethod
+    def from_state(cls, number, entry):
+        """Build from an entry of a `~stale_state.DeadlineIndex`."""
+        updated_at = entry.get('updated_at')
+        deadline = entry.get('deadline')
+        return cls(number, parse_time(updated_at),
+                   labels=entry.get('labels'),
+                   deadline=math.inf if deadline is None else deadline)
+
+
+def urgency(listed, now, stale_label, keep_open_label, close_seconds, mark_seconds=None):
+    """Guess what an item needs next.
+
+    Parameters
+    ----------
+    listed : `Listed`
+        What is known about the item.
+
+    now : float
+        Time now in seconds.
+
+    close_seconds : float
+        How long after a warning the item gets closed.
+
+    mark_seconds : float or `None`
+        How long without updates before the item gets labeled as stale.
+        `None` if it never is, like issues.
+
+    Returns
+    -------
+    rank : int
+        One of `CLOSE`, `WARN`, `MARK`, `MAYBE` and `NOTHING`.
+
+    """
+    if listed.labels is None or listed.updated_at is None:
+        if listed.deadline is not None and listed.deadline > now:
+            return NOTHING
+        return MAYBE
+    updated = listed.updated_at.timestamp()
+    labels = listed.labels
+    if keep_open_label in labels:
+        # Only the stale label may need to come off.
+        return WARN if stale_label in labels else NOTHING
+    if stale_label in labels:
+        return CLOSE if updated + close_seconds <= now else WARN
+    if mark_seconds is None:
+        return NOTHING
+    # Comments also count as updates, so the last commit may be older still.
+    return MARK if updated + mark_seconds <= now else MAYBE
+
+
+def by_urgency(numbers, listed, now, stale_label, keep_open_label, close_seconds,
+               mark_seconds=None):
+    """Sort item numbers by what they most likely need next, see `urgency`.
+
+    ``listed`` maps numbers to their `Listed`; items missing from it rank
+    as `MAYBE`. Items that rank the same keep their order.
+
+    """
+    def key(number):
+        item = listed.get(number)
+        if item is None:
+            return MAYBE
+        return urgency(item, now, stale_label, keep_open_label, close_seconds,
+                       mark_seconds=mark_seconds)
+
+    return sorted(numbers, key=key)
+
+
+def order_plan(plan, stale_label):
+    """Sort planned actions so that closes are applied first, then warnings, then marks.
+
+    The actions for one item stay together and in order, so that a run
+    cut short while applying them has done the most important ones.
+
+    """
+    groups = {}
+    for action in plan:
+        groups.setdefault(action.number, []).append(action)
+
+    def rank(actions):
+        kinds = {action.kind for action in actions}
+        if 'close' in kinds:
+            return CLOSE
+        if 'comment' in kinds:
+            return WARN
+        if any(a.kind == 'add_label' and a.label == stale_label for a in actions):
+            return MARK
+        return MAYBE
+
+    return [action for actions in sorted(groups.values(), key=rank) for action in actions]
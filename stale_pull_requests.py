@@ -1,70 +1,47 @@
-import json
+import functools
+import itertools
+import math
 import os
 import sys
 import time
+from datetime import datetime, timezone
 
-import dateutil.parser
-from github import Auth, Github
 from humanize import naturaldelta, naturaltime
 
-# This workflow only makes sense in these events.
-event_name = os.environ.get('GITHUB_EVENT_NAME', 'unknown')
-if event_name not in ('schedule', 'workflow_dispatch'):
-    print(f'No-op for {event_name}')
-    sys.exit(0)
+from stale_core import Template, cached_naturaldelta, common_options, unwrap
+from stale_fetch import (
+    PullRequestFacts, RestPullRequestFacts, fetch_pull_requests, fetch_pull_requests_async,
+    fetch_rest_by_number, in_shard, list_open, search_candidates)
+from stale_http import setup_client
+from stale_markers import APPLIED, add_marker
+from stale_parallel import map_in_order
+from stale_plan import Action, apply_plan, apply_rest, save_plan
+from stale_priority import ORDERS, Listed, by_urgency, order_plan
+from stale_scheduler import over_budget, within_budget
+from stale_snapshot import SnapshotWriter
+from stale_state import CHECKPOINT_EVERY, DeadlineIndex, policy_for
+from stale_telemetry import Telemetry, write_report
 
-event_jsonfile = os.environ.get('GITHUB_EVENT_PATH', None)
-if event_jsonfile:
-    with open(event_jsonfile, encoding='utf-8') as fin:
-        event = json.load(fin)
-else:
-    # Dummy values for testing only!
-    event = {'repository': {'full_name': 'astropy/astropy'}}
 
-if event_name == 'schedule':
-    reponame = os.environ['GITHUB_REPOSITORY']
-else:
-    reponame = event['repository']['full_name']
+def options_from_env(environ=None):
+    """Keyword arguments for :func:`process_pull_requests` from ``STALEBOT_*`` variables.
 
-is_dryrun = int(os.environ.get('STALEBOT_DRYRUN', '0')) == 1
-stale_label = os.environ.get('STALEBOT_STALE_LABEL', 'Close?')
-keep_open_label = os.environ.get('STALEBOT_KEEP_OPEN_LABEL', 'keep-open')
-closed_by_bot_label = os.environ.get('STALEBOT_CLOSED_BY_BOT_LABEL', 'closed-by-bot')
-max_prs = int(os.environ.get('STALEBOT_MAX_PRS', '200'))
-sleep = float(os.environ.get('STALEBOT_SLEEP', '0'))
+    They are read from ``environ`` if given, else from the environment.
 
-# Warn after 5 months.
-warn_seconds = float(os.environ.get('STALEBOT_WARN_PR_SECONDS', '12960000'))
-
-# Close after 1 month.
-close_seconds = float(os.environ.get('STALEBOT_CLOSE_PR_SECONDS', '2592000'))
-
-
-# Copied over from baldrick
-def unwrap(text):
-    """Given text that has been wrapped, unwrap it but preserve paragraph breaks."""
-
-    # Split into lines and get rid of newlines and leading/trailing spaces
-    lines = [line.strip() for line in text.splitlines()]
-
-    # Join back with predictable newline character
-    text = os.linesep.join(lines)
-
-    # Replace cases where there are more than two successive line breaks
-    while 3 * os.linesep in text:
-        text = text.replace(3 * os.linesep, 2 * os.linesep)
-
-    # Split based on multiple newlines
-    paragraphs = text.split(2 * os.linesep)
-
-    # Join each paragraph using spaces instead of newlines
-    paragraphs = [paragraph.replace(os.linesep, ' ') for paragraph in paragraphs]
-
-    # Join paragraphs together
-    return (2 * os.linesep).join(paragraphs)
-
-
-PULL_REQUESTS_CLOSE_WARNING = unwrap("""
+    """
+    if environ is None:
+        environ = os.environ
+    return dict(
+        common_options(environ),
+        max_prs=int(environ.get('STALEBOT_MAX_PRS', '200')),
+        search_prefilter=int(environ.get('STALEBOT_SEARCH_PREFILTER', '0')) == 1,
+        # Warn after 5 months.
+        warn_seconds=float(environ.get('STALEBOT_WARN_PR_SECONDS', '12960000')),
+        # Close after 1 month.
+        close_seconds=float(environ.get('STALEBOT_CLOSE_PR_SECONDS', '2592000')))
+
+
+PULL_REQUESTS_CLOSE_WARNING = Template(unwrap("""
 Hi humans :wave: - this pull request hasn't had any new commits for
 approximately {pasttime}. **I plan to close this in {futuretime} if the pull
 request doesn't have any new commits by then.**
@@ -79,7 +56,7 @@ to reset the clock.
 
 *If you believe I commented on this pull request incorrectly, please report
 this [here](https://github.com/pllim/action-astropy-stalebot/issues).*
-""")
+"""))
 
 
 # NOTE: This must be in-sync with PULL_REQUESTS_CLOSE_WARNING
@@ -106,57 +83,77 @@ def is_close_epilogue(message):
 def process_one_pr(pr, now, warn_seconds, close_seconds,
                    stale_label='Close?', keep_open_label='keep-open',
                    closed_by_bot_label='closed-by-bot', is_dryrun=False):
-    """Check the given PR and close it if needed.
+    """Check the given PR and close it if needed, right away.
+
+    See :func:`plan_one_pr` for the parameters and return value.
+
+    """
+    if not isinstance(pr, PullRequestFacts):
+        pr = RestPullRequestFacts(pr, stale_label, is_close_warning)
+    actions = []
+    deadline = plan_one_pr(pr, now, warn_seconds, close_seconds, actions,
+                           stale_label=stale_label, keep_open_label=keep_open_label,
+                           closed_by_bot_label=closed_by_bot_label)
+    if not is_dryrun:
+        apply_rest(pr.issue, actions)
+    return deadline
+
+
+def plan_one_pr(pr, now, warn_seconds, close_seconds, actions,
+                stale_label='Close?', keep_open_label='keep-open',
+                closed_by_bot_label='closed-by-bot'):
+    """Check the given PR and plan what to do with it, without changing anything.
 
     Parameters
     ----------
     pr : obj
-        PyGithub PullRequest instance of the PR to be checked.
+        PyGithub PullRequest instance of the PR to be checked,
+        or its `~stale_fetch.PullRequestFacts` if already fetched.
 
     now : float
         Time now in seconds.
 
+    actions : list
+        Planned `~stale_plan.Action` are appended here, in order.
+
     *args, **kwargs
         See :func:`process_prs`.
 
+    Returns
+    -------
+    deadline : float or `None`
+        Time in seconds when this PR next needs attention, assuming it is not
+        updated in the meantime. `None` means it should be checked on every run
+        and ``math.inf`` means it never needs attention as it is.
+
     """
-    all_pr_labels = [lbl.name for lbl in pr.labels]
+    if not isinstance(pr, PullRequestFacts):
+        pr = RestPullRequestFacts(pr, stale_label, is_close_warning)
+
+    all_pr_labels = pr.labels
     print(f'Checking {pr.number} with labels {all_pr_labels}')
 
     if keep_open_label in all_pr_labels:
         print(f'-> PROTECTED by {keep_open_label}, skipping and '
               f'removing "{stale_label}" label if it exists')
-        if not is_dryrun and stale_label in all_pr_labels:
-            pr.remove_from_labels(stale_label)
-        return
-
-    issue = pr.as_issue()  # Some API only available for Issue
+        if stale_label in all_pr_labels:
+            actions.append(Action.for_item(pr, 'remove_label', label=stale_label))
+        return math.inf
 
     # Find last commit timestamp.
-    last_committed = None
-    last_committed_sec = 0
-    for commit in pr.get_commits():
-        cur_commit_time = dateutil.parser.parse(commit.raw_data['commit']['committer']['date'])
-        cur_commit_time_sec = cur_commit_time.timestamp()
-        if cur_commit_time_sec > last_committed_sec:
-            last_committed = cur_commit_time
-            last_committed_sec = cur_commit_time_sec
-
+    last_committed = pr.last_committed
     if last_committed is None:
         print(f'-> LAST COMMIT NOT FOUND, need to debug')
         return
 
+    last_committed_sec = last_committed.timestamp()
     time_since_last_commit = now - last_committed_sec
 
     # Grab timestamp of warning if it exists.
     time_since_last_warning = -1
     last_warn_time = None
     last_warn_time_sec = 0
-    for comment in pr.get_issue_comments():
-        if (comment.user.login not in ('github-actions[bot]', 'astropy-bot[bot]', 'pllim') or
-                not is_close_warning(comment.body)):
-            continue
-        cur_labeled_time = dateutil.parser.parse(comment.raw_data['created_at'])
+    for cur_labeled_time in pr.warnings:
         cur_labeled_time_sec = cur_labeled_time.timestamp()
         if cur_labeled_time_sec > last_warn_time_sec:
             last_warn_time = cur_labeled_time
@@ -170,15 +167,12 @@ def process_one_pr(pr, now, warn_seconds, close_seconds,
         last_labeled = None
         labeled_time_sec = 0
         labeled_by = ''
-        for timeline in issue.get_timeline():
-            if timeline.event != 'labeled' or timeline.raw_data['label']['name'] != stale_label:
-                continue
-            cur_created_at = dateutil.parser.parse(timeline.raw_data['created_at'])
+        for cur_created_at, actor in pr.stale_labeled:
             cur_labeled_time_sec = cur_created_at.timestamp()
             if cur_labeled_time_sec > labeled_time_sec:
                 last_labeled = cur_created_at
                 labeled_time_sec = cur_labeled_time_sec
-                labeled_by = timeline.actor.login
+                labeled_by = actor
 
         if last_labeled is None:
             print(f'-> {stale_label} exists but cannot find when it was added, need to debug')
@@ -188,7 +182,7 @@ def process_one_pr(pr, now, warn_seconds, close_seconds,
             print(f'-> OK PR {pr.number} (not stale but has "{stale_label}" applied by {labeled_by}, '
                   f'someone force pushed), last commit was {last_committed} '
                   f'({naturaltime(time_since_last_commit)})')
-            return
+            return last_committed_sec + warn_seconds
 
         # Note: If warning time is before label time, it's as if the warning
         # did not exist since it's no longer relevant.
@@ -196,14 +190,16 @@ def process_one_pr(pr, now, warn_seconds, close_seconds,
             if time_since_last_warning > close_seconds:
                 print(f'-> CLOSING PR {pr.number}, {naturaldelta(time_since_last_warning)} '
                       'since last warning')
-                if not is_dryrun:
-                    pr.add_to_labels(closed_by_bot_label)
-                    issue.create_comment(PULL_REQUESTS_CLOSE_EPILOGUE)
-                    pr.edit(state='closed')
+                actions.append(Action.for_item(pr, 'add_label', label=closed_by_bot_label))
+                actions.append(Action.for_item(pr, 'comment', body=add_marker(
+                    PULL_REQUESTS_CLOSE_EPILOGUE, 'close', labeled_at=last_labeled,
+                    warned_at=last_warn_time, closed_at=now)))
+                actions.append(Action.for_item(pr, 'close'))
             else:
                 print(f'-> OK PR {pr.number} (already warned), '
                       f'labeled on {last_labeled}, '
                       f'warned on {last_warn_time}')
+                return last_warn_time_sec + close_seconds
         else:  # Need to warn first
             if time_since_last_warning < 0:
                 print(f'-> WARNING PR {pr.number}, labeled on {last_labeled}, '
@@ -211,19 +207,19 @@ def process_one_pr(pr, now, warn_seconds, close_seconds,
             else:
                 print(f'-> WARNING PR {pr.number}, labeled on {last_labeled}, '
                       f'warning issued on {last_warn_time} no longer applicable')
-            if not is_dryrun:
-                issue.create_comment(PULL_REQUESTS_CLOSE_WARNING.format(
-                    keepopen=keep_open_label,
-                    pasttime=naturaldelta(time_since_last_commit),
-                    futuretime=naturaldelta(close_seconds)))
+            actions.append(Action.for_item(pr, 'comment', body=add_marker(
+                PULL_REQUESTS_CLOSE_WARNING.substitute(
+                    keepopen=keep_open_label, pasttime=naturaldelta(time_since_last_commit),
+                    futuretime=cached_naturaldelta(close_seconds)),
+                'warning', labeled_at=last_labeled, labeled_by=labeled_by, warned_at=now,
+                last_commit=last_committed, deadline=now + close_seconds)))
 
     # The PR is not yet marked as stale. Mark it as stale as appropriate.
     else:
         if time_since_last_commit > warn_seconds:
             print(f'-> MARK PR {pr.number} as stale with "{stale_label}" label, '
                   f'last commit was {last_committed}')
-            if not is_dryrun:
-                pr.add_to_labels(stale_label)
+            actions.append(Action.for_item(pr, 'add_label', label=stale_label))
             # Warn if no warning exists or last warning made before last commit.
             if last_warn_time_sec < last_committed_sec:
                 if time_since_last_warning < 0:
@@ -231,23 +227,32 @@ def process_one_pr(pr, now, warn_seconds, close_seconds,
                 else:
                     print(f'-> WARNING PR {pr.number}, '
                           f'warning issued on {last_warn_time} no longer applicable')
-                if not is_dryrun:
-                    issue.create_comment(PULL_REQUESTS_CLOSE_WARNING.format(
-                        keepopen=keep_open_label,
-                        pasttime=naturaldelta(time_since_last_commit),
-                        futuretime=naturaldelta(close_seconds)))
+                # The label is added by the bot, right before, whenever the
+                # plan is applied.
+                actions.append(Action.for_item(pr, 'comment', body=add_marker(
+                    PULL_REQUESTS_CLOSE_WARNING.substitute(
+                        keepopen=keep_open_label, pasttime=naturaldelta(time_since_last_commit),
+                        futuretime=cached_naturaldelta(close_seconds)),
+                    'warning', labeled_at=APPLIED, warned_at=now, last_commit=last_committed,
+                    deadline=now + close_seconds)))
             else:
                 print(f'-> OK PR {pr.number} (already warned), '
                       f'{naturaldelta(time_since_last_warning)} since last warning')
         else:
             print(f'-> OK PR {pr.number} (not stale), last commit was {last_committed} '
                   f'({naturaltime(time_since_last_commit)})')
+            return last_committed_sec + warn_seconds
 
 
 def process_pull_requests(repository, warn_seconds, close_seconds,
                           stale_label='Close?', keep_open_label='keep-open',
                           closed_by_bot_label='closed-by-bot', max_prs=200,
-                          sleep=0, is_dryrun=False):
+                          sleep=0, is_dryrun=False, fetch_engine='graphql', page_size=25,
+                          workers=1, cache_dir='', cache_max_mb=100, state_file='',
+                          full_scan=False, plan_file='', snapshot_file='', batch_size=20,
+                          history_days=0, report_file='', shard_index=0, shard_count=1,
+                          search_prefilter=False, order='urgency', numbers=None, index=None, g=None,
+                          telemetry=None):
     """Check for stale PRs and close them if needed.
 
     Parameters
@@ -278,35 +283,313 @@ def process_pull_requests(repository, warn_seconds, close_seconds,
         Maximum number of PRs to process. This is skipped if set to a negative number.
 
     sleep : float
-        Number of seconds to sleep between PRs. Ignored for dry-run.
+        Minimum number of seconds between writes (labels, comments, closing).
+        GitHub asks for at least 1 second, which is also the floor here.
+        Reads are only held back by the rate limit itself.
 
     is_dryrun : bool
-        Set to `True` for dry-run only.
+        Set to `True` for dry-run only. Changes are planned but not applied.
+
+    fetch_engine : {'graphql', 'rest', 'async'}
+        With ``'graphql'``, everything needed to check a whole page of PRs is
+        fetched in one query. With ``'rest'``, each PR costs several paginated calls.
+        ``'async'`` makes the same calls as ``'rest'`` with httpx, fetching all pages
+        at once and ``2 * workers`` PRs ahead of the checks.
+
+    page_size : int
+        Number of PRs per GraphQL query.
+
+    workers : int
+        Number of PRs to check at the same time, which also caps the number
+        of requests in flight. Log output is still grouped per PR, in order.
+
+    cache_dir : str
+        Directory to keep REST responses in between runs, so unchanged ones
+        are revalidated with conditional requests. Disabled if empty.
+
+    cache_max_mb : float
+        Size cap for ``cache_dir``. Least recently used responses are dropped first.
+
+    state_file : str
+        File to remember between runs when each PR next needs attention.
+        If set, and the previous run got through all open PRs with the same
+        settings, only PRs updated since then or past their deadline are checked.
+        A run that stops before checking all of them, because of ``max_prs``,
+        the rate limit or being killed, records the last one it checked, and
+        the next run starts after it. Consecutive runs so take turns through
+        all open PRs.
+
+    full_scan : bool
+        Check all open PRs even if ``state_file`` would allow skipping some.
+
+    plan_file : str
+        JSON file to write the planned changes to, even for dry-run.
+        It can be applied later with ``python stale_plan.py <plan_file>``.
+
+    snapshot_file : str
+        SQLite file to write what is known about each PR checked, and what
+        was decided on, to as they are checked (see :mod:`stale_snapshot`).
+        Disabled if empty.
+
+    batch_size : int
+        Most changes applied in one GraphQL request.
+
+    history_days : float
+        Ignore comments and stale label events older than this many days,
+        and stop reading comments and timelines there. No limit if zero.
+        Labels added before then count as added at an unknown time.
+
+    report_file : str
+        Where to write a JSON report of the requests made and the time spent.
+        Its tables also go to the step summary of the job. Disabled if empty.
+
+    shard_index, shard_count : int
+        Only check the open PRs that :func:`stale_fetch.in_shard` puts in
+        shard ``shard_index``, counting from zero, out of ``shard_count``.
+        Runs with the same count and different indices never check the same
+        PR. They should each have their own ``state_file``.
+
+    search_prefilter : bool
+        Instead of all open PRs, only check those the search API finds with
+        ``stale_label``, or not updated for ``warn_seconds`` and without
+        ``keep_open_label`` (see :func:`stale_fetch.search_candidates`).
+        PRs with newer comments are then only checked once they get quiet.
+        Such a run is not complete, so ``state_file`` does not allow the
+        next one to skip anything.
+
+    order : {'urgency', 'created'}
+        With ``'urgency'``, a capped run checks first the PRs that most likely
+        need closing, then a warning, then the stale label, going by their
+        labels and last update (see :func:`stale_priority.urgency`). With
+        ``'created'``, oldest PRs come first. Either way, planned changes are
+        applied in that order of urgency.
+
+    numbers : list of int or `None`
+        Only check these PRs, for example the one an event is about,
+        instead of listing the open ones. ``state_file`` and ``snapshot_file``
+        only get these updated, and the next run still looks for updates
+        since the last run that listed them all.
+
+    index : `~stale_state.DeadlineIndex` or `None`
+        Index to use instead of reading one from ``state_file``, like one a
+        long-running worker keeps in memory. It must be for the same
+        settings, see :func:`stale_state.policy_for`.
+
+    g : obj or `None`
+        PyGithub Github instance to use, for example one shared with the other
+        pass (see :func:`stale_http.setup_client`). In that case, ``sleep``,
+        ``cache_dir``, ``cache_max_mb`` and ``report_file`` are up to whoever
+        created it. By default, a new one is created for this pass.
+
+    telemetry : `Telemetry` or `None`
+        What records the requests made by ``g``, to time the phases of this
+        pass and charge requests to items with.
 
     """
-    i = 0
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(f'Shard index {shard_index} out of range for {shard_count} shards')
+    if order not in ORDERS:
+        raise ValueError(f'Unknown order {order!r}, should be one of {ORDERS}')
     now = time.time()
-    auth = Auth.Token(os.environ.get('GITHUB_TOKEN'))
-    g = Github(auth=auth)
-    repo = g.get_repo(repository)
-
-    for pr in repo.get_pulls(state='open', sort='created', direction='asc'):
-        if max_prs >= 0 and i >= max_prs:
-            break
+    horizon = None
+    if history_days > 0:
+        horizon = datetime.fromtimestamp(now - history_days * 86400, timezone.utc)
+    own_client = g is None
+    if own_client:
+        g, cache, scheduler, telemetry = setup_client(
+            workers=workers, sleep=sleep, cache_dir=cache_dir, cache_max_mb=cache_max_mb)
+    elif telemetry is None:
+        telemetry = Telemetry()  # Phases are still timed, but requests are not seen.
+
+    targeted = numbers is not None
+    listed = {}  # What listing told about the PRs, to order them by.
+    if index is None and state_file:
+        index = DeadlineIndex(state_file, 'pulls', policy=policy_for(
+            warn_seconds, close_seconds, stale_label, keep_open_label,
+            shard_index=shard_index, shard_count=shard_count, history_days=history_days))
+    snapshot = None
+    if snapshot_file:
+        snapshot = SnapshotWriter(snapshot_file, repository, 'pulls', now, stale_label=stale_label,
+                                  keep_open_label=keep_open_label, shard_index=shard_index,
+                                  shard_count=shard_count)
+    if shard_count > 1:
+        print(f'Shard {shard_index + 1} of {shard_count}')
+    incremental = not targeted and index is not None and index.usable and not full_scan
+    if incremental:
+        repo = g.get_repo(repository)
+        with telemetry.phase('pulls', 'list'):
+            changed = [Listed(issue.number, issue.updated_at, [lbl.name for lbl in issue.labels])
+                       for issue in repo.get_issues(state='open', since=index.last_run_time)
+                       if issue.pull_request is not None]
+        numbers = [n for n in index.todo([(c.number, c.updated_at) for c in changed], now)
+                   if in_shard(n, shard_index, shard_count)]
+        listed = {n: Listed.from_state(n, index.items[str(n)])
+                  for n in numbers if str(n) in index.items}
+        listed.update((c.number, c) for c in changed)
+        print(f'Checking {len(numbers)} PRs updated or due since {index.last_run_time}')
+    elif index is not None and not targeted:
+        index.reset()
+    searched = numbers is None and search_prefilter
+    if searched:
+        updated_before = datetime.fromtimestamp(now - warn_seconds, timezone.utc)
+        with telemetry.phase('pulls', 'list'):
+            listed = {c.number: c for c in search_candidates(
+                g, repository, stale_label, keep_open_label, updated_before)
+                if in_shard(c.number, shard_index, shard_count)}
+        numbers = list(listed)
+        print(f'Checking {len(numbers)} PRs labeled {stale_label} or not updated '
+              f'since {updated_before}')
+    elif numbers is None and (shard_count > 1 and fetch_engine == 'graphql' or
+                              max_prs >= 0 and order == 'urgency' or
+                              index is not None and (max_prs >= 0 or index.cursor is not None)):
+        # Cheap to list them all, so that only those of this shard are fetched,
+        # the most urgent come first, and a capped run can pick up where the
+        # previous one stopped.
+        with telemetry.phase('pulls', 'list'):
+            listed = {c.number: c for c in list_open(g, repository, engine=fetch_engine)
+                      if in_shard(c.number, shard_index, shard_count)}
+        numbers = list(listed)
+    total = None
+    if numbers is not None:
+        if index is not None:
+            # Anything not checked in this run stays due for the next one.
+            for n in numbers:
+                index.mark_due(n)
+        if index is not None and not targeted:
+            numbers = index.rotate(numbers)
+            if index.cursor is not None:
+                print(f'Resuming after PR {index.cursor}')
+        if order == 'urgency':
+            numbers = by_urgency(numbers, listed, now, stale_label, keep_open_label,
+                                 close_seconds, mark_seconds=warn_seconds)
+        total = len(numbers)
+        if max_prs >= 0:
+            numbers = numbers[:max_prs]
+
+    if fetch_engine == 'graphql':
+        all_prs = fetch_pull_requests(g, repository, stale_label, is_close_warning,
+                                      max_prs=max_prs, page_size=page_size, numbers=numbers,
+                                      horizon=horizon)
+    elif fetch_engine == 'async':
+        all_prs = fetch_pull_requests_async(
+            g, repository, stale_label, is_close_warning, max_prs=max_prs, numbers=numbers,
+            horizon=horizon, keep_open_label=keep_open_label, workers=workers,
+            keep=functools.partial(in_shard, shard_index=shard_index, shard_count=shard_count))
+    elif numbers is not None:
+        repo = g.withLazy(True).get_repo(repository)
+        all_prs = fetch_rest_by_number(repo.get_pull, numbers, known={
+            n: c.item for n, c in listed.items() if c.item is not None})
+    else:
+        repo = g.get_repo(repository)
+        all_prs = (pr for pr in repo.get_pulls(state='open', sort='created', direction='asc')
+                   if in_shard(pr.number, shard_index, shard_count))
+
+    checked = set()
+
+    def check(pr):
+        if not isinstance(pr, PullRequestFacts):
+            pr = RestPullRequestFacts(pr, stale_label, is_close_warning,
+                                      horizon=horizon)
+        actions = []
+        deadline = None
+        labels = None
+        # With REST, facts are fetched as the decision needs them.
+        with telemetry.item('pulls', repository, pr.number), \
+                telemetry.phase('pulls', 'decide', requests_as='fetch'):
+            try:
+                deadline = plan_one_pr(
+                    pr, now, warn_seconds, close_seconds, actions, stale_label=stale_label,
+                    keep_open_label=keep_open_label, closed_by_bot_label=closed_by_bot_label)
+                labels = pr.labels
+            except Exception as e:
+                print(f'-> ERROR: {repr(e)}')
+                actions = []
+        if index is not None:
+            index.record(pr.number, pr.updated_at, deadline, labels=labels)
+        if snapshot is not None:
+            # Labels are only kept once the check went through. The snapshot
+            # is a side output, so failing to write it does not stop the pass.
+            try:
+                snapshot.record(pr, actions, deadline, error=labels is None)
+            except Exception as e:
+                print(f'-> ERROR writing the snapshot: {repr(e)}')
+        checked.add(pr.number)
+        return pr.number, actions
+
+    if max_prs >= 0:
+        all_prs = itertools.islice(all_prs, max_prs)
+    # Plain REST lists the items as they are checked, the other ways fetch
+    # what checking them needs.
+    fetched_as = 'list' if fetch_engine == 'rest' and numbers is None else 'fetch'
+    all_prs = telemetry.timed('pulls', fetched_as, within_budget(all_prs))
+    plan = []
+    last = None
+    for i, (last, actions) in enumerate(map_in_order(check, all_prs, workers=workers), 1):
+        plan.extend(actions)
+        # Save progress now and then, so that a run that gets killed can resume.
+        # PRs with changes planned but not applied yet are still due.
+        if index is not None and not targeted and i % CHECKPOINT_EVERY == 0:
+            index.cursor = last
+            index.save(now, numbers is not None and not searched,
+                       due={action.number for action in plan})
+    # Cut short when sharing the rate limit with other repositories.
+    stopped = over_budget()
+    plan = order_plan(plan, stale_label)
+
+    if plan_file:
+        save_plan(plan_file, 'pulls', repository, plan)
+    if is_dryrun:
+        print(f'Planned {len(plan)} changes, not applied for dry-run')
+    else:
+        with telemetry.phase('pulls', 'mutate'):
+            failed = apply_plan(g, repository, plan, engine=fetch_engine, batch_size=batch_size)
+        if index is not None:
+            for n in failed:
+                index.mark_due(n)
+
+    if index is not None and targeted:
+        if not stopped:
+            for n in set(numbers) - checked:
+                index.forget(n)
+        # Other items were not looked at, so keep the time of the last run that did.
+        index.save(index.last_run, index.usable)
+    elif index is not None:
+        if numbers is None:
+            complete = not stopped and (max_prs < 0 or len(checked) < max_prs)
+        else:
+            # PRs left out by the search have no deadline yet.
+            complete = not searched
+            # Not returned because no longer open, unless cut short.
+            if not stopped:
+                for n in set(numbers) - checked:
+                    index.forget(n)
+        # The next run starts after the last PR checked, unless all of them were.
+        if not stopped and (total is None or len(numbers) == total):
+            index.cursor = None
+        elif last is not None:
+            index.cursor = last
+        index.save(now, complete)
+    if snapshot is not None:
         try:
-            process_one_pr(pr, now, warn_seconds, close_seconds,
-                           stale_label=stale_label, keep_open_label=keep_open_label,
-                           closed_by_bot_label=closed_by_bot_label, is_dryrun=is_dryrun)
+            if numbers is not None and not stopped:
+                for n in set(numbers) - checked:
+                    snapshot.forget(n)
+            # After going through all open PRs, the others are no longer open.
+            snapshot.close(swept=not (stopped or targeted or incremental or searched) and (
+                len(numbers) == total if numbers is not None
+                else max_prs < 0 or len(checked) < max_prs))
         except Exception as e:
-            print(f'-> ERROR: {repr(e)}')
-        i += 1
-        if not is_dryrun and sleep > 0:
-            time.sleep(sleep)
-
+            print(f'ERROR writing the snapshot: {repr(e)}')
+    if own_client:
+        if cache is not None:
+            print(cache.summary())
+        print(scheduler.summary())
+        print(telemetry.summary())
+        write_report(telemetry, repository, report_file,
+                     shard=(shard_index, shard_count) if shard_count > 1 else None)
     print('Finished checking for stale pull requests')
 
 
-process_pull_requests(reponame, warn_seconds, close_seconds,
-                      stale_label=stale_label, keep_open_label=keep_open_label,
-                      closed_by_bot_label=closed_by_bot_label, max_prs=max_prs,
-                      sleep=sleep, is_dryrun=is_dryrun)
+if __name__ == '__main__':
+    from stalebot import run  # The runner imports this module, so not at the top.
+    run(passes=('pulls',), argv=sys.argv[1:])
@@ -0,0 +1,279 @@
+"""Pace GitHub requests from the rate limit information GitHub sends back.
+
+Instead of sleeping a fixed amount after every item, requests go out as fast
+as they are allowed to, and only slow down when the API says so:
+
+* Every response carries ``X-RateLimit-Remaining`` and ``X-RateLimit-Reset``
+  for its resource (``core``, ``graphql``, ``search``). Once only the last
+  ``write_reserve`` fraction of a budget is left, `over_budget` tells the
+  passes to stop checking more items, as ``max_prs`` and ``max_issues`` do,
+  so the writes for decisions already made can still go through. The
+  next run picks up from there (see `stale_state.DeadlineIndex`), rather
+  than this one waiting up to an hour for the reset.
+* A 403 or 429 telling us to back off (``Retry-After``, or the secondary
+  rate limit) blocks new requests for as long as asked, halves the number
+  of requests allowed in flight, and doubles the spacing between writes.
+  Then the same request is sent again. A spent primary budget is not
+  waited for: the request fails.
+* Each successful request grows the number allowed in flight back towards
+  its maximum, by one per round of successful requests, and each successful
+  write takes half a second off the spacing between writes (AIMD).
+
+When several repositories are checked in one run, each is a `Tenant` of the
+same scheduler. Tenants get an equal share of the requests in flight and of
+the rate limit budget left when the run starts; what a tenant did not use
+when it finishes goes to those still running.
+
+"""
+import contextvars
+import threading
+import time
+
+# Tenant the requests made in this context are for, if any.
+current_tenant = contextvars.ContextVar('current_tenant', default=None)
+
+# Scheduler of the client used in this context, set by `stale_http.setup_client`.
+current_scheduler = contextvars.ContextVar('current_scheduler', default=None)
+
+# Budgets that checking items reads from.
+READ_RESOURCES = ('core', 'graphql')
+
+
+def resource_of(url):
+    """Which rate limit budget a request to this URL counts against."""
+    if url.rstrip('/').endswith('/graphql'):
+        return 'graphql'
+    if '/search/' in url:
+        return 'search'
+    return 'core'
+
+
+class Tenant:
+    """One of several repositories sharing a `RateLimitScheduler`.
+
+    Parameters
+    ----------
+    name : str
+        Repository in the format of ``org/repo``.
+
+    quota : dict
+        Most requests counted against each rate limit resource.
+        Resources not listed are not limited.
+
+    """
+    def __init__(self, name, quota):
+        self.name = name
+        self.quota = dict(quota)
+        self.used = {}
+        self.in_flight = 0
+
+    def exhausted(self):
+        """Whether this tenant used up its share of any rate limit budget."""
+        return any(self.used.get(resource, 0) >= quota for resource, quota in self.quota.items())
+
+    def summary(self):
+        return f'{self.name}: ' + ', '.join(
+            f'{resource} {self.used.get(resource, 0)} of {quota:.0f}'
+            for resource, quota in sorted(self.quota.items()))
+
+
+def over_budget():
+    """Whether the tenant of the current context used up its share, or the
+    scheduler of the current context is down to its write reserve."""
+    tenant = current_tenant.get()
+    scheduler = current_scheduler.get()
+    return ((tenant is not None and tenant.exhausted()) or
+            (scheduler is not None and scheduler.reads_exhausted()))
+
+
+def within_budget(items):
+    """Iterate over ``items`` until `over_budget`."""
+    for item in items:
+        if over_budget():
+            tenant = current_tenant.get()
+            print(f'Stopping early, {tenant.name if tenant else "the run"} used up its share '
+                  'of the rate limit')
+            return
+        yield item
+
+
+class RateLimitScheduler:
+    """Admission control for GitHub requests, shared by all threads.
+
+    Parameters
+    ----------
+    max_concurrency : int
+        Most requests in flight at the same time.
+
+    write_reserve : float
+        Fraction of each rate limit budget that only writes may use.
+
+    min_write_interval : float
+        Seconds between the start of two writes. GitHub asks for at least
+        one second to stay clear of the secondary rate limit.
+
+    max_retries : int
+        How many times one request is sent again after being pushed back.
+
+    """
+    def __init__(self, max_concurrency=1, write_reserve=0.1, min_write_interval=1,
+                 max_retries=5):
+        self.max_concurrency = max(1, max_concurrency)
+        self.write_reserve = write_reserve
+        self.min_write_interval = min_write_interval
+        self.max_retries = max_retries
+        self._window = float(self.max_concurrency)
+        self._write_interval = min_write_interval
+        self._in_flight = 0
+        self._blocked_until = 0
+        self._last_write = 0
+        self._budgets = {}
+        self._tenants = []
+        self._cond = threading.Condition()
+        self.requests = 0
+        self.pushbacks = 0
+        self.waited = 0
+
+    @property
+    def concurrency(self):
+        """Requests currently allowed in flight."""
+        return max(1, int(self._window))
+
+    def add_tenants(self, names, remaining):
+        """Split what is left of each rate limit budget equally between repositories.
+
+        Parameters
+        ----------
+        names : list of str
+            Repositories that will share this scheduler.
+
+        remaining : dict
+            Requests left for each rate limit resource, before the write reserve.
+
+        Returns
+        -------
+        tenants : list of `Tenant`
+            Set one as `current_tenant` while working on its repository, and
+            pass it to `finish_tenant` when done.
+
+        """
+        with self._cond:
+            shares = {resource: left * (1 - self.write_reserve) / max(1, len(names))
+                      for resource, left in remaining.items()}
+            tenants = [Tenant(name, shares) for name in names]
+            self._tenants.extend(tenants)
+            return tenants
+
+    def finish_tenant(self, tenant):
+        """Hand the unused share of a finished tenant to the others."""
+        with self._cond:
+            self._tenants.remove(tenant)
+            for resource, quota in tenant.quota.items():
+                left = max(0, quota - tenant.used.get(resource, 0))
+                for other in self._tenants:
+                    other.quota[resource] += left / len(self._tenants)
+            self._cond.notify_all()
+
+    def _tenant_share(self):
+        """Requests in flight allowed for each tenant."""
+        return max(1, self.concurrency // max(1, len(self._tenants)))
+
+    def reads_exhausted(self):
+        """Whether a budget items are read from is down to the write reserve until its reset."""
+        now = time.time()
+        with self._cond:
+            return any(budget['reset'] > now and
+                       budget['remaining'] <= int(budget['limit'] * self.write_reserve)
+                       for resource, budget in self._budgets.items()
+                       if resource in READ_RESOURCES)
+
+    def _wait_time(self, resource, is_write, now):
+        if self._blocked_until > now:
+            return self._blocked_until - now
+        if is_write and self._last_write + self._write_interval > now:
+            return self._last_write + self._write_interval - now
+        return 0
+
+    def acquire(self, resource, is_write):
+        """Block until a request may be sent."""
+        tenant = current_tenant.get()
+        with self._cond:
+            while True:
+                now = time.time()
+                wait = self._wait_time(resource, is_write, now)
+                if (wait <= 0 and self._in_flight < self.concurrency and
+                        (tenant is None or tenant.in_flight < self._tenant_share())):
+                    break
+                start = time.time()
+                self._cond.wait(timeout=wait if wait > 0 else None)
+                self.waited += time.time() - start
+            self._in_flight += 1
+            if tenant is not None:
+                tenant.in_flight += 1
+            self.requests += 1
+            if is_write:
+                self._last_write = now
+
+    def release(self, resource, is_write, response):
+        """Learn from a response. Returns `True` if the request must be sent again."""
+        tenant = current_tenant.get()
+        with self._cond:
+            self._in_flight -= 1
+            if tenant is not None:
+                tenant.in_flight -= 1
+            retry = False
+            if response is not None:
+                self._update_budget(resource, response.headers)
+                retry = self._is_pushback(response)
+                # GitHub does not count a 304 against the rate limit.
+                if tenant is not None and response.status_code != 304:
+                    tenant.used[resource] = tenant.used.get(resource, 0) + 1
+                if retry:
+                    self._back_off(response.headers)
+                else:
+                    # Additive increase: one more slot per window of successes.
+                    self._window = min(self.max_concurrency, self._window + 1 / self._window)
+                    if is_write:
+                        self._write_interval = max(self.min_write_interval,
+                                                   self._write_interval - 0.5)
+            self._cond.notify_all()
+            return retry
+
+    def _update_budget(self, resource, headers):
+        try:
+            self._budgets[headers.get('X-RateLimit-Resource', resource)] = {
+                'limit': int(headers['X-RateLimit-Limit']),
+                'remaining': int(headers['X-RateLimit-Remaining']),
+                'reset': int(headers['X-RateLimit-Reset'])}
+        except (KeyError, ValueError):
+            pass
+
+    @staticmethod
+    def _is_pushback(response):
+        """Whether GitHub asks to wait a little and send the request again."""
+        if response.status_code not in (403, 429):
+            return False
+        if 'Retry-After' in response.headers:
+            return True
+        if response.headers.get('X-RateLimit-Remaining') == '0':
+            return False  # Primary budget spent until its reset, see over_budget.
+        return response.status_code == 429 or 'rate limit' in response.text.lower()
+
+    def _back_off(self, headers):
+        now = time.time()
+        self.pushbacks += 1
+        if 'Retry-After' in headers:
+            delay = float(headers['Retry-After'])
+        else:
+            # Secondary rate limit without instructions: GitHub suggests a minute.
+            delay = 60
+        self._blocked_until = max(self._blocked_until, now + delay)
+        # Multiplicative decrease.
+        self._window = max(1.0, self._window / 2)
+        self._write_interval = max(self._write_interval * 2, 1)
+
+    def summary(self):
+        budgets = ', '.join(f'{name} {b["remaining"]}/{b["limit"]} left'
+                            for name, b in sorted(self._budgets.items()))
+        return (f'Rate limit: {self.requests} requests, {self.pushbacks} pushed back, '
+                f'waited {self.waited:.1f}s' + (f', {budgets}' if budgets else ''))
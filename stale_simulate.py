@@ -0,0 +1,453 @@
+"""Simulate the stale policy over the coming days, offline, from a snapshot.
+
+Before changing thresholds like ``STALEBOT_WARN_PR_SECONDS`` or
+``STALEBOT_CLOSE_ISSUE_SECONDS``, this tells how many PRs and issues would be
+marked as stale, warned and closed on each day under the current and the
+proposed values, without touching GitHub.
+
+A snapshot holds, for every open PR and every open issue labeled as stale,
+what `~stale_pull_requests.plan_one_pr` and `~stale_issues.plan_one_issue`
+decide on: labels, last commit, when the stale label was added and when
+the latest warning was left. The simulation runs the bot once a day from
+when the snapshot was taken, assuming nobody else touches the items, and
+applies its own changes to the state it carries over. All items, and all
+thresholds asked for, are checked at once as NumPy arrays, so thousands of
+items over months take about a second.
+
+Usage::
+
+    python stale_simulate.py snapshot <file> [org/repo]
+    python stale_simulate.py run <file> [--days 90] [--warn-pr-seconds 12960000 7776000] [--check]
+
+``snapshot`` fetches the open PRs and issues of the repository of the event,
+or the one given, with GraphQL. ``run`` takes the thresholds, and labels,
+from the ``STALEBOT_*`` variables unless given, see ``--help``. ``--check``
+also runs the planning functions of the bot on every item for every day
+and policy, and fails if they decide on anything else.
+
+NumPy is only needed for ``run`` and is not part of the action image.
+
+"""
+import argparse
+import contextlib
+import functools
+import io
+import itertools
+import json
+import math
+import sys
+from datetime import datetime, timezone
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import stale_issues
+import stale_pull_requests
+from stale_core import parse_time
+from stale_fetch import IssueFacts, PullRequestFacts, fetch_issues, fetch_pull_requests
+from stale_snapshot import OUTCOMES, outcomes, read_items
+
+SNAPSHOT_VERSION = 1
+
+DAY = 86400
+
+
+def _isoformat(t):
+    if t is None:
+        return None
+    return t.astimezone(timezone.utc).isoformat()
+
+
+def _latest(times):
+    return max(times, key=lambda t: t.timestamp(), default=None)
+
+
+def snapshot_item(facts):
+    """What the policy depends on for one item, from its `~stale_fetch.PullRequestFacts`
+    or `~stale_fetch.IssueFacts`, as a dict that can go in JSON."""
+    item = {'number': facts.number, 'labels': list(facts.labels),
+            'updated_at': _isoformat(facts.updated_at),
+            'stale_labeled': _isoformat(_latest(t for t, _ in facts.stale_labeled)),
+            'warned': _isoformat(_latest(facts.warnings))}
+    if isinstance(facts, PullRequestFacts):
+        item['last_committed'] = _isoformat(facts.last_committed)
+    return item
+
+
+def take_snapshot(g, repository, stale_label='Close?', keep_open_label='keep-open',
+                  page_size=25, taken_at=None):
+    """Fetch what the policy depends on for all open PRs, and open issues labeled as stale.
+
+    Parameters
+    ----------
+    g : obj
+        PyGithub Github instance.
+
+    repository : str
+        Repository in the format of ``org/repo`` or ``user/repo``.
+
+    page_size : int
+        Number of issues or PRs per GraphQL query.
+
+    taken_at : datetime or `None`
+        When the snapshot is taken. Now by default.
+
+    Returns
+    -------
+    snapshot : dict
+        Can be written with :func:`save_snapshot`.
+
+    """
+    if taken_at is None:
+        taken_at = datetime.now(timezone.utc)
+    pulls = fetch_pull_requests(g, repository, stale_label,
+                                stale_pull_requests.is_close_warning, page_size=page_size)
+    issues = fetch_issues(g, repository, stale_label,
+                          functools.partial(stale_issues.is_close_warning,
+                                            stale_label=stale_label),
+                          page_size=page_size)
+    return {'version': SNAPSHOT_VERSION, 'repository': repository,
+            'taken_at': _isoformat(taken_at), 'stale_label': stale_label,
+            'keep_open_label': keep_open_label,
+            'pulls': [snapshot_item(facts) for facts in pulls],
+            'issues': [snapshot_item(facts) for facts in issues if not facts.is_pull_request]}
+
+
+def save_snapshot(snapshot, path):
+    with open(path, 'w', encoding='utf-8') as fout:
+        json.dump(snapshot, fout)
+
+
+def load_snapshot(path, repository=None):
+    """Read a snapshot written by :func:`save_snapshot`, or a SQLite one
+    written by the bot with ``STALEBOT_SNAPSHOT_FILE`` (see `stale_snapshot`).
+    ``repository`` says which one to read from a SQLite file holding several."""
+    with open(path, 'rb') as fin:
+        is_sqlite = fin.read(16) == b'SQLite format 3\x00'
+    if is_sqlite:
+        return read_items(path, repository)
+    with open(path, encoding='utf-8') as fin:
+        snapshot = json.load(fin)
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        raise ValueError(f'{path} is not a snapshot this version can read')
+    return snapshot
+
+
+class Population:
+    """State of all simulated items of one kind, under several policies at once.
+
+    Times are in seconds, and arrays that change from run to run have one
+    row per policy and one column per item.
+
+    Attributes
+    ----------
+    numbers : array of int
+        Item numbers.
+
+    keep_open : array of bool
+        Whether each item has the label that keeps it open.
+
+    last_committed : array of float
+        Time of the last commit of each PR, NaN if not known.
+
+    stale : array of bool
+        Whether each item has the stale label.
+
+    labeled : array of float
+        When the stale label was last added, NaN if not known.
+
+    warned : array of float
+        When the latest warning was left, 0 if never.
+
+    open : array of bool
+        Whether each item is still open.
+
+    """
+    def __init__(self, items, stale_label, keep_open_label, policies=1):
+        if np is None:
+            raise ImportError('The simulator needs NumPy: pip install numpy')
+
+        def times(key):
+            return np.array([_seconds(item.get(key)) for item in items], dtype=float)
+
+        self.numbers = np.array([item['number'] for item in items], dtype=int)
+        self.keep_open = np.array([keep_open_label in item['labels'] for item in items],
+                                  dtype=bool)
+        self.last_committed = times('last_committed')
+        shape = (policies, len(items))
+        self.stale = np.broadcast_to(
+            np.array([stale_label in item['labels'] for item in items], dtype=bool),
+            shape).copy()
+        self.labeled = np.broadcast_to(times('stale_labeled'), shape).copy()
+        self.warned = np.broadcast_to(np.nan_to_num(times('warned'), nan=0), shape).copy()
+        self.open = np.ones(shape, dtype=bool)
+
+    def copy(self):
+        other = object.__new__(type(self))
+        other.__dict__.update({key: value.copy() for key, value in self.__dict__.items()})
+        return other
+
+
+def _seconds(value):
+    if value is None:
+        return math.nan
+    return float(round(parse_time(value).timestamp()))
+
+
+def step_pulls(prs, now, warn_seconds, close_seconds):
+    """One run of `~stale_pull_requests.plan_one_pr` over all PRs and policies.
+
+    ``warn_seconds`` and ``close_seconds`` have one value per policy. The
+    changes the bot makes are applied to ``prs``.
+
+    Returns
+    -------
+    outcomes : dict
+        Maps each of `OUTCOMES` to a boolean array, with one row per policy,
+        telling which PRs it happened to.
+
+    """
+    warn_seconds = np.asarray(warn_seconds, dtype=float)[:, None]
+    close_seconds = np.asarray(close_seconds, dtype=float)[:, None]
+    unlabel = prs.open & prs.keep_open & prs.stale
+    checked = prs.open & ~prs.keep_open & ~np.isnan(prs.last_committed)
+    inactive = now - prs.last_committed > warn_seconds
+    # A warning from before the label was added does not count.
+    labeled = checked & prs.stale & ~np.isnan(prs.labeled) & inactive
+    warned = prs.warned >= prs.labeled
+    close = labeled & warned & (now - prs.warned > close_seconds)
+    mark = checked & ~prs.stale & inactive
+    warn = (labeled & ~warned) | (mark & (prs.warned < prs.last_committed))
+
+    prs.stale[unlabel] = False
+    prs.stale[mark] = True
+    prs.labeled[mark] = now
+    prs.warned[warn] = now
+    prs.open[close] = False
+    return {'mark': mark, 'warn': warn, 'close': close, 'unlabel': unlabel}
+
+
+def step_issues(issues, now, warn_seconds, close_seconds):
+    """One run of `~stale_issues.plan_one_issue` over all issues and policies.
+
+    See :func:`step_pulls`. Issues are never marked as stale by the bot.
+
+    """
+    warn_seconds = np.asarray(warn_seconds, dtype=float)[:, None]
+    close_seconds = np.asarray(close_seconds, dtype=float)[:, None]
+    active = issues.open & issues.stale
+    unlabel = active & issues.keep_open
+    checked = active & ~issues.keep_open
+    # A stale label added at an unknown time counts as added long ago.
+    labeled = np.nan_to_num(issues.labeled, nan=0)
+    since_warned = np.where(issues.warned > 0, now - issues.warned, -1)
+    close = checked & (since_warned > close_seconds)
+    warn = checked & ~close & (since_warned < 0) & (now - labeled > warn_seconds)
+
+    issues.stale[unlabel] = False
+    issues.warned[warn] = now
+    issues.open[close] = False
+    return {'mark': np.zeros_like(warn), 'warn': warn, 'close': close, 'unlabel': unlabel}
+
+
+def _datetime(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc)
+
+
+def _facts(population, policy, i, stale_label, keep_open_label, pulls):
+    """Facts of one simulated item, as the bot would fetch them."""
+    labels = []
+    if population.keep_open[i]:
+        labels.append(keep_open_label)
+    if population.stale[policy, i]:
+        labels.append(stale_label)
+    warned = population.warned[policy, i]
+    warnings = [_datetime(warned)] if warned > 0 else []
+    labeled = population.labeled[policy, i]
+    stale_labeled = [] if np.isnan(labeled) else [(_datetime(labeled), 'someone')]
+    number = int(population.numbers[i])
+    if pulls:
+        committed = population.last_committed[i]
+        committed = None if np.isnan(committed) else _datetime(committed)
+        return PullRequestFacts(number, labels, last_committed=committed,
+                                warnings=warnings, stale_labeled=stale_labeled)
+    return IssueFacts(number, labels, warnings=warnings, stale_labeled=stale_labeled)
+
+
+def check_step(population, happened, now, warn_seconds, close_seconds, stale_label,
+               keep_open_label, pulls=True):
+    """Compare one simulated run with what the planning functions of the bot decide.
+
+    ``population`` is the state before the run and ``happened`` what
+    :func:`step_pulls` or :func:`step_issues` returned for it.
+
+    Returns
+    -------
+    mismatches : list of tuple
+        ``(policy, number, simulated, planned)`` for every item where the
+        two disagree, with sets of `OUTCOMES`.
+
+    """
+    plan_one = stale_pull_requests.plan_one_pr if pulls else stale_issues.plan_one_issue
+    mismatches = []
+    for policy, i in zip(*np.nonzero(population.open)):
+        facts = _facts(population, policy, i, stale_label, keep_open_label, pulls)
+        actions = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            plan_one(facts, now, warn_seconds[policy], close_seconds[policy], actions,
+                     stale_label=stale_label, keep_open_label=keep_open_label)
+        planned = outcomes(actions, stale_label)
+        simulated = {name for name in OUTCOMES if happened[name][policy, i]}
+        if planned != simulated:
+            mismatches.append((int(policy), facts.number, simulated, planned))
+    return mismatches
+
+
+def simulate(items, start, days, warn_seconds, close_seconds, stale_label='Close?',
+             keep_open_label='keep-open', pulls=True, interval=DAY, check=False):
+    """Run the bot on the given items once every ``interval`` seconds, under several policies.
+
+    Parameters
+    ----------
+    items : list of dict
+        PRs, or issues, as in a snapshot.
+
+    start : float
+        Time of the first run, in seconds.
+
+    days : int
+        Number of runs.
+
+    warn_seconds, close_seconds : list of float
+        Thresholds of each policy, like ``STALEBOT_WARN_PR_SECONDS`` and
+        ``STALEBOT_CLOSE_PR_SECONDS`` for PRs.
+
+    pulls : bool
+        Whether the items are PRs rather than issues.
+
+    check : bool
+        Also compare every decision with the planning functions of the bot.
+
+    Returns
+    -------
+    counts : dict
+        Maps each of `OUTCOMES` to an array with one row per policy and one
+        column per run, holding the number of items it happened to.
+
+    mismatches : list of tuple
+        ``(run, policy, number, simulated, planned)`` for every decision
+        the planning functions disagree with. Empty unless ``check``.
+
+    """
+    population = Population(items, stale_label, keep_open_label, policies=len(warn_seconds))
+    step = step_pulls if pulls else step_issues
+    counts = {name: np.zeros((len(warn_seconds), days), dtype=int) for name in OUTCOMES}
+    mismatches = []
+    for run in range(days):
+        now = start + run * interval
+        before = population.copy() if check else None
+        happened = step(population, now, warn_seconds, close_seconds)
+        for name in OUTCOMES:
+            counts[name][:, run] = happened[name].sum(axis=1)
+        if check:
+            mismatches.extend(
+                (run,) + mismatch for mismatch in check_step(
+                    before, happened, now, warn_seconds, close_seconds, stale_label,
+                    keep_open_label, pulls=pulls))
+    return counts, mismatches
+
+
+def _days(seconds):
+    return f'{seconds / DAY:g}d'
+
+
+def print_table(title, policies, counts, columns, start, daily=False, interval=DAY):
+    """Print the totals of each policy, and with ``daily`` the count for each run."""
+    print(f'\n{title}')
+    header = f'{"policy":<28}' + ''.join(f'{name:>10}' for name in columns)
+    print(header)
+    for p, policy in enumerate(policies):
+        label = ' '.join(f'{key}={_days(value)}' for key, value in policy.items())
+        print(f'{label:<28}' + ''.join(f'{counts[name][p].sum():>10}' for name in columns))
+        if daily:
+            for run in range(counts[columns[0]].shape[1]):
+                row = [counts[name][p, run] for name in columns]
+                if any(row):
+                    day = _datetime(start + run * interval).date().isoformat()
+                    print(f'  {day:<26}' + ''.join(f'{n:>10}' for n in row))
+
+
+def main(argv=None):
+    pr_options = stale_pull_requests.options_from_env()
+    issue_options = stale_issues.options_from_env()
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    take = commands.add_parser('snapshot', help='Fetch a snapshot from GitHub')
+    take.add_argument('file')
+    take.add_argument('repository', nargs='?',
+                      help='org/repo (default: the repository of the event)')
+    run = commands.add_parser('run', help='Simulate the policy on a snapshot')
+    run.add_argument('file')
+    run.add_argument('--repository', help='Which repository of a SQLite snapshot to simulate')
+    run.add_argument('--days', type=int, default=90, help='Number of daily runs (default: 90)')
+    run.add_argument('--start', help='Time of the first run (default: when the snapshot was taken)')
+    run.add_argument('--warn-pr-seconds', type=float, nargs='+',
+                     default=[pr_options['warn_seconds']])
+    run.add_argument('--close-pr-seconds', type=float, nargs='+',
+                     default=[pr_options['close_seconds']])
+    run.add_argument('--warn-issue-seconds', type=float, nargs='+',
+                     default=[issue_options['warn_seconds']])
+    run.add_argument('--close-issue-seconds', type=float, nargs='+',
+                     default=[issue_options['close_seconds']])
+    run.add_argument('--daily', action='store_true', help='Also print counts for each day')
+    run.add_argument('--check', action='store_true',
+                     help='Compare every decision with the planning functions of the bot')
+    args = parser.parse_args(argv)
+
+    if args.command == 'snapshot':
+        from stale_http import github_client
+        from stalebot import event_repository
+
+        repository = args.repository or event_repository()
+        if repository is None:
+            return 0
+        snapshot = take_snapshot(github_client(), repository,
+                                 stale_label=pr_options['stale_label'],
+                                 keep_open_label=pr_options['keep_open_label'],
+                                 page_size=pr_options['page_size'])
+        save_snapshot(snapshot, args.file)
+        print(f'Saved {len(snapshot["pulls"])} PRs and {len(snapshot["issues"])} issues '
+              f'of {repository} to {args.file}')
+        return 0
+
+    snapshot = load_snapshot(args.file, args.repository)
+    start = parse_time(args.start or snapshot['taken_at']).timestamp()
+    labels = dict(stale_label=snapshot['stale_label'],
+                  keep_open_label=snapshot['keep_open_label'])
+    print(f'Simulating {args.days} daily runs on {len(snapshot["pulls"])} PRs and '
+          f'{len(snapshot["issues"])} issues of {snapshot["repository"]} '
+          f'from {_datetime(start).isoformat()}')
+    failed = False
+    for pulls, warn, close, columns in (
+            (True, args.warn_pr_seconds, args.close_pr_seconds, ('mark', 'warn', 'close')),
+            (False, args.warn_issue_seconds, args.close_issue_seconds, ('warn', 'close'))):
+        policies = [{'warn': w, 'close': c} for w, c in itertools.product(warn, close)]
+        counts, mismatches = simulate(
+            snapshot['pulls' if pulls else 'issues'], start, args.days,
+            [p['warn'] for p in policies], [p['close'] for p in policies],
+            pulls=pulls, check=args.check, **labels)
+        print_table('PRs' if pulls else 'Issues', policies, counts, columns, start,
+                    daily=args.daily)
+        for run_index, policy, number, simulated, planned in mismatches[:20]:
+            print(f'MISMATCH run {run_index} policy {policy} #{number}: '
+                  f'simulated {sorted(simulated)}, planned {sorted(planned)}')
+        if args.check:
+            print(f'Checked against the bot: {len(mismatches)} mismatches')
+        failed = failed or bool(mismatches)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
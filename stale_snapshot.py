@@ -0,0 +1,382 @@
+"""Snapshot of what the bot knew and decided about each issue and PR, in SQLite.
+
+With ``STALEBOT_SNAPSHOT_FILE``, every item checked is written to a SQLite
+database as soon as it is decided on: its labels, last commit, when the
+stale label was last added and by whom, when it was last warned, what the
+bot decided and when it next needs attention. Rows are committed every
+``CHECKPOINT_EVERY`` items, so memory does not grow with the repository.
+
+Rows hold the state of an item once the changes decided on are made, like
+the simulation in ``stale_simulate.py`` applies them: labels added or
+removed, the stale label added and the warning left by the bot at the time
+of the run. Items the run closes keep their row, with ``close`` as decision,
+but are left out when it is read back.
+
+The snapshot is kept up to date across runs: an item checked again replaces
+its row, and a run that gets through all open items drops those that are no
+longer open. One file can hold several repositories.
+
+Only what the decision needed is fetched, so with the ``rest`` and ``async``
+engines some facts are left empty, like the last commit of a PR labeled
+``keep-open``. What is there is always enough to decide on the item again
+with the same labels.
+
+Usage::
+
+    python stale_snapshot.py <file> [org/repo]
+
+decides on every item of the snapshot still open again as of now, with the
+settings from the ``STALEBOT_*`` variables, without making any request.
+Changes are only logged and, with ``STALEBOT_PLAN_FILE``, written there to
+be applied later with ``python stale_plan.py``.
+
+"""
+import json
+import math
+import os
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+from stale_core import parse_time
+from stale_fetch import BOT_LOGINS, IssueFacts, PullRequestFacts, fetched, in_shard
+from stale_state import CHECKPOINT_EVERY
+
+SNAPSHOT_VERSION = 1
+
+# What a run can do to an item, in the order they are listed in ``decision``.
+OUTCOMES = ('mark', 'warn', 'close', 'unlabel')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    repository TEXT NOT NULL,
+    section TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    labels TEXT,
+    updated_at TEXT,
+    last_committed TEXT,
+    stale_labeled TEXT,
+    labeled_by TEXT,
+    warned TEXT,
+    decision TEXT,
+    deadline TEXT,
+    checked_at TEXT NOT NULL,
+    PRIMARY KEY (repository, section, number)
+);
+CREATE TABLE IF NOT EXISTS passes (
+    repository TEXT NOT NULL,
+    section TEXT NOT NULL,
+    checked_at TEXT NOT NULL,
+    stale_label TEXT NOT NULL,
+    keep_open_label TEXT NOT NULL,
+    PRIMARY KEY (repository, section)
+);
+"""
+
+
+def outcomes(actions, stale_label):
+    """Which of `OUTCOMES` planned actions amount to, as a set."""
+    kinds = {action.kind for action in actions}
+    found = set()
+    if 'close' in kinds:
+        found.add('close')
+    elif 'comment' in kinds:
+        found.add('warn')
+    for action in actions:
+        if action.label == stale_label:
+            found.add('mark' if action.kind == 'add_label' else 'unlabel')
+    return found
+
+
+def _labels_after(labels, actions):
+    labels = list(labels)
+    for action in actions:
+        if action.kind == 'add_label' and action.label not in labels:
+            labels.append(action.label)
+        elif action.kind == 'remove_label' and action.label in labels:
+            labels.remove(action.label)
+    return labels
+
+
+def _isoformat(t):
+    if t is None:
+        return None
+    return t.astimezone(timezone.utc).isoformat()
+
+
+def _connect(path):
+    # Several passes, or repositories, may write to the same file at once.
+    conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version not in (0, SNAPSHOT_VERSION):
+        conn.close()
+        raise ValueError(f'{path} is not a snapshot this version can read')
+    conn.executescript(_SCHEMA)
+    conn.execute(f'PRAGMA user_version = {SNAPSHOT_VERSION}')
+    return conn
+
+
+class SnapshotWriter:
+    """Write the items one pass checks to a snapshot, as they are checked.
+
+    Parameters
+    ----------
+    path : str
+        SQLite file. It does not have to exist yet.
+
+    repository : str
+        Repository in the format of ``org/repo`` or ``user/repo``.
+
+    section : {'pulls', 'issues'}
+        Which pass this is for.
+
+    started : float
+        When this run started, in seconds.
+
+    stale_label, keep_open_label : str
+        Labels the decisions were made with.
+
+    shard_index, shard_count : int
+        Which items this run is responsible for, see `stale_fetch.in_shard`.
+
+    """
+    def __init__(self, path, repository, section, started, stale_label='Close?',
+                 keep_open_label='keep-open', shard_index=0, shard_count=1):
+        self.path = path
+        self.repository = repository
+        self.section = section
+        self.stale_label = stale_label
+        self.keep_open_label = keep_open_label
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.started = datetime.fromtimestamp(started, timezone.utc)
+        self.checked_at = _isoformat(self.started)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._conn = _connect(path)
+
+    def record(self, facts, actions, deadline, error=False):
+        """Write what is known about an item, as the changes decided on leave it.
+
+        Parameters
+        ----------
+        facts : `~stale_fetch.PullRequestFacts` or `~stale_fetch.IssueFacts`
+            Only the facts already fetched are written, nothing more is.
+
+        actions : list of `~stale_plan.Action`
+            Changes planned for the item.
+
+        deadline : float or `None`
+            As returned by `~stale_pull_requests.plan_one_pr`.
+
+        error : bool
+            Whether checking the item failed.
+
+        """
+        known = fetched(facts)
+        if known.get('is_pull_request'):
+            return  # Checked with the issues, but not one of them.
+        stale_labeled = max(known.get('stale_labeled') or [], default=(None, None),
+                            key=lambda event: event[0].timestamp())
+        warned = max(known.get('warnings') or [], default=None, key=lambda t: t.timestamp())
+        labels = known.get('labels')
+        if error:
+            decision = 'error'
+        else:
+            found = outcomes(actions, self.stale_label)
+            decision = ','.join(name for name in OUTCOMES if name in found)
+            labels = _labels_after(labels, actions)
+            if 'mark' in found:
+                # Added with the token of the action.
+                stale_labeled = (self.started, BOT_LOGINS[0])
+            if 'warn' in found:
+                warned = self.started
+        if deadline is None:
+            deadline = self.checked_at
+        elif math.isinf(deadline):
+            deadline = None
+        else:
+            deadline = _isoformat(datetime.fromtimestamp(deadline, timezone.utc))
+        row = (self.repository, self.section, facts.number,
+               None if labels is None else json.dumps(list(labels)),
+               _isoformat(known.get('updated_at')), _isoformat(known.get('last_committed')),
+               _isoformat(stale_labeled[0]), stale_labeled[1], _isoformat(warned),
+               decision, deadline, self.checked_at)
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', row)
+            self._pending += 1
+            if self._pending >= CHECKPOINT_EVERY:
+                self._conn.commit()
+                self._pending = 0
+
+    def forget(self, number):
+        """Drop an item that is no longer open."""
+        with self._lock:
+            self._conn.execute(
+                'DELETE FROM items WHERE repository = ? AND section = ? AND number = ?',
+                (self.repository, self.section, number))
+
+    def close(self, swept=False):
+        """Commit what was written, and close the file.
+
+        With ``swept``, this run checked every open item it is responsible
+        for, so the others in the snapshot are no longer open and are dropped.
+
+        """
+        with self._lock:
+            conn = self._conn
+            if swept:
+                rows = conn.execute(
+                    'SELECT number FROM items WHERE repository = ? AND section = ? '
+                    'AND checked_at != ?', (self.repository, self.section, self.checked_at))
+                gone = [(self.repository, self.section, number) for number, in rows
+                        if in_shard(number, self.shard_index, self.shard_count)]
+                conn.executemany(
+                    'DELETE FROM items WHERE repository = ? AND section = ? AND number = ?',
+                    gone)
+            conn.execute('INSERT OR REPLACE INTO passes VALUES (?, ?, ?, ?, ?)',
+                         (self.repository, self.section, self.checked_at, self.stale_label,
+                          self.keep_open_label))
+            conn.commit()
+            conn.close()
+            self._pending = 0
+
+
+def _repository(conn, path, repository):
+    if repository is not None:
+        return repository
+    repositories = [r for r, in conn.execute('SELECT DISTINCT repository FROM passes')]
+    if len(repositories) != 1:
+        raise ValueError(f'{path} holds {len(repositories)} repositories, '
+                         f'say which one: {", ".join(sorted(repositories))}')
+    return repositories[0]
+
+
+def read_items(path, repository=None, closed=False):
+    """Read a snapshot back.
+
+    Parameters
+    ----------
+    path : str
+        SQLite file written by `SnapshotWriter`.
+
+    repository : str or `None`
+        Which repository to read. Can be left out if there is only one.
+
+    closed : bool
+        Whether to read the items closed by the run that checked them too.
+
+    Returns
+    -------
+    snapshot : dict
+        ``repository``, ``taken_at`` (the newest pass), ``stale_label`` and
+        ``keep_open_label``, and for ``pulls`` and ``issues`` a list of dicts
+        with ``number``, ``labels``, ``updated_at``, ``last_committed`` (PRs
+        only), ``stale_labeled``, ``labeled_by``, ``warned``, ``decision``,
+        ``deadline`` and ``checked_at``, in order of number. Times are ISO
+        8601 strings, as stored.
+
+    """
+    conn = _connect(path)
+    try:
+        repository = _repository(conn, path, repository)
+        snapshot = {'repository': repository, 'taken_at': None,
+                    'stale_label': None, 'keep_open_label': None}
+        for section, checked_at, stale_label, keep_open_label in conn.execute(
+                'SELECT section, checked_at, stale_label, keep_open_label FROM passes '
+                'WHERE repository = ? ORDER BY checked_at', (repository,)):
+            snapshot.update(taken_at=checked_at, stale_label=stale_label,
+                            keep_open_label=keep_open_label)
+        conn.row_factory = sqlite3.Row
+        for section in ('pulls', 'issues'):
+            items = []
+            for row in conn.execute(
+                    'SELECT * FROM items WHERE repository = ? AND section = ? ORDER BY number',
+                    (repository, section)):
+                item = dict(row)
+                del item['repository'], item['section']
+                if not closed and 'close' in (item['decision'] or '').split(','):
+                    continue
+                item['labels'] = json.loads(item['labels']) if item['labels'] else []
+                if section == 'issues':
+                    del item['last_committed']
+                items.append(item)
+            snapshot[section] = items
+    finally:
+        conn.close()
+    return snapshot
+
+
+def item_facts(item, pulls=True):
+    """`~stale_fetch.PullRequestFacts`, or `~stale_fetch.IssueFacts`, from a snapshot item."""
+    labeled = parse_time(item['stale_labeled'])
+    stale_labeled = [] if labeled is None else [(labeled, item['labeled_by'])]
+    warned = parse_time(item['warned'])
+    warnings = [] if warned is None else [warned]
+    updated_at = parse_time(item['updated_at'])
+    if pulls:
+        return PullRequestFacts(item['number'], item['labels'],
+                                last_committed=parse_time(item['last_committed']),
+                                warnings=warnings, stale_labeled=stale_labeled,
+                                updated_at=updated_at)
+    return IssueFacts(item['number'], item['labels'], warnings=warnings,
+                      stale_labeled=stale_labeled, updated_at=updated_at)
+
+
+def replay(snapshot, now, environ=None):
+    """Decide on the items of a snapshot again, without any request.
+
+    Parameters
+    ----------
+    snapshot : dict
+        As returned by `read_items`.
+
+    now : float
+        Time to decide as of, in seconds.
+
+    environ : dict or `None`
+        ``STALEBOT_*`` settings, by default from the environment.
+
+    Returns
+    -------
+    plans : dict
+        Planned `~stale_plan.Action` records for ``pulls`` and ``issues``.
+
+    """
+    # These import this module.
+    import stale_issues
+    import stale_pull_requests
+    from stale_priority import order_plan
+
+    plans = {}
+    for section, plan_one, options in (
+            ('pulls', stale_pull_requests.plan_one_pr,
+             stale_pull_requests.options_from_env(environ)),
+            ('issues', stale_issues.plan_one_issue, stale_issues.options_from_env(environ))):
+        plan = []
+        for item in snapshot[section]:
+            try:
+                plan_one(item_facts(item, pulls=section == 'pulls'), now,
+                         options['warn_seconds'], options['close_seconds'], plan,
+                         stale_label=options['stale_label'],
+                         keep_open_label=options['keep_open_label'],
+                         closed_by_bot_label=options['closed_by_bot_label'])
+            except Exception as e:
+                print(f'-> ERROR: {repr(e)}')
+        plans[section] = order_plan(plan, options['stale_label'])
+    return plans
+
+
+if __name__ == '__main__':
+    from stale_plan import save_plan
+
+    snapshot = read_items(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
+    plan_file = os.environ.get('STALEBOT_PLAN_FILE', '')
+    for plan_section, plan in replay(snapshot, time.time()).items():
+        print(f'Planned {len(plan)} {plan_section} changes for {snapshot["repository"]} '
+              f'from the snapshot of {snapshot["taken_at"]}, not applied')
+        if plan_file:
+            save_plan(plan_file, plan_section, snapshot['repository'], plan)
@@ -0,0 +1,206 @@
+"""State kept between runs so that unchanged items need not be fetched again.
+
+For every issue or PR checked, the state file records when it was last
+updated and when something next needs to happen to it (warning, closing,
+marking as stale). As long as an item is not updated, nothing about it can
+change before that deadline, so a later run can skip it.
+
+It also records where a run that did not get through all items stopped, so
+that the next one starts from there. Progress is saved every
+``CHECKPOINT_EVERY`` items, in case a run gets killed.
+
+A long-running worker keeps the index in memory between runs instead, with
+or without a file (see `stale_worker`).
+
+"""
+import json
+import math
+import os
+import threading
+from datetime import datetime, timezone
+
+STATE_VERSION = 1
+
+CHECKPOINT_EVERY = 100
+
+
+def policy_for(warn_seconds, close_seconds, stale_label, keep_open_label, shard_index=0,
+               shard_count=1, history_days=0):
+    """Everything the deadlines of a pass depend on, for `DeadlineIndex`."""
+    policy = {'warn_seconds': warn_seconds, 'close_seconds': close_seconds,
+              'stale_label': stale_label, 'keep_open_label': keep_open_label}
+    if shard_count > 1:
+        policy['shard'] = [shard_index, shard_count]
+    if history_days > 0:
+        # How far back label events and warnings are looked for.
+        policy['history_days'] = history_days
+    return policy
+
+
+class DeadlineIndex:
+    """Next-action deadline of each issue or PR, persisted in a JSON file.
+
+    The same file holds one section per pass (``'pulls'`` and ``'issues'``).
+
+    Parameters
+    ----------
+    path : str or `None`
+        State file. It does not have to exist yet. With `None`, the index
+        is only kept in memory.
+
+    section : str
+        Which pass this index is for.
+
+    policy : dict
+        Everything the deadlines depend on, like thresholds and labels.
+        If it changed since the index was saved, the index is not usable.
+
+    """
+    def __init__(self, path, section, policy):
+        self.path = path
+        self.section = section
+        self.policy = policy
+        self._lock = threading.Lock()
+        data = {}
+        if path is not None:
+            try:
+                with open(path, encoding='utf-8') as fin:
+                    data = json.load(fin)
+            except (OSError, ValueError):
+                pass
+        if data.get('version') != STATE_VERSION:
+            data = {}
+        self._data = data
+        saved = data.get(section, {})
+        self.last_run = saved.get('last_run')
+        self.items = saved.get('items', {})
+        # Number of the last item checked by a run cut short, if any.
+        self.cursor = saved.get('cursor')
+        # Only a complete scan under the same policy can be trusted.
+        self.usable = (saved.get('policy') == policy and saved.get('complete', False) and
+                       self.last_run is not None)
+
+    @property
+    def last_run_time(self):
+        """When the previous run started, as an aware datetime."""
+        return datetime.fromtimestamp(self.last_run, timezone.utc)
+
+    def todo(self, changed, now):
+        """Numbers of items to check in an incremental run.
+
+        Parameters
+        ----------
+        changed : iterable
+            ``(number, updated_at)`` for items updated since the last run.
+
+        now : float
+            Time now in seconds.
+
+        Returns
+        -------
+        numbers : list of int
+            Items that changed or whose deadline has passed, in order.
+
+        """
+        numbers = set()
+        for number, updated_at in changed:
+            entry = self.items.get(str(number))
+            if entry is None or entry['updated_at'] != _isoformat(updated_at):
+                numbers.add(number)
+        for key, entry in self.items.items():
+            if entry['deadline'] is not None and entry['deadline'] <= now:
+                numbers.add(int(key))
+        return sorted(numbers)
+
+    def rotate(self, numbers):
+        """Put the numbers after the cursor first, keeping their order otherwise.
+
+        This way, runs that only check the first few take turns through all
+        items, wrapping around at the end. If the cursor is no longer among
+        them, those with a larger number come first.
+
+        """
+        numbers = list(numbers)
+        if self.cursor is None:
+            return numbers
+        if self.cursor in numbers:
+            start = numbers.index(self.cursor) + 1
+            return numbers[start:] + numbers[:start]
+        return ([n for n in numbers if n > self.cursor] +
+                [n for n in numbers if n <= self.cursor])
+
+    def record(self, number, updated_at, deadline, labels=None):
+        """Remember when the given item needs to be checked again.
+
+        ``deadline`` is in seconds; `None` means on the next run and
+        ``math.inf`` means only once the item is updated. ``labels`` are
+        kept to tell how urgent the item is when it comes due.
+
+        """
+        if deadline is None:
+            deadline = 0
+        elif math.isinf(deadline):
+            deadline = None
+        entry = {'updated_at': _isoformat(updated_at), 'deadline': deadline}
+        if labels is not None:
+            entry['labels'] = list(labels)
+        with self._lock:
+            self.items[str(number)] = entry
+
+    def mark_due(self, number):
+        """Have the given item checked on the next run, keeping what is known about it."""
+        with self._lock:
+            self.items.setdefault(str(number), {'updated_at': None})['deadline'] = 0
+
+    def forget(self, number):
+        """Drop an item that is no longer open."""
+        with self._lock:
+            self.items.pop(str(number), None)
+
+    def reset(self):
+        """Forget everything before a full scan, except the cursor."""
+        self.items = {}
+
+    def save(self, started, complete, due=()):
+        """Write the index back to its file, if any.
+
+        The index can then be used for the next run as it is.
+
+        Parameters
+        ----------
+        started : float
+            When this run started, in seconds. Next run looks for updates from then.
+
+        complete : bool
+            Whether every open item has been recorded, or the run was cut short.
+
+        due : iterable of int
+            Items to save as due on the next run, while keeping their deadline
+            in memory, like those with changes planned but not applied yet.
+
+        """
+        with self._lock:
+            items = self.items
+            due = [str(n) for n in due if str(n) in items]
+            if due:
+                items = dict(items)
+                for key in due:
+                    items[key] = dict(items[key], deadline=0)
+            self._data['version'] = STATE_VERSION
+            self._data[self.section] = {'policy': self.policy, 'last_run': started,
+                                        'complete': complete, 'cursor': self.cursor,
+                                        'items': items}
+            self.last_run = started
+            self.usable = complete and started is not None
+            if self.path is None:
+                return
+            tmpfile = f'{self.path}.tmp'
+            with open(tmpfile, 'w', encoding='utf-8') as fout:
+                json.dump(self._data, fout)
+            os.replace(tmpfile, self.path)
+
+
+def _isoformat(t):
+    if t is None:
+        return None
+    return t.astimezone(timezone.utc).isoformat()
@@ -0,0 +1,443 @@
+"""Record what each run asks of the GitHub API, and where its time goes.
+
+Every request the shared session sends is recorded with its endpoint,
+status, latency, page and size, and charged to the item being checked at
+the time, if any. Phases of a pass (listing items, fetching what is needed
+to check them, deciding, applying changes) are timed separately. At the end
+of a run, all of it is summarized in a JSON report, written to a file, with
+its main tables in the step summary of the GitHub Actions job, to find out
+which endpoints use up the rate limit and to compare runs.
+
+Runs split into shards each write their own report, which can be merged
+into one with::
+
+    python stale_telemetry.py merged.json report-0.json report-1.json ...
+
+"""
+import contextlib
+import json
+import math
+import os
+import re
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import parse_qs, urlparse
+
+REPORT_VERSION = 1
+
+LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000)
+ITEM_REQUEST_BUCKETS = (0, 1, 2, 5, 10, 20, 50)
+
+# How many of the most expensive items to list in the report, per pass.
+COSTLIEST_ITEMS = 10
+
+_OPERATION = re.compile(r'^\s*(query|mutation)\s+(\w+)')
+_SHA = re.compile(r'/[0-9a-f]{40}(?=/|$)')
+_NUMBER = re.compile(r'/\d+(?=/|$)')
+_LABEL = re.compile(r'/labels/[^/]+$')
+
+
+def endpoint_of(method, url, body=b''):
+    """Group requests by what they ask for, like ``GET /repos/{repo}/issues/{n}/comments``.
+
+    GraphQL requests are told apart by their operation name.
+
+    """
+    path = urlparse(url).path
+    if path.rstrip('/').endswith('/graphql'):
+        try:
+            match = _OPERATION.match(json.loads(body)['query'])
+        except (ValueError, KeyError, TypeError):
+            match = None
+        operation = match.group(2) if match else 'anonymous'
+        return f'{method} /graphql {operation}'
+    path = re.sub(r'^(.*?/repos)/[^/]+/[^/]+', r'\1/{repo}', path)
+    path = _LABEL.sub('/labels/{name}', _NUMBER.sub('/{n}', _SHA.sub('/{sha}', path)))
+    return f'{method} {path}'
+
+
+def _page_of(url):
+    try:
+        return int(parse_qs(urlparse(url).query).get('page', ['1'])[0])
+    except ValueError:
+        return 1
+
+
+def _histogram(values, edges):
+    """Count values up to each edge, and above the last one."""
+    labels = [f'<={edge}' for edge in edges] + [f'>{edges[-1]}']
+    counts = dict.fromkeys(labels, 0)
+    for value in values:
+        for edge, label in zip(edges, labels):
+            if value <= edge:
+                counts[label] += 1
+                break
+        else:
+            counts[labels[-1]] += 1
+    return counts
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(math.ceil(q * len(sorted_values))) - 1)]
+
+
+def _percentile_from_histogram(counts, edges, q, maximum):
+    """Upper edge of the bucket the ``q`` quantile falls in, at most ``maximum``."""
+    total = sum(counts.values())
+    seen = 0
+    for edge, count in zip(list(edges) + [maximum], counts.values()):
+        seen += count
+        if total and seen >= q * total:
+            return min(edge, maximum)
+    return maximum
+
+
+class Telemetry:
+    """Requests, phase timers and per-item cost of one run, shared by all threads.
+
+    Which phase and which item a request belongs to is tracked per thread, so
+    the workers checking items in parallel each charge their own item.
+
+    """
+    def __init__(self):
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._endpoints = {}
+        self._phases = {}
+        self._items = {}
+        self._rate_limits = {}
+        self.requests = 0
+        self.not_modified = 0
+        self.errors = 0
+        self.unattributed = 0
+        self.request_seconds = 0
+        self.bytes_down = 0
+
+    # Recording
+
+    def record(self, method, url, body, response, seconds, resource, item=None):
+        """Record one request sent. ``response`` is `None` if it could not be sent.
+
+        The request is charged to ``item``, ``(section, repository, number)``,
+        if given, else to the item the calling thread is checking, if any.
+
+        """
+        endpoint = endpoint_of(method.upper(), url, body)
+        status = response.status_code if response is not None else 'error'
+        size = len(response.content or b'') if response is not None else 0
+        headers = response.headers if response is not None else {}
+        local = self._local
+        frames = getattr(local, 'phases', None)
+        if item is None:
+            item = getattr(local, 'item', None)
+        with self._lock:
+            self.requests += 1
+            self.request_seconds += seconds
+            self.bytes_down += size
+            if status == 304:
+                self.not_modified += 1
+            elif status == 'error' or status >= 400:
+                self.errors += 1
+
+            stats = self._endpoints.setdefault(endpoint, {
+                'requests': 0, 'statuses': {}, 'latencies': [], 'bytes': 0, 'pages': 0,
+                'max_page': 1})
+            stats['requests'] += 1
+            stats['statuses'][str(status)] = stats['statuses'].get(str(status), 0) + 1
+            stats['latencies'].append(seconds)
+            stats['bytes'] += size
+            page = _page_of(url)
+            if page > 1:
+                stats['pages'] += 1
+                stats['max_page'] = max(stats['max_page'], page)
+
+            budget = self._rate_limits.setdefault(
+                headers.get('X-RateLimit-Resource', resource),
+                {'requests': 0, 'counted': 0, 'remaining': None, 'limit': None})
+            budget['requests'] += 1
+            # GitHub does not charge for a 304.
+            if status != 304 and status != 'error':
+                budget['counted'] += 1
+            if 'X-RateLimit-Remaining' in headers:
+                budget['remaining'] = int(headers['X-RateLimit-Remaining'])
+                budget['limit'] = int(headers.get('X-RateLimit-Limit', 0)) or None
+
+            if frames:
+                section, name, requests_as = frames[-1]['key']
+                phase = self._phase(section, requests_as or name)
+                phase['requests'] += 1
+                if requests_as:
+                    phase['seconds'] += seconds
+                    frames[-1]['diverted'] += seconds
+            if item is not None:
+                cost = self._items.setdefault(item, {'requests': 0, 'seconds': 0, 'bytes': 0})
+                cost['requests'] += 1
+                cost['seconds'] += seconds
+                cost['bytes'] += size
+            else:
+                self.unattributed += 1
+
+    def _phase(self, section, name):
+        return self._phases.setdefault(section, {}).setdefault(
+            name, {'seconds': 0, 'requests': 0})
+
+    @contextlib.contextmanager
+    def phase(self, section, name, requests_as=None):
+        """Time what happens inside as phase ``name`` of pass ``section``.
+
+        With ``requests_as``, the time spent in requests made inside counts
+        towards that phase instead. Time is summed over threads.
+
+        """
+        frames = self._local.__dict__.setdefault('phases', [])
+        frame = {'key': (section, name, requests_as), 'diverted': 0}
+        frames.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            frames.pop()
+            with self._lock:
+                phase = self._phase(section, name)
+                phase['seconds'] += elapsed - frame['diverted']
+
+    def timed(self, section, name, iterable):
+        """Iterate, counting the time to get each element as phase ``name``."""
+        iterator = iter(iterable)
+        while True:
+            with self.phase(section, name):
+                try:
+                    element = next(iterator)
+                except StopIteration:
+                    return
+            yield element
+
+    @contextlib.contextmanager
+    def item(self, section, repository, number):
+        """Charge the requests made inside to one issue or PR."""
+        self._local.item = (section, repository, number)
+        with self._lock:
+            self._items.setdefault(self._local.item, {'requests': 0, 'seconds': 0, 'bytes': 0})
+        try:
+            yield
+        finally:
+            self._local.item = None
+
+    # Reporting
+
+    def report(self, repository=None, shard=None):
+        """Everything recorded so far, as a JSON-serializable dict.
+
+        ``shard`` is ``(index, count)`` if the run only checked one shard.
+
+        """
+        with self._lock:
+            latencies = [t for stats in self._endpoints.values() for t in stats['latencies']]
+            endpoints = []
+            for endpoint, stats in self._endpoints.items():
+                ordered = sorted(stats['latencies'])
+                endpoints.append({
+                    'endpoint': endpoint, 'requests': stats['requests'],
+                    'statuses': dict(stats['statuses']), 'extra_pages': stats['pages'],
+                    'max_page': stats['max_page'], 'bytes': stats['bytes'],
+                    'seconds': round(sum(ordered), 3),
+                    'latency_ms': {q: round(_percentile(ordered, p) * 1000, 1)
+                                   for q, p in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99))},
+                    'latency_histogram_ms': _histogram([t * 1000 for t in ordered],
+                                                       LATENCY_BUCKETS_MS),
+                })
+                endpoints[-1]['latency_ms']['max'] = round(ordered[-1] * 1000, 1)
+            endpoints.sort(key=lambda e: (-e['requests'], e['endpoint']))
+
+            items = {}
+            for (section, repo, number), cost in self._items.items():
+                items.setdefault(section, []).append(dict(cost, repository=repo, number=number))
+            per_pass = {}
+            for section, costs in items.items():
+                costs.sort(key=lambda c: (-c['requests'], -c['seconds'], c['repository'],
+                                          c['number']))
+                total = sum(c['requests'] for c in costs)
+                per_pass[section] = {
+                    'count': len(costs), 'requests': total,
+                    'mean_requests': round(total / len(costs), 3),
+                    'requests_histogram': _histogram([c['requests'] for c in costs],
+                                                     ITEM_REQUEST_BUCKETS),
+                    'costliest': [dict(c, seconds=round(c['seconds'], 3))
+                                  for c in costs[:COSTLIEST_ITEMS]],
+                }
+
+            phases = {section: {name: {'seconds': round(p['seconds'], 3),
+                                       'requests': p['requests']}
+                                for name, p in named.items()}
+                      for section, named in self._phases.items()}
+
+            return {
+                'version': REPORT_VERSION,
+                'repository': repository,
+                'shards': [shard[0]] if shard else None,
+                'shard_count': shard[1] if shard else 1,
+                'started_at': datetime.fromtimestamp(self.started, timezone.utc).isoformat(),
+                'seconds': round(time.time() - self.started, 3),
+                'totals': {'requests': self.requests, 'not_modified': self.not_modified,
+                           'errors': self.errors, 'bytes_down': self.bytes_down,
+                           'request_seconds': round(self.request_seconds, 3),
+                           'unattributed_requests': self.unattributed},
+                'rate_limit': {name: dict(b) for name, b in sorted(self._rate_limits.items())},
+                'phases': phases,
+                'latency_histogram_ms': _histogram([t * 1000 for t in latencies],
+                                                   LATENCY_BUCKETS_MS),
+                'endpoints': endpoints,
+                'items': per_pass,
+            }
+
+    def summary(self):
+        return (f'API calls: {self.requests} requests, {self.not_modified} not modified, '
+                f'{self.errors} failed, {self.request_seconds:.1f}s waiting for responses')
+
+
+def markdown_report(report, max_endpoints=15):
+    """Render the tables of a report for the GitHub Actions step summary.
+
+    The full report is only written to the report file, as step summaries
+    are limited in size.
+
+    """
+    totals = report['totals']
+    title = f'## Stalebot run on {report["repository"]}' if report['repository'] \
+        else '## Stalebot run'
+    if report.get('shards'):
+        title += (f' (shard {", ".join(str(i + 1) for i in report["shards"])} '
+                  f'of {report["shard_count"]})')
+    lines = [title, '',
+             f'{totals["requests"]} requests ({totals["not_modified"]} not modified, '
+             f'{totals["errors"]} failed) in {report["seconds"]:.1f}s.', '',
+             '| Pass | Phase | Seconds | Requests |', '|---|---|---|---|']
+    for section, phases in report['phases'].items():
+        for name, phase in phases.items():
+            lines.append(f'| {section} | {name} | {phase["seconds"]:.2f} | {phase["requests"]} |')
+    lines += ['', '| Endpoint | Requests | Extra pages | p50 ms | p90 ms | KB |',
+              '|---|---|---|---|---|---|']
+    for e in report['endpoints'][:max_endpoints]:
+        lines.append(f'| `{e["endpoint"]}` | {e["requests"]} | {e["extra_pages"]} | '
+                     f'{e["latency_ms"]["p50"]} | {e["latency_ms"]["p90"]} | '
+                     f'{e["bytes"] / 1024:.1f} |')
+    lines += ['', '| Pass | Items | Requests per item |', '|---|---|---|']
+    for section, items in report['items'].items():
+        lines.append(f'| {section} | {items["count"]} | {items["mean_requests"]} |')
+    lines.append('')
+    return '\n'.join(lines)
+
+
+def merge_reports(reports):
+    """Combine the reports of runs split into shards, as if they were one run.
+
+    Counts add up. The wall time is that of the slowest shard, and the rate
+    limit left is the lowest seen. Latency percentiles per endpoint can only
+    be estimated from the merged histograms, so they are bucket edges.
+
+    """
+    reports = list(reports)
+    merged = {
+        'version': REPORT_VERSION,
+        'repository': ', '.join(dict.fromkeys(r['repository'] for r in reports
+                                              if r['repository'])) or None,
+        'shards': sorted(i for r in reports for i in (r.get('shards') or [])) or None,
+        'shard_count': max(r.get('shard_count', 1) for r in reports),
+        'started_at': min(r['started_at'] for r in reports),
+        'seconds': max(r['seconds'] for r in reports),
+        'totals': {}, 'rate_limit': {}, 'phases': {},
+        'latency_histogram_ms': {}, 'endpoints': [], 'items': {},
+    }
+
+    def add(into, counts):
+        for key, value in counts.items():
+            into[key] = into.get(key, 0) + value
+
+    endpoints = {}
+    items = {}
+    for report in reports:
+        add(merged['totals'], report['totals'])
+        add(merged['latency_histogram_ms'], report['latency_histogram_ms'])
+        for name, budget in report['rate_limit'].items():
+            into = merged['rate_limit'].setdefault(
+                name, {'requests': 0, 'counted': 0, 'remaining': None, 'limit': None})
+            add(into, {'requests': budget['requests'], 'counted': budget['counted']})
+            if budget['remaining'] is not None:
+                into['remaining'] = min(budget['remaining'], into['remaining']
+                                        if into['remaining'] is not None else math.inf)
+            into['limit'] = budget['limit'] or into['limit']
+        for section, phases in report['phases'].items():
+            for name, phase in phases.items():
+                add(merged['phases'].setdefault(section, {}).setdefault(
+                    name, {'seconds': 0, 'requests': 0}), phase)
+        for e in report['endpoints']:
+            into = endpoints.setdefault(e['endpoint'], {
+                'endpoint': e['endpoint'], 'requests': 0, 'statuses': {}, 'extra_pages': 0,
+                'max_page': 1, 'bytes': 0, 'seconds': 0, 'latency_ms': {'max': 0},
+                'latency_histogram_ms': {}})
+            add(into, {key: e[key] for key in ('requests', 'extra_pages', 'bytes', 'seconds')})
+            add(into['statuses'], e['statuses'])
+            add(into['latency_histogram_ms'], e['latency_histogram_ms'])
+            into['max_page'] = max(into['max_page'], e['max_page'])
+            into['latency_ms']['max'] = max(into['latency_ms']['max'], e['latency_ms']['max'])
+        for section, per_pass in report['items'].items():
+            into = items.setdefault(section, {'count': 0, 'requests': 0,
+                                              'requests_histogram': {}, 'costliest': []})
+            add(into, {'count': per_pass['count'], 'requests': per_pass['requests']})
+            add(into['requests_histogram'], per_pass['requests_histogram'])
+            into['costliest'] += per_pass['costliest']
+
+    merged['totals']['request_seconds'] = round(merged['totals'].get('request_seconds', 0), 3)
+    for phases in merged['phases'].values():
+        for phase in phases.values():
+            phase['seconds'] = round(phase['seconds'], 3)
+    for e in endpoints.values():
+        e['seconds'] = round(e['seconds'], 3)
+        maximum = e['latency_ms']['max']
+        e['latency_ms'] = dict(
+            {q: _percentile_from_histogram(e['latency_histogram_ms'], LATENCY_BUCKETS_MS, p,
+                                           maximum)
+             for q, p in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99))}, max=maximum)
+    merged['endpoints'] = sorted(endpoints.values(),
+                                 key=lambda e: (-e['requests'], e['endpoint']))
+    for section, per_pass in items.items():
+        per_pass['mean_requests'] = round(per_pass['requests'] / max(1, per_pass['count']), 3)
+        per_pass['costliest'] = sorted(
+            per_pass['costliest'], key=lambda c: (-c['requests'], -c['seconds'],
+                                                  c['repository'], c['number'])
+        )[:COSTLIEST_ITEMS]
+        merged['items'][section] = {key: per_pass[key] for key in (
+            'count', 'requests', 'mean_requests', 'requests_histogram', 'costliest')}
+    return merged
+
+
+def save_report(report, path=''):
+    """Write a report to ``path`` and to the step summary, if any."""
+    if path:
+        with open(path, 'w', encoding='utf-8') as fout:
+            json.dump(report, fout, indent=2)
+        print(f'Run report written to {path}')
+    step_summary = os.environ.get('GITHUB_STEP_SUMMARY')
+    if step_summary:
+        with open(step_summary, 'a', encoding='utf-8') as fout:
+            fout.write(markdown_report(report))
+    return report
+
+
+def write_report(telemetry, repository=None, path='', shard=None):
+    """Write the report of a run to ``path`` and to the step summary, if any."""
+    return save_report(telemetry.report(repository, shard=shard), path)
+
+
+if __name__ == '__main__':
+    shard_reports = []
+    for report_path in sys.argv[2:]:
+        with open(report_path, encoding='utf-8') as fin:
+            shard_reports.append(json.load(fin))
+    save_report(merge_reports(shard_reports), sys.argv[1])
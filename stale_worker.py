@@ -0,0 +1,317 @@
+"""Keep checking repositories from a long-running process.
+
+Each run of the action starts cold: the image is built, Python starts, new
+connections are opened and, unless a state file is restored from cache,
+every open item is fetched again. A `Worker` instead keeps the client, with
+its connection pool, HTTP cache and rate limit scheduler, and the deadline
+index of each repository and pass in memory. After its first sweep, each
+one only lists what changed since the previous sweep, and checks those and
+the items that came due (see `stale_state.DeadlineIndex`). Events about one
+issue or PR are checked as they come, in between sweeps.
+
+As a library::
+
+    worker = Worker(['astropy/astropy'])
+    worker.sweep()                                  # Check what changed or came due.
+    worker.submit('astropy/astropy', 'pulls', 123)  # Check this PR ...
+    worker.check_events()                           # ... now.
+    worker.run_forever(interval=3600)               # Both, until worker.stop().
+
+Usage::
+
+    python stale_worker.py [--interval 3600] [--port 8080]
+
+sweeps the repositories of ``STALEBOT_REPOSITORIES``, or else
+``GITHUB_REPOSITORY``, every ``--interval`` seconds, with the settings from
+the ``STALEBOT_*`` variables. With ``--port``, GitHub webhooks posted to
+that port are checked as they come (see `stalebot.ITEM_EVENTS`). Requests
+not signed with ``STALEBOT_WEBHOOK_SECRET``, the secret of the webhook, are
+turned away. Without a secret, the worker does not start unless
+``--insecure`` is given too, to take unsigned requests from anyone.
+
+After each sweep, the requests made since the previous one are summarized,
+and reported to ``STALEBOT_REPORT_FILE`` if set.
+
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from github import GithubException
+
+from stale_http import setup_client, shared_session
+from stale_parallel import map_in_order
+from stale_scheduler import current_scheduler
+from stale_state import DeadlineIndex, policy_for
+from stale_telemetry import Telemetry, write_report
+from stalebot import (DEFAULT_BOT_LOGIN, PASSES, expand_repositories, item_of_event,
+                      load_overrides, repository_environ)
+
+
+def token_login(g):
+    """Login of the account ``g`` makes its changes as, if it can look it up."""
+    try:
+        return g.get_user().login
+    except GithubException:
+        return DEFAULT_BOT_LOGIN  # Tokens of GitHub Apps cannot.
+
+
+class Worker:
+    """Check repositories again and again, keeping what is known about them in memory.
+
+    Parameters
+    ----------
+    repositories : list of str
+        Repositories like ``org/repo``, or wildcards like ``org/*``,
+        as in ``STALEBOT_REPOSITORIES``.
+
+    passes : tuple of str
+        Names of the passes to run, in order. See `stalebot.PASSES`.
+
+    environ : dict or `None`
+        ``STALEBOT_*`` variables to take the settings from, the environment
+        by default. With several repositories, ``STALEBOT_REPO_OVERRIDES``
+        applies as with `stalebot.run`. With ``STALEBOT_STATE_FILE``, the
+        indices are also saved there, so that a restarted worker picks up
+        where it was.
+
+    """
+    def __init__(self, repositories, passes=tuple(PASSES), environ=None):
+        self.environ = dict(os.environ if environ is None else environ)
+        self.passes = passes
+        first = PASSES[passes[0]][1](self.environ)
+        self.parallel_repos = max(1, int(self.environ.get('STALEBOT_PARALLEL_REPOS', '4')))
+        self.g, self.cache, self.scheduler, self.telemetry = setup_client(
+            workers=first['workers'] * self.parallel_repos, sleep=first['sleep'],
+            cache_dir=first['cache_dir'], cache_max_mb=first['cache_max_mb'])
+        self.report_file = first['report_file']
+        self.repositories = expand_repositories(self.g, repositories)
+        self.login = self.environ.get('STALEBOT_BOT_LOGIN') or token_login(self.g)
+        self._overrides = load_overrides(self.environ.get('STALEBOT_REPO_OVERRIDES', ''))
+        self._indices = {}
+        self._events = queue.Queue()
+        self._stopping = threading.Event()
+
+    def options(self, repository, name):
+        """Keyword arguments of pass ``name`` for the given repository."""
+        environ = self.environ
+        if len(self.repositories) > 1:
+            environ = repository_environ(repository, self._overrides, self.environ)
+        return PASSES[name][1](environ)
+
+    def check(self, repository, name, numbers=None):
+        """Run pass ``name`` on one repository, only on ``numbers`` if given."""
+        options = self.options(repository, name)
+        index = self._indices.get((repository, name))
+        if index is None:
+            index = self._indices[(repository, name)] = DeadlineIndex(
+                options['state_file'] or None, name, policy_for(
+                    options['warn_seconds'], options['close_seconds'], options['stale_label'],
+                    options['keep_open_label'], shard_index=options['shard_index'],
+                    shard_count=options['shard_count'], history_days=options['history_days']))
+        process, _ = PASSES[name]
+        # So that passes stop early when the rate limit runs low, whichever
+        # thread runs them, like the one of run_forever.
+        token = current_scheduler.set(self.scheduler)
+        try:
+            process(repository, g=self.g, telemetry=self.telemetry, numbers=numbers,
+                    index=index, **options)
+        except Exception as e:
+            print(f'-> ERROR checking {repository}: {repr(e)}')
+        finally:
+            current_scheduler.reset(token)
+
+    def sweep(self):
+        """Check all repositories, only what changed or came due after the first sweep."""
+        started = time.monotonic()
+
+        def check_repository(repository):
+            print(f'=== {repository}')
+            for name in self.passes:
+                self.check(repository, name)
+
+        for _ in map_in_order(check_repository, self.repositories, workers=self.parallel_repos):
+            pass
+        print(f'Swept {len(self.repositories)} repositories in '
+              f'{time.monotonic() - started:.1f} s')
+        self.report()
+
+    def report(self):
+        """Summarize the requests made since the previous report, and start over.
+
+        Otherwise the telemetry would keep every request of a worker that
+        runs for weeks. Written to ``STALEBOT_REPORT_FILE`` too, if set.
+
+        """
+        if self.cache is not None:
+            print(self.cache.summary())
+        print(self.scheduler.summary())
+        print(self.telemetry.summary())
+        write_report(self.telemetry, ', '.join(self.repositories), self.report_file)
+        # The session the requests go through records them, see stale_http.setup_client.
+        self.telemetry = shared_session().telemetry = Telemetry()
+
+    def submit(self, repository, name, number):
+        """Have issue or PR ``number`` of the given repository checked by pass ``name``.
+
+        It is checked by the next :meth:`check_events`. Safe to call from any thread.
+
+        """
+        self._events.put((repository, name, number))
+
+    def handle_event(self, event_name, event):
+        """Submit the item a GitHub event is about, if it needs checking again.
+
+        Returns whether it did, see `stalebot.item_of_event`.
+
+        """
+        item = item_of_event(event_name, event, own_login=self.login)
+        repository = event.get('repository', {}).get('full_name')
+        if item is None or repository not in self.repositories:
+            return False
+        self.submit(repository, *item)
+        return True
+
+    def check_events(self, timeout=0):
+        """Check the items submitted so far, all at once for each repository and pass.
+
+        Waits up to ``timeout`` seconds for one if there are none.
+
+        Returns
+        -------
+        count : int
+            Number of items submitted.
+
+        """
+        events = []
+        try:
+            events.append(self._events.get(timeout=timeout) if timeout > 0
+                          else self._events.get_nowait())
+            while True:
+                events.append(self._events.get_nowait())
+        except queue.Empty:
+            pass
+        targets = {}
+        for event in events:
+            if event is not None:  # Only wakes up the loop, see stop().
+                repository, name, number = event
+                targets.setdefault((repository, name), set()).add(number)
+        for (repository, name), numbers in targets.items():
+            print(f'=== {repository}')
+            self.check(repository, name, numbers=sorted(numbers))
+        return sum(len(numbers) for numbers in targets.values())
+
+    def run_forever(self, interval=3600):
+        """Sweep every ``interval`` seconds and check submitted items in between,
+        until :meth:`stop` is called."""
+        next_sweep = time.monotonic()
+        while not self._stopping.is_set():
+            wait = next_sweep - time.monotonic()
+            if wait <= 0:
+                self.sweep()
+                next_sweep = time.monotonic() + interval
+            else:
+                self.check_events(timeout=wait)
+
+    def stop(self):
+        """Have :meth:`run_forever` return, once done with what it is checking."""
+        self._stopping.set()
+        self._events.put(None)
+
+
+def serve_webhooks(worker, port, secret='', host='', insecure=False):
+    """Take GitHub webhooks on ``port``, in a thread, and submit their items to ``worker``.
+
+    Parameters
+    ----------
+    worker : `Worker`
+        Where the items go.
+
+    port : int
+        Port to listen on. With 0, any free one, see ``server_address``.
+
+    secret : str
+        Secret of the webhook. Requests not signed with it are turned away.
+
+    host : str
+        Address to listen on, all of them by default.
+
+    insecure : bool
+        Take unsigned requests, from anyone, if ``secret`` is empty.
+        Otherwise a secret is required.
+
+    Returns
+    -------
+    server : `http.server.ThreadingHTTPServer`
+        Call its ``shutdown`` method to stop it.
+
+    """
+    if not secret and not insecure:
+        raise ValueError('A webhook secret is needed to take webhooks, unless insecure')
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if secret:
+                signature = 'sha256=' + hmac.new(
+                    secret.encode(), body, hashlib.sha256).hexdigest()
+                if not hmac.compare_digest(signature,
+                                           self.headers.get('X-Hub-Signature-256', '')):
+                    self.send_response(401)
+                    self.end_headers()
+                    return
+            try:
+                event = json.loads(body)
+            except ValueError:
+                self.send_response(400)
+                self.end_headers()
+                return
+            accepted = worker.handle_event(self.headers.get('X-GitHub-Event', ''), event)
+            self.send_response(202 if accepted else 204)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass  # Items are logged when checked.
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--interval', type=float, default=3600,
+                        help='Seconds between sweeps (default: 3600)')
+    parser.add_argument('--port', type=int,
+                        help='Port to take GitHub webhooks on (default: none)')
+    parser.add_argument('--insecure', action='store_true',
+                        help='With --port, take webhooks that are not signed, '
+                             'if STALEBOT_WEBHOOK_SECRET is not set')
+    args = parser.parse_args(argv)
+    secret = os.environ.get('STALEBOT_WEBHOOK_SECRET', '')
+    if args.port is not None and not secret and not args.insecure:
+        parser.error('Set STALEBOT_WEBHOOK_SECRET to take webhooks, or pass --insecure')
+
+    patterns = os.environ.get('STALEBOT_REPOSITORIES', '').replace(',', ' ').split()
+    if not patterns:
+        if not os.environ.get('GITHUB_REPOSITORY'):
+            parser.error('Set STALEBOT_REPOSITORIES or GITHUB_REPOSITORY')
+        patterns = [os.environ['GITHUB_REPOSITORY']]
+    worker = Worker(patterns)
+    if args.port is not None:
+        server = serve_webhooks(worker, args.port, secret=secret, insecure=args.insecure)
+        print(f'Taking webhooks on port {server.server_address[1]}')
+    try:
+        worker.run_forever(args.interval)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+"""Check for stale pull requests, then stale issues, in one process.
+
+Both passes share one Github client, so also its keep-alive connections,
+HTTP cache and rate limit scheduler. There is no need to wait between them:
+the scheduler already holds requests back when GitHub asks for it.
+
+Usage::
+
+    python stalebot.py [--full] [pulls] [issues]
+
+Without ``pulls`` or ``issues``, both passes run. Options are taken from the
+``STALEBOT_*`` environment variables, see the README.
+
+On an event about one issue or PR (see ``ITEM_EVENTS``), like a push to a PR
+or a label removed from an issue, only that item is checked, with the same
+rules, which only takes a few requests.
+
+With ``STALEBOT_REPOSITORIES``, several repositories are checked in the same
+run instead of the one of the event, ``STALEBOT_PARALLEL_REPOS`` at a time.
+They share the client, and each gets an equal share of the rate limit left
+(see `stale_scheduler.Tenant`). ``STALEBOT_REPO_OVERRIDES`` can change the
+``STALEBOT_*`` variables for some of them.
+
+"""
+import fnmatch
+import json
+import os
+import sys
+
+from github import UnknownObjectException
+
+import stale_issues
+import stale_pull_requests
+from stale_http import setup_client
+from stale_parallel import map_in_order
+from stale_scheduler import current_tenant
+from stale_telemetry import write_report
+
+# Pass name: (function, its keyword arguments from the environment).
+PASSES = {
+    'pulls': (stale_pull_requests.process_pull_requests, stale_pull_requests.options_from_env),
+    'issues': (stale_issues.process_issues, stale_issues.options_from_env),
+}
+
+# This workflow only makes sense in these events.
+EVENTS = ('schedule', 'workflow_dispatch')
+
+# Events about one issue or PR, and their activity types after which it is
+# checked again. Others are no-ops.
+ITEM_EVENTS = {
+    'pull_request': ('synchronize', 'labeled', 'unlabeled', 'reopened'),
+    'pull_request_target': ('synchronize', 'labeled', 'unlabeled', 'reopened'),
+    'issues': ('labeled', 'unlabeled', 'reopened'),
+    'issue_comment': ('created', 'deleted'),
+}
+
+# Who changes made with the token of the workflow come from.
+DEFAULT_BOT_LOGIN = 'github-actions[bot]'
+
+# Files that would be shared by several repositories unless set for each.
+# Passes running at once would also wait on each other's snapshot writes.
+PER_REPOSITORY_FILES = ('STALEBOT_STATE_FILE', 'STALEBOT_PLAN_FILE', 'STALEBOT_SNAPSHOT_FILE')
+
+
+def _load_event():
+    event_jsonfile = os.environ.get('GITHUB_EVENT_PATH', None)
+    if event_jsonfile:
+        with open(event_jsonfile, encoding='utf-8') as fin:
+            return json.load(fin)
+    # Dummy values for testing only!
+    return {'repository': {'full_name': 'astropy/astropy'}}
+
+
+def event_repository():
+    """Repository to check, or `None` if there is nothing to do for this event."""
+    event_name = os.environ.get('GITHUB_EVENT_NAME', 'unknown')
+    if event_name not in EVENTS and event_item() is None:
+        print(f'No-op for {event_name}')
+        return None
+
+    event = _load_event()
+    if event_name == 'schedule':
+        return os.environ['GITHUB_REPOSITORY']
+    return event['repository']['full_name']
+
+
+def event_item():
+    """Pass name and number of the open issue or PR the current event is
+    about, see :func:`item_of_event`."""
+    event_name = os.environ.get('GITHUB_EVENT_NAME', 'unknown')
+    if event_name not in ITEM_EVENTS:
+        return None
+    return item_of_event(event_name, _load_event(),
+                         own_login=os.environ.get('STALEBOT_BOT_LOGIN') or DEFAULT_BOT_LOGIN)
+
+
+def item_of_event(event_name, event, own_login=DEFAULT_BOT_LOGIN):
+    """Pass name and number of the open issue or PR an event is about,
+    like ``('pulls', 123)``, or `None` if it is not about one that needs
+    checking again.
+
+    Parameters
+    ----------
+    event_name : str
+        Like ``GITHUB_EVENT_NAME``, or the ``X-GitHub-Event`` header of a webhook.
+
+    event : dict
+        Payload of the event.
+
+    own_login : str
+        Login the bot makes its changes as. Its own events are skipped, but
+        not those of other bots, like pushes from pre-commit.ci or Dependabot.
+
+    """
+    if event_name not in ITEM_EVENTS or event.get('action') not in ITEM_EVENTS[event_name]:
+        return None
+    # The changes the bot makes itself need no second look.
+    if event.get('sender', {}).get('login') == own_login:
+        return None
+    item = event.get('pull_request') or event.get('issue')
+    if item is None or item.get('state') != 'open':
+        return None
+    # Comments on a PR come with the issue side of it.
+    is_pull_request = 'pull_request' in event or 'pull_request' in item
+    return 'pulls' if is_pull_request else 'issues', item['number']
+
+
+def expand_repositories(g, patterns):
+    """Turn ``org/repo`` names and ``org/pattern*`` wildcards into repository names.
+
+    Wildcards match the repositories of an organization or user that are not
+    archived. Each repository is listed once, in the order first matched.
+
+    """
+    repositories = []
+    owners = {}
+    for pattern in patterns:
+        owner = pattern.split('/')[0]
+        if not any(c in pattern for c in '*?['):
+            matched = [pattern]
+        else:
+            if owner not in owners:
+                try:
+                    repos = list(g.get_organization(owner).get_repos())
+                except UnknownObjectException:  # Not an organization
+                    repos = list(g.get_user(owner).get_repos())
+                owners[owner] = [r.full_name for r in repos if not r.archived]
+            matched = [r for r in owners[owner] if fnmatch.fnmatch(r, pattern)]
+            if not matched:
+                print(f'No repository matches {pattern}')
+        repositories.extend(r for r in matched if r not in repositories)
+    return repositories
+
+
+def load_overrides(value):
+    """Parse ``STALEBOT_REPO_OVERRIDES``: a JSON object, or a JSON file with one.
+
+    It maps repository names, or wildcards, to the ``STALEBOT_*`` variables to
+    change for them, like ``{"astropy/*": {"STALEBOT_MAX_PRS": "50"}}``.
+
+    """
+    if not value.strip():
+        return {}
+    if not value.lstrip().startswith('{'):
+        with open(value, encoding='utf-8') as fin:
+            value = fin.read()
+    return json.loads(value)
+
+
+def repository_environ(repository, overrides, environ=None):
+    """The environment variables for one of several repositories checked in one run.
+
+    Overrides matching the repository apply in the order given, so later ones
+    win. Files in ``PER_REPOSITORY_FILES`` that are not overridden get the
+    repository in their name.
+
+    """
+    environ = dict(os.environ if environ is None else environ)
+    changed = {}
+    for pattern, variables in overrides.items():
+        if fnmatch.fnmatch(repository, pattern):
+            changed.update({key: str(value) for key, value in variables.items()})
+    environ.update(changed)
+    for key in PER_REPOSITORY_FILES:
+        if environ.get(key) and key not in changed:
+            root, ext = os.path.splitext(environ[key])
+            environ[key] = f'{root}.{repository.replace("/", ".")}{ext}'
+    return environ
+
+
+def run(passes=('pulls', 'issues'), argv=()):
+    """Run the given passes on the repository of the current event,
+    or on those in ``STALEBOT_REPOSITORIES``.
+
+    Parameters
+    ----------
+    passes : tuple of str
+        Names of the passes to run, in order. See ``PASSES``.
+
+    argv : list of str
+        Command line arguments. ``--full`` is the same as ``STALEBOT_FULL_SCAN=1``.
+
+    """
+    repository = event_repository()
+    if repository is None:
+        return
+    patterns = os.environ.get('STALEBOT_REPOSITORIES', '').replace(',', ' ').split()
+    item = event_item()
+    if item is not None:
+        name, number = item
+        passes = tuple(p for p in passes if p == name)
+        patterns = []  # Only the repository of the event is concerned.
+        print(f'Checking {"PR" if name == "pulls" else "issue"} {number} of {repository} '
+              f'after {os.environ["GITHUB_EVENT_NAME"]}')
+        if not passes:
+            return
+
+    def options_for(name, environ=None):
+        options = PASSES[name][1](environ)
+        if '--full' in argv:
+            options['full_scan'] = True
+        if item is not None:
+            options['numbers'] = [item[1]]
+        return options
+
+    # Client settings are the same for all passes and all repositories.
+    first = options_for(passes[0])
+    parallel_repos = max(1, int(os.environ.get('STALEBOT_PARALLEL_REPOS', '4')))
+    g, cache, scheduler, telemetry = setup_client(
+        workers=first['workers'] * (parallel_repos if patterns else 1), sleep=first['sleep'],
+        cache_dir=first['cache_dir'], cache_max_mb=first['cache_max_mb'])
+
+    if not patterns:
+        for name in passes:
+            process, _ = PASSES[name]
+            process(repository, g=g, telemetry=telemetry, **options_for(name))
+    else:
+        repositories = expand_repositories(g, patterns)
+        overrides = load_overrides(os.environ.get('STALEBOT_REPO_OVERRIDES', ''))
+        limits = g.get_rate_limit().resources
+        tenants = scheduler.add_tenants(repositories, {'core': limits.core.remaining,
+                                                       'graphql': limits.graphql.remaining})
+        print(f'Checking {len(repositories)} repositories, {parallel_repos} at a time')
+
+        def check_repository(tenant):
+            token = current_tenant.set(tenant)
+            environ = repository_environ(tenant.name, overrides)
+            print(f'=== {tenant.name}')
+            try:
+                for name in passes:
+                    process, _ = PASSES[name]
+                    process(tenant.name, g=g, telemetry=telemetry, **options_for(name, environ))
+            except Exception as e:
+                print(f'-> ERROR checking {tenant.name}: {repr(e)}')
+            finally:
+                scheduler.finish_tenant(tenant)
+                current_tenant.reset(token)
+            print(tenant.summary())
+
+        for _ in map_in_order(check_repository, tenants, workers=parallel_repos):
+            pass
+        repository = ', '.join(repositories)
+
+    if cache is not None:
+        print(cache.summary())
+    print(scheduler.summary())
+    print(telemetry.summary())
+    shard = (first['shard_index'], first['shard_count']) if first['shard_count'] > 1 else None
+    write_report(telemetry, repository, first['report_file'], shard=shard)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    run(passes=tuple(arg for arg in args if arg in PASSES) or tuple(PASSES), argv=args)
@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'benchmarks')]
+
+from fake_github import FakeGitHub  # noqa: E402
+
+
+@pytest.fixture
+def serve(monkeypatch):
+    """Start a fake GitHub for the given repositories, and point the bot at it."""
+    servers = []
+
+    def start(repos, **kwargs):
+        server = FakeGitHub(repos, **kwargs).start()
+        servers.append(server)
+        monkeypatch.setenv('GITHUB_API_URL', server.base_url)
+        monkeypatch.setenv('GITHUB_TOKEN', 'fake')
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
@@ -0,0 +1,16 @@
+import pytest
+
+import stale_issues
+import stale_pull_requests
+from stale_core import Template
+
+
+def test_templates_fill_in_like_format():
+    fields = dict(closelabel='Close?', keepopen='keep-open', pasttime='a year',
+                  futuretime='a month')
+    for template in (stale_issues.ISSUE_CLOSE_WARNING, stale_issues.ISSUE_CLOSE_EPILOGUE,
+                     stale_pull_requests.PULL_REQUESTS_CLOSE_WARNING):
+        assert template.substitute(**fields) == str.format(template, **fields)
+    assert Template('{n:>3} left').substitute(n=7) == '  7 left'
+    with pytest.raises(ValueError):
+        Template('{0} and {}')
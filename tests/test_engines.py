@@ -0,0 +1,54 @@
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+import stale_issues
+import stale_pull_requests
+from fake_github import BOT, MAINTAINER, FakeRepo
+from stale_http import setup_client
+from stale_plan import load_plan
+
+NOW = time.time()
+
+
+def add_edited_warning(repo):
+    """An issue warned before it was labeled, with the warning edited after."""
+    now = datetime.fromtimestamp(NOW, timezone.utc)
+    item = repo.add(False, now - timedelta(days=60))
+    warning = item.add_comment(BOT, stale_issues.ISSUE_CLOSE_WARNING.format(
+        closelabel='Close?', pasttime='a month ago', futuretime='a week'),
+        now - timedelta(days=21))
+    item.add_label('Close?', now - timedelta(days=20), MAINTAINER)
+    item.edit_comment(warning, now - timedelta(days=19))
+    return item
+
+
+def plans(repo, tmp_path, engine, workers):
+    """The changes both passes plan, as of ``NOW``."""
+    g, _, _, telemetry = setup_client(workers=workers)
+    plan_file = str(tmp_path / f'{engine}-{workers}.json')
+    options = dict(is_dryrun=True, fetch_engine=engine, workers=workers, plan_file=plan_file,
+                   g=g, telemetry=telemetry)
+    stale_pull_requests.process_pull_requests(repo.full_name, 12960000, 2592000, max_prs=-1,
+                                              **options)
+    stale_issues.process_issues(repo.full_name, 0, 604800, max_issues=-1, **options)
+    return {section: sorted((action.to_dict() for action in actions), key=repr)
+            for section, (_, actions) in load_plan(plan_file).items()}
+
+
+@pytest.mark.parametrize('engine, workers', [('graphql', 4), ('rest', 1), ('rest', 4),
+                                             ('async', 1), ('async', 4)])
+def test_engines_plan_the_same(serve, tmp_path, monkeypatch, engine, workers):
+    # Comments record when the run started.
+    for module in (stale_pull_requests, stale_issues):
+        monkeypatch.setattr(module, 'time', SimpleNamespace(time=lambda: NOW))
+    repo = FakeRepo.synthetic(150, seed=3)
+    edited = add_edited_warning(repo)
+    serve(repo)
+    expected = plans(repo, tmp_path, 'graphql', 1)
+    assert expected['pulls'] and expected['issues']
+    # The warning counts, as with the since filter of the REST API.
+    assert 'close' in {a['kind'] for a in expected['issues'] if a['number'] == edited.number}
+    assert plans(repo, tmp_path, engine, workers) == expected
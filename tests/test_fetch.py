@@ -0,0 +1,105 @@
+import functools
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import stale_issues
+import stale_pull_requests
+from fake_github import BOT, HUMANS, MAINTAINER, FakeRepo
+from stale_fetch import fetch_issues, fetch_issues_async, fetch_pull_requests
+from stale_http import setup_client
+from stale_plan import load_plan
+
+NOW = datetime.now(timezone.utc)
+
+
+def buried_issue(repo, n_comments=150, n_events=120):
+    """A warned issue whose stale label event and warning are older than the newest 100."""
+    item = repo.add(False, NOW - timedelta(days=60))
+    labeled = NOW - timedelta(days=30)
+    item.add_label('Close?', labeled, MAINTAINER)
+    warning = stale_issues.ISSUE_CLOSE_WARNING.format(
+        closelabel='Close?', pasttime='a day ago', futuretime='a week')
+    item.add_comment(BOT, warning, labeled + timedelta(hours=1))
+    for i in range(n_comments):
+        item.add_comment(HUMANS[i % len(HUMANS)], 'me too', labeled + timedelta(days=1, hours=i))
+    for i in range(n_events):
+        item.add_label(f'area-{i}', labeled + timedelta(days=2, hours=i), MAINTAINER)
+    return item, labeled
+
+
+@pytest.mark.parametrize('n_comments, n_events', [(10, 10), (150, 10), (10, 120), (250, 250)])
+def test_graphql_reads_past_newest_100(serve, n_comments, n_events):
+    repo = FakeRepo(now=NOW)
+    item, labeled = buried_issue(repo, n_comments, n_events)
+    serve(repo)
+    g = setup_client()[0]
+    is_warning = functools.partial(stale_issues.is_close_warning, stale_label='Close?')
+    [facts] = fetch_issues(g, repo.full_name, 'Close?', is_warning)
+    assert [t for t, _ in facts.stale_labeled] == [labeled.replace(microsecond=0)]
+    assert facts.warnings == [(labeled + timedelta(hours=1)).replace(microsecond=0)]
+
+    actions = []
+    stale_issues.plan_one_issue(facts, NOW.timestamp(), 0, 7 * 86400, actions)
+    assert [a.kind for a in actions] == ['add_label', 'comment', 'close']
+
+
+def test_graphql_pr_warning_past_newest_100(serve):
+    repo = FakeRepo(now=NOW)
+    item = repo.add(True, NOW - timedelta(days=400))
+    item.add_commit(NOW - timedelta(days=300))
+    labeled = NOW - timedelta(days=60)
+    item.add_label('Close?', labeled, BOT)
+    warning = stale_pull_requests.PULL_REQUESTS_CLOSE_WARNING.format(
+        keepopen='keep-open', pasttime='5 months', futuretime='a month')
+    item.add_comment(BOT, warning, labeled + timedelta(seconds=30))
+    for i in range(120):
+        item.add_comment(HUMANS[0], 'ping', labeled + timedelta(days=1, hours=i))
+    serve(repo)
+    g = setup_client()[0]
+    [facts] = fetch_pull_requests(g, repo.full_name, 'Close?',
+                                  stale_pull_requests.is_close_warning)
+    assert facts.warnings == [(labeled + timedelta(seconds=30)).replace(microsecond=0)]
+
+
+@pytest.mark.parametrize('engine', ['graphql', 'rest', 'async'])
+def test_label_older_than_history_counts_from_horizon(serve, tmp_path, engine):
+    repo = FakeRepo(now=NOW)
+    item = repo.add(True, NOW - timedelta(days=400))
+    item.add_commit(NOW - timedelta(days=300))
+    item.add_label('Close?', NOW - timedelta(days=250), BOT)
+    warning = stale_pull_requests.PULL_REQUESTS_CLOSE_WARNING.format(
+        keepopen='keep-open', pasttime='5 months', futuretime='a month')
+    item.add_comment(BOT, warning, NOW - timedelta(days=60))
+    serve(repo)
+    g, _, _, telemetry = setup_client()
+    plan_file = str(tmp_path / 'plan.json')
+    stale_pull_requests.process_pull_requests(
+        repo.full_name, 150 * 86400, 30 * 86400, is_dryrun=True, fetch_engine=engine,
+        history_days=200, plan_file=plan_file, g=g, telemetry=telemetry)
+    [(_, plan)] = load_plan(plan_file).values()
+    assert [a.kind for a in plan] == ['add_label', 'comment', 'close']
+
+
+def test_async_reads_only_the_newest_pages(serve):
+    repo = FakeRepo(now=NOW)
+    item = repo.add(False, NOW - timedelta(days=400))
+    # Lots of history from long before the issue was labeled.
+    for i in range(350):
+        t = NOW - timedelta(days=300, hours=-i)
+        item.add_comment(HUMANS[i % len(HUMANS)], 'me too', t)
+        item.add_label(f'area-{i}', t, MAINTAINER)
+    item.add_label('Close?', NOW - timedelta(days=30), MAINTAINER)
+    item.add_comment(BOT, stale_issues.ISSUE_CLOSE_WARNING.format(
+        closelabel='Close?', pasttime='a day ago', futuretime='a week'),
+        NOW - timedelta(days=29))
+    fake = serve(repo)
+    g = setup_client()[0]
+    is_warning = functools.partial(stale_issues.is_close_warning, stale_label='Close?')
+    [expected] = fetch_issues(g, repo.full_name, 'Close?', is_warning)
+    before = fake.stats.requests
+    [facts] = fetch_issues_async(g, repo.full_name, 'Close?', is_warning, numbers=[item.number])
+    assert facts.stale_labeled == expected.stale_labeled
+    assert facts.warnings == expected.warnings
+    # The issue, then the first and last pages of its comments and its timeline.
+    assert fake.stats.requests - before == 5
@@ -0,0 +1,41 @@
+import os
+
+from stale_http import LOW_WATER, ResponseCache
+
+
+class Response:
+    def __init__(self, text):
+        self.headers = {'ETag': '"x"', 'Content-Type': 'application/json'}
+        self.text = text
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def test_sizes_in_bytes(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    cache.put('https://api.github.com/a', None, Response('é' * 1000))
+    assert cache._total == directory_size(tmp_path)
+
+
+def test_evicts_down_to_low_water(tmp_path):
+    cache = ResponseCache(str(tmp_path), max_bytes=100000)
+    passes = 0
+    for i in range(500):
+        evictions = cache.evictions
+        cache.put(f'https://api.github.com/{i}', None, Response('x' * 1000))
+        passes += cache.evictions > evictions
+        assert directory_size(tmp_path) <= cache.max_bytes
+    assert cache._total == directory_size(tmp_path)
+    # Each time it goes over, it makes room for several more entries.
+    assert 0 < passes < 500 / 5
+    assert cache.get('https://api.github.com/499') is not None
+
+
+def test_reopened_cache_is_evicted(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    for i in range(30):
+        cache.put(f'https://api.github.com/{i}', None, Response('x' * 1000))
+    cache = ResponseCache(str(tmp_path), max_bytes=10000)
+    assert directory_size(tmp_path) <= 10000 * LOW_WATER
@@ -0,0 +1,56 @@
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+import stale_issues
+import stale_pull_requests
+from fake_github import BOT, MAINTAINER, FakeRepo
+from stale_http import setup_client
+from stale_markers import MARKER_SLACK, read_marker
+from stale_plan import Action, apply_plan, load_plan
+
+NOW = datetime.now(timezone.utc)
+
+
+def test_item_stays_open_if_its_label_fails(serve):
+    repo = FakeRepo(now=NOW)
+    failing = repo.add(False, NOW - timedelta(days=60))
+    closing = repo.add(False, NOW - timedelta(days=60))
+    for item in (failing, closing):
+        item.add_label('Close?', NOW - timedelta(days=30), MAINTAINER)
+    serve(repo, locked_labels=['closed-by-bot'])
+    g = setup_client()[0]
+    plan = [Action(failing.number, 'add_label', label='closed-by-bot')]
+    for item in (failing, closing):
+        plan += [Action(item.number, 'comment', body=stale_issues.ISSUE_CLOSE_EPILOGUE),
+                 Action(item.number, 'close')]
+    assert apply_plan(g, repo.full_name, plan) == {failing.number}
+    assert failing.state == 'open'
+    assert closing.state == 'closed'
+
+
+@pytest.mark.parametrize('engine', ['graphql', 'rest'])
+def test_marker_says_when_the_label_was_applied(serve, tmp_path, monkeypatch, engine):
+    repo = FakeRepo(now=NOW)
+    pr = repo.add(True, NOW - timedelta(days=400))
+    pr.add_commit(NOW - timedelta(days=300))
+    serve(repo)
+    g, _, _, telemetry = setup_client()
+    # Planned an hour before the plan is applied.
+    planned = time.time() - 3600
+    monkeypatch.setattr(stale_pull_requests, 'time', SimpleNamespace(time=lambda: planned))
+    plan_file = str(tmp_path / 'plan.json')
+    stale_pull_requests.process_pull_requests(
+        repo.full_name, 150 * 86400, 30 * 86400, is_dryrun=True, fetch_engine=engine,
+        plan_file=plan_file, g=g, telemetry=telemetry)
+    [(_, plan)] = load_plan(plan_file).values()
+    assert [a.kind for a in plan] == ['add_label', 'comment']
+    assert read_marker(plan[1].body) is None  # Not to be trusted before it is applied
+
+    assert not apply_plan(g, repo.full_name, plan, engine=engine)
+    [labeled] = [e['created_at'] for e in pr.events if e['label'] == 'Close?']
+    [(body, login)] = [(c['body'], c['user']) for c in pr.comments]
+    assert login == BOT
+    assert abs(read_marker(body)['labeled_at'] - labeled) < MARKER_SLACK
@@ -0,0 +1,61 @@
+import json
+import time
+
+import stale_pull_requests
+from fake_github import FakeRepo
+from stale_http import setup_client
+from stale_scheduler import RateLimitScheduler
+
+
+class Response:
+    def __init__(self, status_code, headers, text=''):
+        self.status_code = status_code
+        self.headers = headers
+        self.text = text
+
+
+def budget_headers(remaining, limit=5000, reset_in=3600):
+    return {'X-RateLimit-Limit': str(limit), 'X-RateLimit-Remaining': str(remaining),
+            'X-RateLimit-Reset': str(int(time.time() + reset_in))}
+
+
+def test_reads_stop_at_the_reserve_without_waiting():
+    scheduler = RateLimitScheduler(write_reserve=0.1)
+    scheduler.acquire('core', False)
+    scheduler.release('core', False, Response(200, budget_headers(501)))
+    assert not scheduler.reads_exhausted()
+    scheduler.acquire('core', False)
+    scheduler.release('core', False, Response(200, budget_headers(500)))
+    assert scheduler.reads_exhausted()
+    # Nothing is held back for the reset.
+    assert scheduler._wait_time('core', False, time.time()) == 0
+    assert scheduler._wait_time('core', True, time.time() + 1) == 0
+
+
+def test_spent_budget_is_not_waited_for():
+    scheduler = RateLimitScheduler()
+    spent = Response(403, budget_headers(0), 'API rate limit exceeded')
+    scheduler.acquire('core', False)
+    assert not scheduler.release('core', False, spent)
+    assert scheduler._blocked_until == 0
+
+    secondary = Response(403, {'Retry-After': '2'}, 'You have exceeded a secondary rate limit')
+    scheduler.acquire('core', False)
+    assert scheduler.release('core', False, secondary)
+    assert 0 < scheduler._blocked_until - time.time() <= 2
+
+
+def test_pass_stops_when_rate_limit_runs_low(serve, tmp_path, capsys):
+    repo = FakeRepo.synthetic(300, seed=1)
+    server = serve(repo, rate_limit=200)
+    g, _, _, telemetry = setup_client()
+    start = time.time()
+    stale_pull_requests.process_pull_requests(
+        repo.full_name, 12960000, 2592000, max_prs=-1, fetch_engine='rest', is_dryrun=True,
+        state_file=str(tmp_path / 'state.json'), g=g, telemetry=telemetry)
+    assert time.time() - start < 60
+    assert 'Stopping early' in capsys.readouterr().out
+    assert server.stats.requests <= 200
+    state = json.loads((tmp_path / 'state.json').read_text())['pulls']
+    assert not state['complete']
+    assert state['cursor'] is not None
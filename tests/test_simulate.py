@@ -0,0 +1,21 @@
+import pytest
+
+from fake_github import FakeRepo
+from stale_http import setup_client
+
+pytest.importorskip('numpy')
+
+import stale_simulate  # noqa: E402
+
+
+def test_simulation_agrees_with_the_bot(serve, tmp_path, capsys):
+    repo = FakeRepo.synthetic(200, seed=4)
+    serve(repo)
+    path = str(tmp_path / 'snapshot.json')
+    stale_simulate.save_snapshot(stale_simulate.take_snapshot(setup_client()[0], repo.full_name),
+                                 path)
+    assert stale_simulate.main(['run', path, '--days', '60', '--check',
+                                '--warn-pr-seconds', '12960000', '7776000',
+                                '--close-issue-seconds', '604800', '1209600']) == 0
+    out = capsys.readouterr().out
+    assert out.count('Checked against the bot: 0 mismatches') == 2
@@ -0,0 +1,62 @@
+import sqlite3
+import time
+from types import SimpleNamespace
+
+import stale_issues
+import stale_pull_requests
+from fake_github import FakeRepo
+from stale_http import setup_client
+from stale_plan import load_plan
+from stale_snapshot import SnapshotWriter, read_items, replay
+from stalebot import repository_environ
+
+NOW = time.time()
+
+
+def test_each_repository_gets_its_own_snapshot():
+    environ = {'STALEBOT_SNAPSHOT_FILE': 'snapshot.sqlite'}
+    assert (repository_environ('astropy/photutils', {}, environ)['STALEBOT_SNAPSHOT_FILE'] ==
+            'snapshot.astropy.photutils.sqlite')
+    overrides = {'astropy/*': {'STALEBOT_SNAPSHOT_FILE': 'shared.sqlite'}}
+    assert (repository_environ('astropy/photutils', overrides, environ)['STALEBOT_SNAPSHOT_FILE']
+            == 'shared.sqlite')
+
+
+def test_snapshot_errors_do_not_stop_the_pass(serve, tmp_path, monkeypatch, capsys):
+    def locked(*args, **kwargs):
+        raise sqlite3.OperationalError('database is locked')
+
+    monkeypatch.setattr(SnapshotWriter, 'record', locked)
+    monkeypatch.setattr(SnapshotWriter, 'close', locked)
+    repo = FakeRepo.synthetic(100, seed=5)
+    serve(repo)
+    g, _, _, telemetry = setup_client()
+    plan_file = str(tmp_path / 'plan.json')
+    stale_issues.process_issues(repo.full_name, 0, 604800, is_dryrun=True, plan_file=plan_file,
+                                snapshot_file=str(tmp_path / 'snapshot.sqlite'), g=g,
+                                telemetry=telemetry)
+    assert 'database is locked' in capsys.readouterr().out
+    assert load_plan(plan_file)['issues'][1]
+
+
+def test_replay_of_a_run_plans_nothing_more(serve, tmp_path, monkeypatch):
+    for module in (stale_pull_requests, stale_issues):
+        monkeypatch.setattr(module, 'time', SimpleNamespace(time=lambda: NOW))
+    repo = FakeRepo.synthetic(150, seed=3)
+    serve(repo)
+    g, _, _, telemetry = setup_client()
+    plan_file = str(tmp_path / 'plan.json')
+    snapshot_file = str(tmp_path / 'snapshot.sqlite')
+    options = dict(is_dryrun=True, plan_file=plan_file, snapshot_file=snapshot_file, g=g,
+                   telemetry=telemetry)
+    stale_pull_requests.process_pull_requests(repo.full_name, 12960000, 2592000, max_prs=-1,
+                                              **options)
+    stale_issues.process_issues(repo.full_name, 0, 604800, max_issues=-1, **options)
+    planned = {section: {a.kind for a in actions}
+               for section, (_, actions) in load_plan(plan_file).items()}
+    assert {'add_label', 'comment', 'close'} <= planned['pulls']
+    assert {'comment', 'close'} <= planned['issues']
+
+    # Labels added, warnings left and items closed by the run are not planned again
+    # by a replay soon after.
+    assert replay(read_items(snapshot_file), NOW + 60, environ={}) == {'pulls': [], 'issues': []}
@@ -0,0 +1,15 @@
+from stalebot import item_of_event
+
+
+def event(sender, sender_type='Bot'):
+    return {'action': 'synchronize', 'sender': {'login': sender, 'type': sender_type},
+            'pull_request': {'number': 7, 'state': 'open'}}
+
+
+def test_only_own_events_are_skipped():
+    assert item_of_event('pull_request_target', event('github-actions[bot]')) is None
+    assert item_of_event('pull_request_target', event('pre-commit-ci[bot]')) == ('pulls', 7)
+    assert item_of_event('pull_request_target', event('dependabot[bot]')) == ('pulls', 7)
+    assert item_of_event('pull_request_target', event('pllim', 'User'),
+                         own_login='pllim') is None
+    assert item_of_event('pull_request_target', event('pllim', 'User')) == ('pulls', 7)
@@ -0,0 +1,54 @@
+import json
+import math
+
+import pytest
+
+import stale_pull_requests
+from fake_github import FakeRepo
+from stale_http import setup_client
+from stale_plan import load_plan
+from stale_state import DeadlineIndex, policy_for
+
+
+def test_save_keeps_unapplied_items_due(tmp_path):
+    path = str(tmp_path / 'state.json')
+    index = DeadlineIndex(path, 'issues', policy_for(0, 604800, 'Close?', 'keep-open'))
+    index.record(1, None, 1000.)
+    index.record(2, None, math.inf)
+    index.save(0., True, due=[2, 3])
+    items = json.loads((tmp_path / 'state.json').read_text())['issues']['items']
+    assert items == {'1': {'updated_at': None, 'deadline': 1000.},
+                     '2': {'updated_at': None, 'deadline': 0}}
+    # Only the file has them due, until the changes are applied.
+    assert index.items['2']['deadline'] is None
+
+
+def test_killed_run_leaves_planned_items_due(serve, tmp_path, monkeypatch):
+    repo = FakeRepo.synthetic(400, seed=2)
+    serve(repo)
+    g, _, _, telemetry = setup_client()
+
+    def killed(*args, **kwargs):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(stale_pull_requests, 'apply_plan', killed)
+    with pytest.raises(KeyboardInterrupt):
+        stale_pull_requests.process_pull_requests(
+            repo.full_name, 12960000, 2592000, max_prs=-1, fetch_engine='graphql',
+            state_file=str(tmp_path / 'state.json'), plan_file=str(tmp_path / 'plan.json'),
+            g=g, telemetry=telemetry)
+    _, plan = load_plan(str(tmp_path / 'plan.json'))['pulls']
+    items = json.loads((tmp_path / 'state.json').read_text())['pulls']['items']
+    assert len(items) >= 100
+    planned = {str(action.number) for action in plan} & set(items)
+    assert planned
+    assert all(items[n]['deadline'] == 0 for n in planned)
+
+
+def test_history_days_invalidates_index(tmp_path):
+    path = str(tmp_path / 'state.json')
+    index = DeadlineIndex(path, 'pulls', policy_for(1, 2, 'Close?', 'keep-open'))
+    index.save(0., True)
+    assert DeadlineIndex(path, 'pulls', policy_for(1, 2, 'Close?', 'keep-open')).usable
+    assert not DeadlineIndex(path, 'pulls', policy_for(1, 2, 'Close?', 'keep-open',
+                                                       history_days=30)).usable
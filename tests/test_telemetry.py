@@ -0,0 +1,27 @@
+import pytest
+
+import stale_pull_requests
+from fake_github import FakeRepo
+from stale_http import setup_client
+from stale_telemetry import markdown_report
+
+
+@pytest.mark.parametrize('engine, fetched_as',
+                         [('graphql', 'fetch'), ('async', 'fetch'), ('rest', 'list')])
+def test_phases_and_step_summary(serve, engine, fetched_as):
+    repo = FakeRepo.synthetic(50, seed=4)
+    serve(repo)
+    g, _, _, telemetry = setup_client()
+    stale_pull_requests.process_pull_requests(repo.full_name, 12960000, 2592000, max_prs=-1,
+                                              is_dryrun=True, fetch_engine=engine, g=g,
+                                              telemetry=telemetry)
+    report = telemetry.report(repo.full_name)
+    phases = report['phases']['pulls']
+    assert fetched_as in phases
+    if engine == 'graphql':
+        # Fetching the facts is not counted as listing the PRs.
+        assert 'list' not in phases and phases['fetch']['requests'] > 0
+
+    summary = markdown_report(report)
+    assert '| pulls | fetch |' in summary
+    assert '"endpoints"' not in summary
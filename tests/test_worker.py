@@ -0,0 +1,93 @@
+import hashlib
+import hmac
+import json
+import os
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from fake_github import FakeRepo
+from stale_worker import Worker, main, serve_webhooks
+
+SECRET = 'hush'
+
+
+def post(server, event_name, event, secret=SECRET):
+    body = json.dumps(event).encode()
+    headers = {'X-GitHub-Event': event_name, 'Content-Type': 'application/json'}
+    if secret:
+        headers['X-Hub-Signature-256'] = 'sha256=' + hmac.new(
+            secret.encode(), body, hashlib.sha256).hexdigest()
+    request = urllib.request.Request(f'http://127.0.0.1:{server.server_address[1]}/',
+                                     data=body, headers=headers)
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def test_sweeps_and_webhooks(serve, tmp_path, capsys):
+    repo = FakeRepo.synthetic(150, seed=6)
+    fake = serve(repo)
+    report_file = tmp_path / 'report.json'
+    worker = Worker([repo.full_name], environ=dict(
+        os.environ, STALEBOT_DRYRUN='1', STALEBOT_MAX_PRS='-1', STALEBOT_MAX_ISSUES='-1',
+        STALEBOT_REPORT_FILE=str(report_file)))
+
+    worker.sweep()
+    assert (json.loads(report_file.read_text())['totals']['requests'] ==
+            fake.stats.requests > 0)
+    telemetry = worker.telemetry
+    assert telemetry.requests == 0
+
+    # Only what changed or came due is checked again, as the first sweep left it.
+    first = fake.stats.requests
+    capsys.readouterr()
+    worker.sweep()
+    out = capsys.readouterr().out
+    assert 'PRs updated or due since' in out and 'issues updated or due since' in out
+    assert (json.loads(report_file.read_text())['totals']['requests'] ==
+            fake.stats.requests - first > 0)
+    assert worker.telemetry is not telemetry and worker.telemetry.requests == 0
+
+    with pytest.raises(ValueError):
+        serve_webhooks(worker, 0)
+    server = serve_webhooks(worker, 0, secret=SECRET, host='127.0.0.1')
+    try:
+        number = repo.open_items(is_pr=True)[0].number
+        event = {'action': 'synchronize', 'sender': {'login': 'pre-commit-ci[bot]', 'type': 'Bot'},
+                 'pull_request': {'number': number, 'state': 'open'},
+                 'repository': {'full_name': repo.full_name}}
+        assert post(server, 'pull_request_target', event, secret='') == 401
+        assert post(server, 'pull_request_target', event) == 202
+        before = fake.stats.requests
+        capsys.readouterr()
+        assert worker.check_events(timeout=5) == 1
+        assert fake.stats.requests > before
+        assert f'PR {number}' in capsys.readouterr().out
+        assert worker.telemetry.requests == fake.stats.requests - before
+    finally:
+        server.shutdown()
+
+
+def test_webhooks_need_a_secret(monkeypatch):
+    monkeypatch.delenv('STALEBOT_WEBHOOK_SECRET', raising=False)
+    with pytest.raises(SystemExit):
+        main(['--port', '0'])
+
+
+def test_sweeps_from_another_thread_stop_at_the_reserve(serve, monkeypatch, capsys):
+    repo = FakeRepo.synthetic(50, seed=6)
+    serve(repo)
+    worker = Worker([repo.full_name], environ=dict(os.environ, STALEBOT_DRYRUN='1'))
+    monkeypatch.setattr(worker.scheduler, 'reads_exhausted', lambda: True)
+    capsys.readouterr()
+    thread = threading.Thread(target=worker.sweep)
+    thread.start()
+    thread.join()
+    out = capsys.readouterr().out
+    assert out.count('Stopping early') == len(worker.passes)
+    assert '-> ' not in out